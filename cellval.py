@@ -5,8 +5,12 @@
 
 
 import traceback
+import enum
+import copy
+import dis
 import parsekvc as parse
 import funcs
+import syncd
 
 
 me = None
@@ -16,119 +20,302 @@ GBFLYPYTHON = False
 GBTEXT2ZERO = True
 
 
-CALLDEPTHMAX = 10000
 def trap_calclooping(cellKey):
     '''
-    If callDepth crosses the set threshold, then raise a CalcLoop exception and
-    Err tag all involved cells.
+    If the cell is part of a calc loop, as identified by syncd, then raise a CalcLoop
+    exception.
 
-    This is currently set to a very high value of 1000, so that python system recursion
-    limit will kick in and [_]cdata_update will do its magic of evaluating long chains
-    by sliding over the long chain in parts over a configured number of calc runs.
-
-        Inturn any cells still left hanging after [_]cdata_update is done is what gets
-        ErrTagged by it.
-
-        _cdata_update also resets callDepth counter, as it starts fresh recalculations.
-
-    NOTE: Put differently this also has the side-effect of keeping this logic on hold in the back,
-    indirectly, currently.
+    Calc loops are already known from the links between cells, so they are not
+    evaluated at all. Inturn, as cells are evaluated in their dependency order
+    (see nvalue_ordered), any other chaining of cells, however long, doesnt
+    lead to recursion.
     '''
-    curCalcCnt = me['calcCnt'].get(cellKey)
-    if curCalcCnt == None:
-        curCalcCnt = 0
-    curCalcCnt += 1
-    #print("TrapCalcLoop:IN:{}:{}:{}".format(cellKey, me['callDepth'], curCalcCnt), file=GERRFILE)
-    if me['callDepth'] > CALLDEPTHMAX:
-        print("TrapCalcLoop:NoNo:{}:{}".format(me['callDepth'], me['calcCnt']), file=GERRFILE)
-        for key in me['calcCnt']:
-            sData = me['data'].get(key)
-            if sData != None:
-                if sData.startswith('='):
-                    me['data'][key] = "{}:{}".format(ERRLOOP, sData)
-        raise RuntimeError("CalcLoop:{}:{}".format(cellKey, me['callDepth']))
-    me['calcCnt'][cellKey] = curCalcCnt
-    me['cdataUpdate'] = True
+    if cellKey in me['loopOf']:
+        raise RuntimeError("CalcLoop:{}:{}".format(cellKey, len(me['loopOf'][cellKey])))
 
 
-def _nvalue_saddr_or_str(sAddrOr):
+ExprSlot = enum.Enum("ExprSlot", "Cell Func Group")
+EXPRSLOT = "_sv{}"
+def _word_boundary(sLeft, sRight):
     '''
-    If passed a cell address in AlphaNum notation,
-        Return the corresponding cells numeric value
-    Else return the passed string back again.
+    Check if the two given parts will merge into a single word, if joined as is.
     '''
-    bCellAddr, cellKey = parse.celladdr_valid(sAddrOr)
-    if bCellAddr:
-        val = nvalue_key(cellKey)
-        #print("_nvalue_saddr_or_str:{}:{}:{}".format(sAddrOr, cellKey, val), file=GLOGFILE)
-        return val
-    return sAddrOr
+    if (sLeft == "") or (sRight == ""):
+        return False
+    return ((sLeft[-1].isalnum() or (sLeft[-1] == '_')) and (sRight[0].isalnum() or (sRight[0] == '_')))
 
 
-def nvalue_expr(sData):
+gdCodes = dict()
+def compile_expr(sData):
     '''
-    Evaluate the given expression.
+    Compile the given expression into a reusable form.
 
     It identifies sub parts of the expression like functions, celladdresses,
-    groups etc and then try and find their value.
+    groups etc, in the same way as nvalue_expr used to do on each evaluation.
+    Each of these sub parts is represented by a slot variable in the python
+    source, which inturn is compiled into a code object.
 
-    Finally evaluate the simplified expression using python.
+        celladdresses are resolved into their cell keys.
+        functions are split into their name and arguments.
+        groups are inturn compiled recursively.
+
+    Returns a tuple of (codeObject, slotsList). nvalue_compiled only needs to
+    find the values of the slots and run the code object, to get the value.
     '''
     # Remove spaces and identify independent subparts that can be simplified/evaluated.
     evalParts, evalTypes = parse.get_evalparts(sData)
-    sNew = ""
+    lSlots = []
+    sSrc = ""
     for i in range(len(evalParts)):
+        sPart = evalParts[i]
+        slot = None
         if evalTypes[i] == parse.EvalPartType.Func: # Handle functions
-            sCmd, sArgs = evalParts[i].split('(',1)
+            sCmd, sArgs = sPart.split('(',1)
             sArgs = sArgs[:-1]
-            # Handle celladdress callDepth here, so that do_func and partners dont have to worry about same
-            bHasCellAddr = False
-            tlArgs, tlArgTypes = parse.get_evalparts(sArgs)
-            for ti in range(len(tlArgTypes)):
-                if tlArgTypes[ti] == parse.EvalPartType.AlphaNum:
-                    tbCellAddr, tsCellAddr, tPos = parse.get_celladdr(tlArgs[ti])
-                    if tbCellAddr and (tPos == 0):
-                        bHasCellAddr = True
-            # Evaluate the function
-            if bHasCellAddr:
-                me['callDepth'] += 1
-            sVal = funcs.do_func(sCmd, sArgs)
-            if bHasCellAddr:
-                me['callDepth'] -= 1
-            sNew += str(sVal)
+            slot = (ExprSlot.Func, (sCmd, sArgs))
         elif evalTypes[i] == parse.EvalPartType.AlphaNum: # Handle cell addresses
-            me['callDepth'] += 1
-            sNew += str(_nvalue_saddr_or_str(evalParts[i]))
-            me['callDepth'] -= 1
+            bCellAddr, cellKey = parse.celladdr_valid(sPart)
+            if bCellAddr:
+                slot = (ExprSlot.Cell, cellKey)
         elif evalTypes[i] == parse.EvalPartType.Group: # Bracket grouped subexpression
-            sVal = nvalue_expr(evalParts[i][1:-1])
-            sNew += "({})".format(sVal)
+            slot = (ExprSlot.Group, compile_expr(sPart[1:-1]))
+        if slot != None:
+            sPart = EXPRSLOT.format(len(lSlots))
+            lSlots.append(slot)
+        if _word_boundary(sSrc, sPart):
+            sSrc += " "
+        sSrc += sPart
+    # Cells with similar =expressions map to the same python source, so share their code objects
+    code = gdCodes.get(sSrc)
+    if code == None:
+        try:
+            code = compile(sSrc, "<=expr>", "eval", dont_inherit=True)
+        except:
+            print("compile_expr:exception:{}:{}".format(sData, sSrc), file=GERRFILE)
+            raise
+        gdCodes[sSrc] = code
+    return code, lSlots
+
+
+MUTABLETYPES = ( list, dict, set, bytearray )
+VOLATILEEVALS = 0
+# In FlyPython mode, expressions are evaluated with the module's globals, along with
+# their slots. The copy of the globals (gdFlyGlobals) is built once, after the compile
+# caches are cleared, and is shared by the expressions which cant mutate it.
+gdFlyGlobals = None
+gdFlyMutates = dict()
+giFlyDepth = 0
+FLYMUTATINGOPS = { 'STORE_NAME', 'STORE_GLOBAL', 'DELETE_NAME', 'DELETE_GLOBAL' }
+FLYMUTATINGNAMES = { 'globals', 'vars', 'exec', 'eval', 'compile', 'setattr', 'delattr', '__import__' }
+def _fly_mutates(code):
+    '''
+    Check if the given code object could mutate the globals it is evaluated with,
+    either by binding names (like using :=) or by getting at them explicitly.
+    Code objects within it (like of lambdas or comprehensions) are checked too.
+    '''
+    bMutates = gdFlyMutates.get(code)
+    if bMutates != None:
+        return bMutates
+    bMutates = not FLYMUTATINGNAMES.isdisjoint(code.co_names)
+    if not bMutates:
+        for inst in dis.get_instructions(code):
+            if inst.opname in FLYMUTATINGOPS:
+                bMutates = True
+                break
+    if not bMutates:
+        for const in code.co_consts:
+            if (type(const) == type(code)) and _fly_mutates(const):
+                bMutates = True
+                break
+    gdFlyMutates[code] = bMutates
+    return bMutates
+
+
+def _fly_globals(code):
+    '''
+    Get the globals to evaluate the given code object with, in FlyPython mode.
+
+    The shared copy of the module's globals is used, unless the code could mutate
+    it, or it is being used by a outer evaluation (as the slots are put into it),
+    in which case a fresh copy is used.
+    '''
+    global gdFlyGlobals
+    if gdFlyGlobals == None:
+        gdFlyGlobals = globals().copy()
+        gdFlyMutates.clear()
+    if (giFlyDepth > 0) or _fly_mutates(code):
+        return gdFlyGlobals.copy()
+    return gdFlyGlobals
+
+
+def nvalue_compiled(compiled):
+    '''
+    Evaluate the given compiled expression.
+
+    Find the values of all the slots in the compiled expression, and inturn
+    run the code object with these values made available to it by their slot
+    variable names.
+
+    VOLATILEEVALS is incremented whenever a volatile function is evaluated,
+    so that nvalue_key can avoid caching the results of cells which depend
+    on volatile functions, directly or through other cells.
+    '''
+    global VOLATILEEVALS, giFlyDepth
+    code, lSlots = compiled
+    dSlots = dict()
+    for i in range(len(lSlots)):
+        slotType, slot = lSlots[i]
+        if slotType == ExprSlot.Cell:
+            val = nvalue_key(slot)
+            if GBFLYPYTHON and (type(val) == str):
+                # a text cell's content is interpreted as a python expression
+                val = eval(val)
+            elif type(val) in MUTABLETYPES:
+                # dont let the expression modify the cell's cached value in place
+                val = copy.deepcopy(val)
+        elif slotType == ExprSlot.Func:
+            if funcs.is_volatile(slot[0]):
+                VOLATILEEVALS += 1
+            val = funcs.do_func(slot[0], slot[1])
         else:
-            sNew += evalParts[i]
+            val = nvalue_compiled(slot)
+        dSlots[EXPRSLOT.format(i)] = val
     # Evaluate
     try:
-        #print("nvalue_expr:eval:{}:{}".format(sData, sNew), file=GERRFILE)
         if GBFLYPYTHON:
-            val = eval(sNew)
+            if (giFlyDepth == 0) and (gdFlyMutates.get(code) == False):
+                dGlobals = gdFlyGlobals
+            else:
+                dGlobals = _fly_globals(code)
+            dGlobals.update(dSlots)
+            giFlyDepth += 1
+            try:
+                val = eval(code, dGlobals)
+            finally:
+                giFlyDepth -= 1
         else:
-            val = eval(sNew, {}, {})
-    except RecursionError as re:
-        ##DBUG##print("nvalue_expr:RecursionError:{}:{}:{}".format(sData, sNew, re), file=GERRFILE)
-        raise
+            val = eval(code, dSlots)
     except:
-        print("nvalue_expr:exception:{}:{}".format(sData, sNew), file=GERRFILE)
+        print("nvalue_compiled:exception:{}:{}".format(code, dSlots), file=GERRFILE)
         traceback.print_exc(file=GERRFILE)
         val = None
         raise
     return val
 
 
+gdExprs = dict()
+def compile_cache_clear():
+    '''
+    Clear the code objects and compiled expressions cached wrt the expressions
+    themselves (gdCodes and gdExprs), like when the spreadsheet is replaced.
+    The FlyPython globals are built again, when next required.
+    '''
+    global gdFlyGlobals
+    gdCodes.clear()
+    gdExprs.clear()
+    gdFlyGlobals = None
+    gdFlyMutates.clear()
+
+
+def nvalue_expr(sData, cellKey=None):
+    '''
+    Evaluate the given expression.
+
+    If the cell to which the expression belongs is specified, then the
+    compiled form of the expression is cached wrt that cell, so that it
+    is not parsed and compiled again, till the cell content changes. The
+    syncd module drops the cached compiled expression when it is informed
+    about a cell being updated.
+
+    Else, as with the arguments of python functions, the compiled form is
+    cached wrt the expression itself.
+    '''
+    if cellKey == None:
+        compiled = gdExprs.get(sData)
+        if compiled == None:
+            compiled = compile_expr(sData)
+            gdExprs[sData] = compiled
+        return nvalue_compiled(compiled)
+    cexpr = me['cexpr'].get(cellKey)
+    if (cexpr == None) or (cexpr[0] != sData):
+        cexpr = (sData, compile_expr(sData))
+        me['cexpr'][cellKey] = cexpr
+    return nvalue_compiled(cexpr[1])
+
+
 ERRNUM = "#ErrNum#"
+def nvalue_number(sVal):
+    '''
+    Return the value of a cell content starting with +/- or numeric.
+    ERROR tag, if exception.
+    '''
+    try:
+        if GBFLYPYTHON:
+            return eval(sVal)
+        return eval(sVal, {}, {})
+    except:
+        return '{}{}'.format(ERRNUM, sVal)
+
+
+gdPassValues = None
+def nvalue_ordered(lOrder, lExcCells=None):
+    '''
+    Evaluate the given cells in the given order, which should be such that each cell
+    comes after the cells it depends on, as got from syncd.get_evalorder.
+
+    So when a cell is evaluated, the cells it depends on are already evaluated and
+    their values are got from the calc cache, or from gdPassValues for cells whose
+    values cant be cached (like cells depending on volatile functions). Thus cells
+    are evaluated without recursing into other cells, using the explicit stack of
+    syncd.get_evalorder, for chains of cells of any length.
+
+    If lExcCells is given, cells which raise exceptions are added to it and the
+    other cells are evaluated. Else the exception is raised to the caller.
+    '''
+    global gdPassValues
+    bOuter = (gdPassValues == None)
+    if bOuter:
+        gdPassValues = dict()
+    try:
+        for cell in lOrder:
+            try:
+                nvalue_key(cell)
+            except:
+                if lExcCells == None:
+                    raise
+                lExcCells.append(cell)
+                print("nvalue_ordered:exception:{}".format(cell), file=GERRFILE)
+                traceback.print_exc(file=GERRFILE)
+    finally:
+        if bOuter:
+            gdPassValues = None
+
+
+def nvalue_inorder(key, bUseCachedData=True):
+    '''
+    Evaluate the given =expression cell, after evaluating the cells it depends on,
+    which are not already evaluated, in their dependency order.
+    '''
+    global gdPassValues
+    lOrder, sLoopCells = syncd.get_evalorder([key])
+    if key in sLoopCells:
+        raise RuntimeError("CalcLoop:{}:DependsOnLoop".format(key))
+    gdPassValues = dict()
+    try:
+        nvalue_ordered([ cell for cell in lOrder if cell != key ])
+        return nvalue_key(key, bUseCachedData)
+    finally:
+        gdPassValues = None
+
+
 def nvalue_key(key, bUseCachedData=True, bText2Zero=None, bDontCacheText=True):
     '''
     Return the value associated with the given cell, preferably numeric.
     The cell is specified using its corresponding key.
 
+    =expression cells are evaluated in their dependency order, along with the cells
+    they depend on, using nvalue_inorder, unless already in a ordered evaluation pass.
+
     If the cell doesnt contain any data, it will return 0.
     This is unity operation for add++ but not for mult++.
 
@@ -140,6 +327,7 @@ def nvalue_key(key, bUseCachedData=True, bText2Zero=None, bDontCacheText=True):
     Else (return data if bText2Zero is False; otherwise return 0)
 
     Dont cache None or empty cells. Also by default dont cache text cells.
+    Nor cells which depend on volatile functions.
     '''
     if bText2Zero == None:
         bText2Zero = GBTEXT2ZERO
@@ -148,6 +336,8 @@ def nvalue_key(key, bUseCachedData=True, bText2Zero=None, bDontCacheText=True):
         val = me['cdata'].get(key)
         if val != None:
             return val
+        if (gdPassValues != None) and (key in gdPassValues):
+            return _passvalue(key)
     # find the value
     sVal = me['data'].get(key)
     if sVal == None:
@@ -158,15 +348,21 @@ def nvalue_key(key, bUseCachedData=True, bText2Zero=None, bDontCacheText=True):
         val = 0
     elif sVal.startswith("="):
         trap_calclooping(key)
-        val = nvalue_expr(sVal[1:])
-    elif (sVal[0] in [ '+', '-']) or sVal[0].isnumeric():
+        if gdPassValues == None:
+            return nvalue_inorder(key, bUseCachedData)
+        volatileEvals = VOLATILEEVALS
         try:
-            if GBFLYPYTHON:
-                val = eval(sVal)
-            else:
-                val = eval(sVal, {}, {})
+            val = nvalue_expr(sVal[1:], key)
         except:
-            val = '{}{}'.format(ERRNUM, sVal)
+            gdPassValues[key] = (None, False, True)
+            raise
+        bVolatile = (volatileEvals != VOLATILEEVALS)
+        if bVolatile:
+            bUseCachedData = False
+        if (not bUseCachedData) or (val == None):
+            gdPassValues[key] = (val, bVolatile, False)
+    elif (sVal[0] in [ '+', '-']) or sVal[0].isnumeric():
+        val = nvalue_number(sVal)
     else:
         if bDontCacheText:
             bUseCachedData = False
@@ -180,6 +376,20 @@ def nvalue_key(key, bUseCachedData=True, bText2Zero=None, bDontCacheText=True):
     return val
 
 
+def _passvalue(key):
+    '''
+    Return the value of the given cell, as evaluated earlier in the current ordered
+    evaluation pass. If its evaluation had raised a exception, raise a exception.
+    '''
+    global VOLATILEEVALS
+    val, bVolatile, bExc = gdPassValues[key]
+    if bExc:
+        raise RuntimeError("CalcExc:{}".format(key))
+    if bVolatile:
+        VOLATILEEVALS += 1
+    return val
+
+
 def value_key(key, raw=False):
     '''
     Return the value associated with the given cell.
@@ -101,6 +101,83 @@ static PyObject* load_line(PyObject *self, PyObject *args) {
 }
 
 
+// Add the given cell content (utf-8 bytes, not null terminated) to the data dictionary
+static int dict_add_bytes(PyObject *dict, long r, long c, const char *s, Py_ssize_t len) {
+    PyObject *k = Py_BuildValue("(ll)", r, c);
+    if (k == NULL)
+        return -1;
+    PyObject *v = PyUnicode_DecodeUTF8(s, len, NULL);
+    if (v == NULL) {
+        Py_DECREF(k);
+        return -1;
+    }
+    int iRet = PyObject_SetItem(dict, k, v);
+    Py_DECREF(k);
+    Py_DECREF(v);
+    return iRet;
+}
+
+
+// Extract the cell contents from all the lines in the buffer and add them to the given data dictionary
+PyDoc_STRVAR(
+    load_buffer_doc,
+    "numRows, numCols = load_buffer(dataDict, buffer)\n"
+    "--\n\n"
+    "load all the lines of the given csv file content into data dictionary for the cells, in one go.\n"
+    "The buffer can be bytes or a mmap of the file or any other object supporting the buffer protocol.\n"
+    "\n"
+    "Lines can end with \\n or \\r\\n or \\r, and cell contents are decoded as utf-8.\n"
+    "It uses the csv chars set using config_csvchars, and there is no limit on cell content size.\n"
+    "numCols is the number of fields in the last line, as with load_line.\n");
+static PyObject* load_buffer(PyObject *self, PyObject *args) {
+    PyObject *dict;
+    Py_buffer buf;
+    long r = 0;
+    long c = 1;
+
+    if (!PyArg_ParseTuple(args, "Oy*", &dict, &buf)) {
+        return NULL;
+    }
+    const char *s = buf.buf;
+    Py_ssize_t len = buf.len;
+    Py_ssize_t i = 0;
+    while (i < len) {
+        r += 1;
+        c = 1;
+        Py_ssize_t iStart = i;
+        bool bInQuote = false;
+        while (i < len) {
+            char t = s[i];
+            if ((t == '\n') || (t == '\r')) {
+                break;
+            }
+            if (t == gTextQuote) {
+                bInQuote = !bInQuote;
+            } else if ((t == gFieldSep) && !bInQuote) {
+                if ((i > iStart) && (dict_add_bytes(dict, r, c, s+iStart, i-iStart) < 0))
+                    goto error;
+                c += 1;
+                iStart = i+1;
+            }
+            i += 1;
+        }
+        if ((i > iStart) && (dict_add_bytes(dict, r, c, s+iStart, i-iStart) < 0))
+            goto error;
+        // Skip the line end
+        if ((i+1 < len) && (s[i] == '\r') && (s[i+1] == '\n'))
+            i += 2;
+        else
+            i += 1;
+    }
+    PyBuffer_Release(&buf);
+    return Py_BuildValue("(ll)", r, c);
+
+error:
+    PyBuffer_Release(&buf);
+    return NULL;
+}
+
+
 //RE_CAINCR = re.compile("(.*?)([$]?[a-zA-Z]+[$]?[0-9]+[ ]*[:]?)(.*?)")
 PyDoc_STRVAR(
     get_celladdrs_incranges_fromre_doc,
@@ -406,6 +483,7 @@ static PyObject* celladdr_valid_ex(PyObject *self, PyObject *args) {
 
 static PyMethodDef CSVLoadMethods[] = {
     { "load_line", load_line, METH_VARARGS, load_line_doc },
+    { "load_buffer", load_buffer, METH_VARARGS, load_buffer_doc },
     { "get_celladdrs_incranges", get_celladdrs_incranges, METH_VARARGS, get_celladdrs_incranges_doc },
     { "celladdr_valid_ex", celladdr_valid_ex, METH_VARARGS, celladdr_valid_ex_doc },
     { "config_csvchars", config_csvchars, METH_VARARGS, config_csvchars_doc },
@@ -428,6 +506,7 @@ static struct PyModuleDef chelpermodule = {
  * me = dict()
  * ts = "test, me; what else"
  * chelper.load_line(me, 1, ts, len(ts))
+ * chelper.load_buffer(me, b"test, me; what else\nnext; line")
  * chelper.get_celladdrs_incranges("string containing cell addresses (including ranges) like AB12 : BC123 + DE12 - 999 /1.5 + MN93:PQ99 / XY1 :YZ1024")
  */
 PyMODINIT_FUNC PyInit_chelper(void) {
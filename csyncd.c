@@ -1,156 +1,516 @@
 /*
- * C helpers for keeping cells in sync
+ * csyncd - A c based module containing helpers to speed up the logics used by syncd
+ * for keeping the links between cells and inturn the calc cache in sync.
  * HanishKVC, 2020
+ *
+ * The python containers maintained by syncd (ie revLinks, rangeIndex, rangeLevels,
+ * rangeMemo, cdata) are passed in as is and worked on directly, so that the logic
+ * here and the python logic in syncd can be used interchangably.
  */
+#include <Python.h>
+#include <stdbool.h>
+#include <ctype.h>
 
 
-#include <Python.h>
+PyDoc_STRVAR(
+    revlink_add_doc,
+    "revlink_add(revLinks, cell, revLink)\n"
+    "--\n\n"
+    "Update the revLinks of a cell, to include the cell named by revLink.\n");
+static PyObject* revlink_add(PyObject *self, PyObject *args) {
+    PyObject *revLinks, *cell, *revLink;
+    PyObject *cellRevLink;
+
+    if (!PyArg_ParseTuple(args, "O!OO", &PyDict_Type, &revLinks, &cell, &revLink)) {
+        return NULL;
+    }
+    cellRevLink = PyDict_GetItemWithError(revLinks, cell);
+    if (cellRevLink == NULL) {
+        if (PyErr_Occurred())
+            return NULL;
+        cellRevLink = PySet_New(NULL);
+        if (cellRevLink == NULL)
+            return NULL;
+        if (PyDict_SetItem(revLinks, cell, cellRevLink) < 0) {
+            Py_DECREF(cellRevLink);
+            return NULL;
+        }
+        Py_DECREF(cellRevLink);
+    }
+    if (PySet_Add(cellRevLink, revLink) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+
+PyDoc_STRVAR(
+    revlink_discard_doc,
+    "bFound = revlink_discard(revLinks, cell, revLink)\n"
+    "--\n\n"
+    "Update the revLinks of a cell, by removing the cell named by revLink.\n"
+    "Returns False if the cell doesnt have any revLinks.\n");
+static PyObject* revlink_discard(PyObject *self, PyObject *args) {
+    PyObject *revLinks, *cell, *revLink;
+    PyObject *cellRevLink;
+
+    if (!PyArg_ParseTuple(args, "O!OO", &PyDict_Type, &revLinks, &cell, &revLink)) {
+        return NULL;
+    }
+    cellRevLink = PyDict_GetItemWithError(revLinks, cell);
+    if (cellRevLink == NULL) {
+        if (PyErr_Occurred())
+            return NULL;
+        Py_RETURN_FALSE;
+    }
+    if (PySet_Discard(cellRevLink, revLink) < 0)
+        return NULL;
+    Py_RETURN_TRUE;
+}
+
+
+/*
+ * Walk the rangeIndex entries wrt the given cell, and for each range which contains
+ * the cell, add its owner to sOwners and drop its memo from dMemo (if not NULL).
+ */
+static int range_index_walk(PyObject *rangeIndex, PyObject *rangeLevels, PyObject *cellKey, PyObject *sOwners, PyObject *dMemo) {
+    PyObject *level, *levelCnt;
+    Py_ssize_t iPos = 0;
+    long r, c;
 
+    if (!PyTuple_Check(cellKey) || (PyTuple_GET_SIZE(cellKey) != 2)) {
+        PyErr_SetString(PyExc_TypeError, "csyncd:cellKey should be a (r, c) tuple");
+        return -1;
+    }
+    r = PyLong_AsLong(PyTuple_GET_ITEM(cellKey, 0));
+    c = PyLong_AsLong(PyTuple_GET_ITEM(cellKey, 1));
+    if (PyErr_Occurred())
+        return -1;
+    while (PyDict_Next(rangeLevels, &iPos, &level, &levelCnt)) {
+        long lr = PyLong_AsLong(PyTuple_GET_ITEM(level, 0));
+        long lc = PyLong_AsLong(PyTuple_GET_ITEM(level, 1));
+        PyObject *block = Py_BuildValue("(Oll)", level, r >> lr, c >> lc);
+        if (block == NULL)
+            return -1;
+        PyObject *sEntries = PyDict_GetItemWithError(rangeIndex, block);
+        Py_DECREF(block);
+        if (sEntries == NULL) {
+            if (PyErr_Occurred())
+                return -1;
+            continue;
+        }
+        PyObject *it = PyObject_GetIter(sEntries);
+        if (it == NULL)
+            return -1;
+        PyObject *entry;
+        while ((entry = PyIter_Next(it)) != NULL) {
+            PyObject *rect = PyTuple_GET_ITEM(entry, 1);
+            long r1 = PyLong_AsLong(PyTuple_GET_ITEM(rect, 0));
+            long c1 = PyLong_AsLong(PyTuple_GET_ITEM(rect, 1));
+            long r2 = PyLong_AsLong(PyTuple_GET_ITEM(rect, 2));
+            long c2 = PyLong_AsLong(PyTuple_GET_ITEM(rect, 3));
+            if ((r1 <= r) && (r <= r2) && (c1 <= c) && (c <= c2)) {
+                if ((sOwners != NULL) && (PySet_Add(sOwners, PyTuple_GET_ITEM(entry, 0)) < 0)) {
+                    Py_DECREF(entry);
+                    Py_DECREF(it);
+                    return -1;
+                }
+                if ((dMemo != NULL) && (PyDict_Contains(dMemo, rect) == 1)) {
+                    if (PyDict_DelItem(dMemo, rect) < 0) {
+                        Py_DECREF(entry);
+                        Py_DECREF(it);
+                        return -1;
+                    }
+                }
+            }
+            Py_DECREF(entry);
+        }
+        Py_DECREF(it);
+        if (PyErr_Occurred())
+            return -1;
+    }
+    return 0;
+}
+
+
+PyDoc_STRVAR(
+    range_index_query_doc,
+    "sCells = range_index_query(rangeIndex, rangeLevels, cellKey)\n"
+    "--\n\n"
+    "Get the set of cells which depend on the given cell through ranges.\n");
+static PyObject* range_index_query(PyObject *self, PyObject *args) {
+    PyObject *rangeIndex, *rangeLevels, *cellKey;
+
+    if (!PyArg_ParseTuple(args, "O!O!O", &PyDict_Type, &rangeIndex, &PyDict_Type, &rangeLevels, &cellKey)) {
+        return NULL;
+    }
+    PyObject *sCells = PySet_New(NULL);
+    if (sCells == NULL)
+        return NULL;
+    if (range_index_walk(rangeIndex, rangeLevels, cellKey, sCells, NULL) < 0) {
+        Py_DECREF(sCells);
+        return NULL;
+    }
+    return sCells;
+}
+
+
+PyDoc_STRVAR(
+    rangememo_discard_doc,
+    "rangememo_discard(rangeIndex, rangeLevels, rangeMemo, cellKey)\n"
+    "--\n\n"
+    "Drop the memoed results of all ranges which contain the given cell.\n");
+static PyObject* rangememo_discard(PyObject *self, PyObject *args) {
+    PyObject *rangeIndex, *rangeLevels, *rangeMemo, *cellKey;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O", &PyDict_Type, &rangeIndex, &PyDict_Type, &rangeLevels, &PyDict_Type, &rangeMemo, &cellKey)) {
+        return NULL;
+    }
+    if (PyDict_Size(rangeMemo) == 0)
+        Py_RETURN_NONE;
+    if (range_index_walk(rangeIndex, rangeLevels, cellKey, NULL, rangeMemo) < 0)
+        return NULL;
+    Py_RETURN_NONE;
+}
+
+
+// Add the cells which depend on the given cell, either directly or through ranges, to sCells
+static int rev_cells_add(PyObject *revLinks, PyObject *rangeIndex, PyObject *rangeLevels, PyObject *cellKey, PyObject *sCells, PyObject *dMemo) {
+    if (range_index_walk(rangeIndex, rangeLevels, cellKey, sCells, dMemo) < 0)
+        return -1;
+    PyObject *cellRevLink = PyDict_GetItemWithError(revLinks, cellKey);
+    if (cellRevLink == NULL) {
+        if (PyErr_Occurred())
+            return -1;
+        return 0;
+    }
+    PyObject *it = PyObject_GetIter(cellRevLink);
+    if (it == NULL)
+        return -1;
+    PyObject *cell;
+    while ((cell = PyIter_Next(it)) != NULL) {
+        int iRet = PySet_Add(sCells, cell);
+        Py_DECREF(cell);
+        if (iRet < 0) {
+            Py_DECREF(it);
+            return -1;
+        }
+    }
+    Py_DECREF(it);
+    if (PyErr_Occurred())
+        return -1;
+    return 0;
+}
+
+
+PyDoc_STRVAR(
+    rev_cells_doc,
+    "sCells = rev_cells(revLinks, rangeIndex, rangeLevels, cellKey)\n"
+    "--\n\n"
+    "Get the cells which depend on the given cell, either directly or through ranges.\n");
+static PyObject* rev_cells(PyObject *self, PyObject *args) {
+    PyObject *revLinks, *rangeIndex, *rangeLevels, *cellKey;
 
-PyDoc_SetStr(
+    if (!PyArg_ParseTuple(args, "O!O!O!O", &PyDict_Type, &revLinks, &PyDict_Type, &rangeIndex, &PyDict_Type, &rangeLevels, &cellKey)) {
+        return NULL;
+    }
+    PyObject *sCells = PySet_New(NULL);
+    if (sCells == NULL)
+        return NULL;
+    if (rev_cells_add(revLinks, rangeIndex, rangeLevels, cellKey, sCells, NULL) < 0) {
+        Py_DECREF(sCells);
+        return NULL;
+    }
+    return sCells;
+}
+
+
+PyDoc_STRVAR(
     cdata_clear_revlinks_doc,
-    "cdata_clear_revlinks(cellKey, clearedSet=None, depth=0)\n"
+    "cdata_clear_revlinks(cdata, revLinks, rangeIndex, rangeLevels, rangeMemo, cellKey, clearedSet=None)\n"
     "--\n\n"
-    "cdata_clear_revlinks(meCData, cellKey, meRevLinks, clearedSet=None, depth=0)\n"
     "Clear cdata cache entry of a cell and all its revLinks.\n"
     "\n"
     "When a cell is updated, it and all other cells which depend on this\n"
     "cell either directly or indirectly require to be cleared from calc\n"
-    "cache, this logic helps with same.\n" );
-static void cdata_clear_revlinks(PyObject *self, PyObject *args) {
-    //print("DBUG:syncdCdataClearRevLinks:{}:cell[{}]".format(depth, cellKey), file=GERRFILE)
-    PyObject *meCData;
-    PyObject *cellKey;
-    PyObject *meRevLinks;
-    PyList *clearedSet = NULL;
-    int depth = 0;
-
-    if (!PyArg_ParseTuple(args, "OOO|Oi", &meCData, &cellKey, &meRevLinks, &clearedSet, &depth)) {
-        return;
-    }
-    if (PyDict_Contains(meCData, cellKey) == 1) {
-        PyDict_DelItem(meCData, cellKey);
-    }
-    if ((clearedSet != Py_None) && (clearedSet != NULL)) {
-        PySet_Add(clearedSet, cellKey)
-    }
-    if (PyDict_Contains(meRevLinks, cellKey) != 1) {
-        return;
-    }
-    PyList *revLinks = PyDict_GetItem(meRevLinks, cellKey);
-    if (revLinks == NULL)
-        return;
-    int listLen = PyList_Size(revLinks);
-    if (clearedSet == Py_None)
-        clearedSet = NULL;
-    for(i = 0; i < listLen; i++) {
-        PyObject *cell = PyList_GetItem(revLinks, i);
-        if ((clearedSet != NULL) && (PySet_Contains(clearedSet, cell) == 1)) {
-            continue;
+    "cache, this logic helps with same. The memoed results of the ranges\n"
+    "containing the cleared cells are also dropped.\n"
+    "\n"
+    "The dependent cells are walked using a explicit stack, so chains of\n"
+    "any length can be handled. If clearedSet is provided, it is updated\n"
+    "with all the cells cleared from the calc cache.\n");
+static PyObject* cdata_clear_revlinks(PyObject *self, PyObject *args) {
+    PyObject *cdata, *revLinks, *rangeIndex, *rangeLevels, *rangeMemo, *cellKey;
+    PyObject *clearedSet = Py_None;
+
+    if (!PyArg_ParseTuple(args, "O!O!O!O!O!O|O", &PyDict_Type, &cdata, &PyDict_Type, &revLinks,
+                &PyDict_Type, &rangeIndex, &PyDict_Type, &rangeLevels, &PyDict_Type, &rangeMemo,
+                &cellKey, &clearedSet)) {
+        return NULL;
+    }
+    if (clearedSet == Py_None) {
+        clearedSet = PySet_New(NULL);
+    } else if (PySet_Check(clearedSet)) {
+        Py_INCREF(clearedSet);
+    } else {
+        PyErr_SetString(PyExc_TypeError, "csyncd:clearedSet should be a set or None");
+        return NULL;
+    }
+    if (clearedSet == NULL)
+        return NULL;
+    PyObject *lStack = PyList_New(0);
+    PyObject *sRevCells = PySet_New(NULL);
+    if ((lStack == NULL) || (sRevCells == NULL))
+        goto error;
+    if ((PyList_Append(lStack, cellKey) < 0) || (PySet_Add(clearedSet, cellKey) < 0))
+        goto error;
+    while (PyList_GET_SIZE(lStack) > 0) {
+        Py_ssize_t iLast = PyList_GET_SIZE(lStack) - 1;
+        PyObject *cell = PyList_GET_ITEM(lStack, iLast);
+        Py_INCREF(cell);
+        if (PyList_SetSlice(lStack, iLast, iLast+1, NULL) < 0) {
+            Py_DECREF(cell);
+            goto error;
+        }
+        int iRet = PyDict_Contains(cdata, cell);
+        if ((iRet == 1) && (PyDict_DelItem(cdata, cell) < 0))
+            iRet = -1;
+        if (iRet >= 0) {
+            PyObject *dMemo = (PyDict_Size(rangeMemo) > 0) ? rangeMemo : NULL;
+            iRet = rev_cells_add(revLinks, rangeIndex, rangeLevels, cell, sRevCells, dMemo);
+        }
+        Py_DECREF(cell);
+        if (iRet < 0)
+            goto error;
+        PyObject *it = PyObject_GetIter(sRevCells);
+        if (it == NULL)
+            goto error;
+        PyObject *revCell;
+        while ((revCell = PyIter_Next(it)) != NULL) {
+            iRet = PySet_Contains(clearedSet, revCell);
+            if (iRet == 0) {
+                if ((PySet_Add(clearedSet, revCell) < 0) || (PyList_Append(lStack, revCell) < 0))
+                    iRet = -1;
+            }
+            Py_DECREF(revCell);
+            if (iRet < 0)
+                break;
+        }
+        Py_DECREF(it);
+        if ((iRet < 0) || PyErr_Occurred() || (PySet_Clear(sRevCells) < 0))
+            goto error;
+    }
+    Py_DECREF(lStack);
+    Py_DECREF(sRevCells);
+    Py_DECREF(clearedSet);
+    Py_RETURN_NONE;
+
+error:
+    Py_XDECREF(lStack);
+    Py_XDECREF(sRevCells);
+    Py_DECREF(clearedSet);
+    return NULL;
+}
+
+
+/*
+ * Extract the numeric row and col address corresponding to given cell address.
+ * This follows the same logic as celladdr_valid_ex in chelper.
+ */
+static bool celladdr_parse(const char *sAddr, long *pRow, long *pCol) {
+    char sCol[16], sRow[24];
+    int iS = 0, iR = 0, iC = 0;
+    int iState = 0; // 0 (Not in CA yet), 1 (optional col$), 2 (alpha part), 3 (optional row$), 4 (num part), 5 (space at end), 99 (done), -1 (Err)
+    int c;
+
+    while (true) {
+        c = sAddr[iS];
+        if (isalpha(c)) {
+            if (((iState == 0) || (iState == 1) || (iState == 2)) && (iC < (int)sizeof(sCol)-1)) {
+                iState = 2;
+                sCol[iC] = c;
+                iC += 1;
+            } else {
+                iState = -1;
+                break;
+            }
+        } else if(isdigit(c)) {
+            if (((iState == 2) || (iState == 3) || (iState == 4)) && (iR < (int)sizeof(sRow)-1)) {
+                iState = 4;
+                sRow[iR] = c;
+                iR += 1;
+            } else {
+                iState = -1;
+                break;
+            }
+        } else if (c == ' ') {
+            if ((iState == 0) || (iState == 5)) {
+            } else if (iState == 4) {
+                iState= 5;
+            } else {
+                iState = -1;
+                break;
+            }
+        } else if (c == '$') {
+            if (iState == 0) {
+                iState = 1;
+            } else if (iState == 2) {
+                iState = 3;
+            } else {
+                iState = -1;
+                break;
+            }
+        } else if (c == 0) {
+            if ((iState == 4) || (iState == 5)) {
+                iState = 99;
+                break;
+            }
+            iState = -1;
+            break;
+        } else {
+            iState = -1;
+            break;
+        }
+        iS += 1;
+    }
+    if (iState != 99) {
+        return false;
+    }
+    sRow[iR] = 0;
+    *pRow = strtol(sRow, NULL, 10);
+    *pCol = 0;
+    for (iS = 0; iS < iC; iS++) {
+        if ((sCol[iS] >= 'A') && (sCol[iS] <= 'Z')) {
+            *pCol = *pCol*26 + (sCol[iS] - 'A') + 1;
+        } else {
+            *pCol = *pCol*26 + (sCol[iS] - 'a') + 1;
         }
-        cdata_clear_revlinks(meCData, cell, meRevLinks, clearedSet, depth+1)
     }
+    return true;
+}
+
+
+// Get the cell address at the given index of the given list
+static int celladdr_fromlist(PyObject *lAddr, Py_ssize_t i, const char **psAddr, long *pRow, long *pCol) {
+    PyObject *oAddr = PySequence_Fast_GET_ITEM(lAddr, i);
+    *psAddr = PyUnicode_AsUTF8(oAddr);
+    if (*psAddr == NULL)
+        return -1;
+    return celladdr_parse(*psAddr, pRow, pCol) ? 1 : 0;
+}
+
+
+PyDoc_STRVAR(
+    fwd_links_doc,
+    "sLinks, sRects, lInvalid = fwd_links(lCellAddrs)\n"
+    "--\n\n"
+    "Convert the cell addresses (including ranges) got from a =expression,\n"
+    "into the set of cells and the set of range rectangles, it depends on.\n"
+    "\n"
+    "lCellAddrs is a list of lists, each containing either a cell address or\n"
+    "the start and end cell addresses of a range, as returned by\n"
+    "get_celladdrs_incranges. Ranges are returned as (r1, c1, r2, c2) tuples,\n"
+    "and ranges whose end is before their start are skipped.\n"
+    "The cell addresses which are invalid are returned in lInvalid.\n");
+static PyObject* fwd_links(PyObject *self, PyObject *args) {
+    PyObject *lCellAddrs;
+    PyObject *sLinks = NULL, *sRects = NULL, *lInvalid = NULL, *lFast = NULL;
+
+    if (!PyArg_ParseTuple(args, "O", &lCellAddrs)) {
+        return NULL;
+    }
+    lFast = PySequence_Fast(lCellAddrs, "csyncd:lCellAddrs should be a list");
+    sLinks = PySet_New(NULL);
+    sRects = PySet_New(NULL);
+    lInvalid = PyList_New(0);
+    if ((lFast == NULL) || (sLinks == NULL) || (sRects == NULL) || (lInvalid == NULL))
+        goto error;
+    Py_ssize_t iCnt = PySequence_Fast_GET_SIZE(lFast);
+    for (Py_ssize_t i = 0; i < iCnt; i++) {
+        PyObject *lAddr = PySequence_Fast(PySequence_Fast_GET_ITEM(lFast, i), "csyncd:cell address should be a list");
+        if (lAddr == NULL)
+            goto error;
+        Py_ssize_t iLen = PySequence_Fast_GET_SIZE(lAddr);
+        const char *sAddr;
+        long r1, c1, r2, c2;
+        int iRet = 0;
+        PyObject *key = NULL;
+        if (iLen == 1) {
+            iRet = celladdr_fromlist(lAddr, 0, &sAddr, &r1, &c1);
+            if (iRet == 1) {
+                key = Py_BuildValue("(ll)", r1, c1);
+                if ((key == NULL) || (PySet_Add(sLinks, key) < 0))
+                    iRet = -1;
+            }
+        } else if (iLen == 2) {
+            iRet = celladdr_fromlist(lAddr, 0, &sAddr, &r1, &c1);
+            if (iRet == 1)
+                iRet = celladdr_fromlist(lAddr, 1, &sAddr, &r2, &c2);
+            if ((iRet == 1) && (r1 <= r2) && (c1 <= c2)) {
+                key = Py_BuildValue("(llll)", r1, c1, r2, c2);
+                if ((key == NULL) || (PySet_Add(sRects, key) < 0))
+                    iRet = -1;
+            }
+        } else {
+            iRet = 1;
+        }
+        if (iRet == 0) {
+            PyObject *oAddr = PyUnicode_FromString(sAddr);
+            if ((oAddr == NULL) || (PyList_Append(lInvalid, oAddr) < 0))
+                iRet = -1;
+            Py_XDECREF(oAddr);
+        }
+        Py_XDECREF(key);
+        Py_DECREF(lAddr);
+        if (iRet < 0)
+            goto error;
+    }
+    Py_DECREF(lFast);
+    PyObject *tRet = Py_BuildValue("(OOO)", sLinks, sRects, lInvalid);
+    Py_DECREF(sLinks);
+    Py_DECREF(sRects);
+    Py_DECREF(lInvalid);
+    return tRet;
+
+error:
+    Py_XDECREF(lFast);
+    Py_XDECREF(sLinks);
+    Py_XDECREF(sRects);
+    Py_XDECREF(lInvalid);
+    return NULL;
+}
+
+
+static PyMethodDef CSyncdMethods[] = {
+    { "revlink_add", revlink_add, METH_VARARGS, revlink_add_doc },
+    { "revlink_discard", revlink_discard, METH_VARARGS, revlink_discard_doc },
+    { "range_index_query", range_index_query, METH_VARARGS, range_index_query_doc },
+    { "rangememo_discard", rangememo_discard, METH_VARARGS, rangememo_discard_doc },
+    { "rev_cells", rev_cells, METH_VARARGS, rev_cells_doc },
+    { "cdata_clear_revlinks", cdata_clear_revlinks, METH_VARARGS, cdata_clear_revlinks_doc },
+    { "fwd_links", fwd_links, METH_VARARGS, fwd_links_doc },
+    { NULL, NULL, 0, NULL}
+};
+
+
+static struct PyModuleDef csyncdmodule = {
+    PyModuleDef_HEAD_INIT,
+    "csyncd",
+    NULL,
+    -1,
+    CSyncdMethods
+};
+
+
+/* One could test this like this
+ * import csyncd
+ * revLinks = dict()
+ * csyncd.revlink_add(revLinks, (1,1), (2,2))
+ * csyncd.fwd_links([['A1'], ['B2', 'C3']])
+ * or use syncd.test_csyncd() to compare it against the python logic
+ */
+PyMODINIT_FUNC PyInit_csyncd(void) {
+    return PyModule_Create(&csyncdmodule);
 }
 
 
-def cell_updated(cellKey, sContent, clearCache=True, clearedSet=None):
-    '''
-    Update the fw and reverse links associated with each cell
-
-    NOTE: For now it maintains a expanded list of cells. TO keep the
-    logic which depends on this at other places simple and stupid.
-
-    clearedSet can be used to ensure that calc cache clearing can be done
-    efficiently for spreadsheets involving very-very-long chains of
-    cell-to-cell interdependencies. Also when a bunch of cells are
-    updated from the same context like say during insert / delete of
-    rows / cols, the clearedSet helps to avoid trying to clear calc cache
-    of same dependent cells more than once, across multiple calls to
-    cell_updated.
-
-    In normal use one should call cell_updated with a empty clearedSet.
-    Think carefully before using cell_updated without clearedSet.
-    '''
-    global TIMECAP1, TIMECAP2, TIMECAP3, TOKENCAP1
-    origCellFwdLink = me['fwdLinks'].get(cellKey)
-    cellFwdLink = set()
-    # Handle the new content of the cell
-    T1 = time.time()
-    if sContent == None:
-        sContent = ""
-    if sContent.strip().startswith('='):
-        lCellAddrs = parse.get_celladdrs_incranges(sContent)
-        #lCellAddrs = parse.get_celladdrs_incranges_internal(sContent)
-        #print(lCellAddrs, file=GERRFILE)
-    else:
-        lCellAddrs = []
-    TOKENCAP1 += len(lCellAddrs)
-    T2 = time.time()
-    TIMECAP1 += (T2-T1)
-    for cellAddrPlus in lCellAddrs:
-        if (len(cellAddrPlus) == 1):
-            bCellAddr, key = parse.celladdr_valid(cellAddrPlus[0])
-            if not bCellAddr:
-                print("WARN:syncdCellUpdated:{}:{}={}".format(sContent, cellAddrPlus[0], key), file=GERRFILE)
-                continue
-            cellFwdLink.add(key)
-            cell_revlink_add(key, cellKey)
-        elif (len(cellAddrPlus) == 2):
-            bCellAddr, key1 = parse.celladdr_valid(cellAddrPlus[0])
-            if not bCellAddr:
-                print("WARN:syncdCellUpdated:{}:{}={}".format(sContent, cellAddrPlus[0], key1), file=GERRFILE)
-                continue
-            bCellAddr, key2 = parse.celladdr_valid(cellAddrPlus[1])
-            if not bCellAddr:
-                print("WARN:syncdCellUpdated:{}:{}={}".format(sContent, cellAddrPlus[1], key2), file=GERRFILE)
-                continue
-            for r in range(key1[0], key2[0]+1):
-                for c in range(key1[1], key2[1]+1):
-                    cellFwdLink.add((r,c))
-                    cell_revlink_add((r,c), cellKey)
-    T3 = time.time()
-    TIMECAP2 += (T3-T2)
-    # Handle cells removed from the =expression
-    if origCellFwdLink != None:
-        droppedCells = origCellFwdLink.difference(cellFwdLink)
-    else:
-        droppedCells = set()
-    if len(cellFwdLink) > 0:
-        me['fwdLinks'][cellKey] = cellFwdLink
-    else:
-        if origCellFwdLink != None:
-            me['fwdLinks'].pop(cellKey)
-    for cell in droppedCells:
-        cell_revlink_discard(cell, cellKey)
-    # Clear cell calc cache for all dependents
-    if clearCache:
-        cdata_clear_revlinks(cellKey, clearedSet)
-    T4 = time.time()
-    TIMECAP3 += (T4-T3)
-
-
-def create_links():
-    '''
-    Create fwd and rev Links freshly for all cells in the spreadsheet in memory.
-
-    NOTE: Normally when/where create_links is called, even full calc cache update would be
-    triggered by setting cdataUpdate flag to true before or after calling create_links,
-    so the call to cell_updated from create_links can set clearCache to False.
-
-    As create links doesnt touch the calc cache, so remember to either
-
-        force clear the full calc cache by using cdataUpdate
-
-        OR adjust calc cache suitably in the context from where create_links is called.
-    '''
-    init()
-    clearedSet = set()
-    cell_updated_time_init()
-    for key in me['data']:
-        cell_updated(key, me['data'][key], clearCache=False, clearedSet=clearedSet)
-    print("DBUG:T1:{}, T2:{}, T3:{}, CAs:{}".format(TIMECAP1, TIMECAP2, TIMECAP3, TOKENCAP1), file=GERRFILE)
-
-
-
-
-# vim: set sts=4 expandtab: #
+// vim: set sts=4 expandtab: //
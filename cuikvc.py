@@ -160,6 +160,9 @@ def dlg(scr, msgsIn, y=0, x=0, attr=curses.A_NORMAL, border=False, newwin=False,
         cellstr(scr, bY, bX, dispStr, attr)
         scr.move(bY, textCursorX)
         got = scr.getch()
+        # Retry, if getch timed out, like when the window has a timeout set
+        if got == -1:
+            continue
         if getString == None:
             break
         if got == ord('\n'):
@@ -169,6 +169,18 @@ def update_celladdrs_exceptfixed(sIn, afterR, incR, afterC, incC):
 
 
 
+def _links_shifted(cellKey, bRowMode, afterR, afterC):
+    '''
+    Check if the given cell depends on any cells, which will shift due to insert/delete
+    of rows (bRowMode) or cols, after afterR or afterC respectively. Only then does its
+    =expression require to be updated.
+    '''
+    maxR, maxC = syncd.links_extent(cellKey)
+    if bRowMode:
+        return maxR > afterR
+    return maxC > afterC
+
+
 def insert_rc_ab(cmd, args):
     '''
     Insert n number of rows or columns, before or after the current row|column.
@@ -176,6 +188,9 @@ def insert_rc_ab(cmd, args):
     Call update_celladdr to adjust =expressions where required.
 
     Also adjust/update the calc cache data i.e cdata dictionary.
+
+    Inturn syncd is asked to shift the links, rather than parsing all the
+    =expressions again.
     '''
     bRowMode = False
     bColMode = False
@@ -215,8 +230,7 @@ def insert_rc_ab(cmd, args):
         curData = me['data'][k]
         newData = curData
         curCData = me['cdata'].get(k)
-        fwdLinks = me['fwdLinks'].get(k)
-        if (fwdLinks != None) and (len(fwdLinks) > 0):
+        if syncd.has_links(k) and _links_shifted(k, bRowMode, cR, cC):
             newData = update_celladdrs_all(curData, cR, incR, cC, incC, bUpdateFixed=True)
             if newData.find("#Err") == -1:
                 if curCData != None:
@@ -229,13 +243,21 @@ def insert_rc_ab(cmd, args):
     me['cdata'] = newCDataDict
     if bRowMode:
         me['numRows'] += cnt
+        syncd.remap_links(bRowMode, cR, cnt)
     if bColMode:
         me['numCols'] += cnt
+        syncd.remap_links(bRowMode, cC, cnt)
 
 
 def delete_rc(cmd, args):
     '''
     Delete the current+ row(s) or column(s), as specified in the cmd.
+
+    Inturn syncd is asked to shift the links, so that only the =expressions
+    which refer to the deleted cells are parsed again. This includes the cells
+    whose =expressions got err tagged, as their err tagged addresses could be
+    linked differently, like the ends of a range given in reverse order, which
+    isnt linked as a range, but whose err tagged ends are linked as cells.
     '''
     # Identify the delete operation details
     bRowMode = False
@@ -267,48 +289,53 @@ def delete_rc(cmd, args):
     # the cells about to be deleted.
     # THe dependents could be either direct or indirect.
     clearedSet = set()
+    lCells = []
     for r in range(sR, eR+1):
         for c in range(sC, eC+1):
-            syncd.cell_updated((r,c), None, clearedSet=clearedSet)
+            syncd.cell_updated((r,c), None, clearedSet=clearedSet, updateLoops=False)
+            lCells.append((r,c))
+    syncd.update_loops(lCells)
     # update the affected =expressions
     # as well as update the data and calc cache dictionaries
     newDict = dict()
     newCDataDict = dict()
+    sErrTagged = set()
     for k in me['data']:
         r,c = k
         curData = me['data'][k]
         curCData = None
-        fwdLinks = me['fwdLinks'].get(k)
-        if (fwdLinks != None) and (len(fwdLinks) > 0):
-            curData = update_celladdrs_all(curData, sR-1, incR, sC-1, incC, bUpdateFixed=True)
-            if curData.find("#Err") == -1:
-                curCData = me['cdata'].get(k)
-        else:
-            curCData = me['cdata'].get(k)
+        nk = None
         if bRowMode:
             if r < sR:
-                newDict[k] = curData
-                if curCData != None:
-                    newCDataDict[k] = curCData
+                nk = k
             elif r > eR:
-                newDict[(r+incR,c)] = curData
-                if curCData != None:
-                    newCDataDict[(r+incR,c)] = curCData
+                nk = (r+incR,c)
         if bColMode:
             if c < sC:
-                newDict[k] = curData
-                if curCData != None:
-                    newCDataDict[k] = curCData
+                nk = k
             elif c > eC:
-                newDict[(r,c+incC)] = curData
-                if curCData != None:
-                    newCDataDict[(r,c+incC)] = curCData
+                nk = (r,c+incC)
+        if nk == None:
+            continue
+        if syncd.has_links(k) and _links_shifted(k, bRowMode, sR-1, sC-1):
+            curData = update_celladdrs_all(curData, sR-1, incR, sC-1, incC, bUpdateFixed=True)
+            if curData.find("#Err") == -1:
+                curCData = me['cdata'].get(k)
+            else:
+                sErrTagged.add(nk)
+        else:
+            curCData = me['cdata'].get(k)
+        newDict[nk] = curData
+        if curCData != None:
+            newCDataDict[nk] = curCData
     me['data'] = newDict
     me['cdata'] = newCDataDict
     if bRowMode:
         me['numRows'] -= cnt
+        syncd.remap_links(bRowMode, sR-1, incR, sErrTagged)
     if bColMode:
         me['numCols'] -= cnt
+        syncd.remap_links(bRowMode, sC-1, incC, sErrTagged)
 
 
 def copy_cell():
@@ -388,6 +415,7 @@ def _do_rcopy(scr, srcSKey, srcEKey, dstSKey, dstEKey, bAdjustCellAddrs=True):
     baseSrcC = srcSKey[1]
     r = 0
     clearedSet = set()
+    lCells = []
     for dR in range(dstSKey[0], dstEKey[0]+1):
         sR = baseSrcR + (r%srcRLen)
         c = 0
@@ -399,10 +427,15 @@ def _do_rcopy(scr, srcSKey, srcEKey, dstSKey, dstEKey, bAdjustCellAddrs=True):
                     incR = dR - sR
                     incC = dC - sC
                     sData = update_celladdrs_exceptfixed(sData, 0, incR, 0, incC)
-            syncd.cell_updated((dR,dC), sData, clearedSet=clearedSet)
-            me['data'][(dR,dC)] = sData
+            if sData != None:
+                me['data'][(dR,dC)] = sData
+            else:
+                me['data'].pop((dR,dC), None)
+            syncd.cell_updated((dR,dC), sData, clearedSet=clearedSet, updateLoops=False)
+            lCells.append((dR,dC))
             c += 1
         r += 1
+    syncd.update_loops(lCells)
     if dstEKey[0] > me['numRows']:
         me['numRows'] = dstEKey[0]
     if dstEKey[1] > me['numCols']:
@@ -417,10 +450,11 @@ def _do_rclear(scr, dstSKey, dstEKey):
     NOTE: Doesnt alert if clearing cells with data|content in them.
     '''
     clearedSet = set()
-    for dR in range(dstSKey[0], dstEKey[0]+1):
-        for dC in range(dstSKey[1], dstEKey[1]+1):
-            me['data'].pop((dR,dC), None)
-            syncd.cell_updated((dR,dC), "", clearedSet=clearedSet)
+    lCells = syncd.cells_in_range(dstSKey[0], dstSKey[1], dstEKey[0], dstEKey[1])
+    for dR, dC in lCells:
+        me['data'].pop((dR,dC), None)
+        syncd.cell_updated((dR,dC), "", clearedSet=clearedSet, updateLoops=False)
+    syncd.update_loops(lCells)
     return True
 
 
@@ -429,14 +463,15 @@ def _do_rclear_err(scr, dstSKey, dstEKey):
     Clear error tags in the specified block of cells at dst.
     '''
     clearedSet = set()
-    for dR in range(dstSKey[0], dstEKey[0]+1):
-        for dC in range(dstSKey[1], dstEKey[1]+1):
-            sData = me['data'].get((dR,dC), None)
-            if sData != None:
-                if sData.startswith("#Err") and (sData[7] == '#'):
-                    sData = sData[8:]
-                    me['data'][(dR,dC)] = sData
-                    syncd.cell_updated((dR,dC), sData, clearedSet=clearedSet) # Can do without in most cases, but just in case
+    lCells = []
+    for dR, dC in syncd.cells_in_range(dstSKey[0], dstSKey[1], dstEKey[0], dstEKey[1]):
+        sData = me['data'][(dR,dC)]
+        if sData.startswith("#Err") and (sData[7] == '#'):
+            sData = sData[8:]
+            me['data'][(dR,dC)] = sData
+            syncd.cell_updated((dR,dC), sData, clearedSet=clearedSet, updateLoops=False) # Can do without in most cases, but just in case
+            lCells.append((dR,dC))
+    syncd.update_loops(lCells)
     return True
 
 
@@ -455,11 +490,14 @@ def _do_rgennums(scr, startKey, endKey, tokens):
         delta = 1
     curValue = start
     clearedSet = set()
+    lCells = []
     for r in range(startKey[0], endKey[0]+1):
         for c in range(startKey[1], endKey[1]+1):
             me['data'][(r,c)] = "{}".format(curValue)
-            syncd.cell_updated((r,c), "", clearedSet=clearedSet)
+            syncd.cell_updated((r,c), me['data'][(r,c)], clearedSet=clearedSet, updateLoops=False)
+            lCells.append((r,c))
             curValue += delta
+    syncd.update_loops(lCells)
     if endKey[0] > me['numRows']:
         me['numRows'] = endKey[0]
     if endKey[1] > me['numCols']:
@@ -490,22 +528,22 @@ def _do_rsearch(scr, cmd, startKey, endKey, tokens):
         sReplaceWith = tokens[1]
         if sReplaceWith[0] == parse.TOKENQUOTE:
             sReplaceWith = sReplaceWith[1:-1]
-    for r in range(startKey[0], endKey[0]+1):
-        for c in range(startKey[1], endKey[1]+1):
-            curData = me['data'].get((r,c))
-            if curData == None:
-                continue
-            if curData.find(sToFind) == -1:
-                continue
-            nav._goto_cell(scr, r,c)
-            if sReplaceWith == None:
-                dlg(scr, [ 'FoundAt:{}{}:{}                        '.format(coladdr_num2alpha(c), r, curData), 'Press any key for next...' ])
-            else:
-                got = dlg(scr, [ 'FoundAt:{}{}:{}                        '.format(coladdr_num2alpha(c), r, curData), 'Replace [y/N]:' ])
-                if chr(got).upper() == 'Y':
-                    curData = curData.replace(sToFind, sReplaceWith)
-                    me['data'][(r,c)] = curData
-                    bReplaced = True
+    for r, c in syncd.cells_in_range(startKey[0], startKey[1], endKey[0], endKey[1]):
+        curData = me['data'].get((r,c))
+        if curData == None:
+            continue
+        if curData.find(sToFind) == -1:
+            continue
+        nav._goto_cell(scr, r,c)
+        if sReplaceWith == None:
+            dlg(scr, [ 'FoundAt:{}{}:{}                        '.format(coladdr_num2alpha(c), r, curData), 'Press any key for next...' ])
+        else:
+            got = dlg(scr, [ 'FoundAt:{}{}:{}                        '.format(coladdr_num2alpha(c), r, curData), 'Replace [y/N]:' ])
+            if chr(got).upper() == 'Y':
+                curData = curData.replace(sToFind, sReplaceWith)
+                me['data'][(r,c)] = curData
+                syncd.cell_updated((r,c), curData, clearedSet=set())
+                bReplaced = True
     return True, bReplaced
 
 
@@ -627,4 +665,34 @@ def do_mcmd(scr, cmd, args):
 
 
 
+def test_delete_rc_links():
+    '''
+    Check that the links remapped after deleting a row/col, match those built freshly
+    by create_links, for =expressions whose reversed ranges get err tagged, as their
+    err tagged ends are linked as cells. AssertionError is raised, if they dont match.
+    '''
+    global me, coladdr_num2alpha
+    savedGlobals = (me, coladdr_num2alpha, syncd.me)
+    try:
+        coladdr_num2alpha = lambda c: chr(ord('A')+c-1)
+        for cmd, sData, sExpected in [
+                ("dr", "=SUM(C5:H1)+A6", "=SUM(C4:#ErrRow#H1)+A5"),
+                ("dc", "=PROD(Q46:B53)+E34", "=PROD(P46:#ErrCol#B53)+D34") ]:
+            me = { 'data': { (1,6): "1", (2,6): sData }, 'cdata': dict(), 'numRows': 60, 'numCols': 20,
+                    'editCount': 0, 'dirtyRows': None, 'curRow': 1, 'curCol': 2 }
+            syncd.me = me
+            syncd.init()
+            syncd.sparse_build()
+            syncd.create_links()
+            delete_rc(cmd, "1")
+            nk = (1,6) if cmd == "dr" else (2,5)
+            assert me['data'][nk] == sExpected, "test_delete_rc_links:{}:{}".format(cmd, me['data'][nk])
+            lGot = [ me['fwdLinks'], me['fwdRanges'], me['loopOf'] ]
+            syncd.create_links()
+            assert lGot == [ me['fwdLinks'], me['fwdRanges'], me['loopOf'] ], "test_delete_rc_links:{}:{}:MISMATCH".format(cmd, lGot)
+            print("test_delete_rc_links:{}:ok".format(cmd))
+    finally:
+        me, coladdr_num2alpha, syncd.me = savedGlobals
+
+
 # vim: set sts=4 expandtab: #
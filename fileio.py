@@ -13,6 +13,13 @@ import cuikvc as cui
 import syncd
 import time
 import importlib
+import json
+import hashlib
+import mmap
+import concurrent.futures
+import marshal
+import struct
+import tempfile
 
 
 # Entities from main logic
@@ -29,6 +36,40 @@ THEFIELDSEP = None
 # Both use similar concepts, but bitstreams are not directly interchangable
 bInternalEncDec = True
 
+# Whether to save and use the deps sidecar file (file.csv.deps), which holds
+# the links between the cells, along with unencrypted csv files.
+# Off by default, enabled using the --depssidecar commandline argument.
+bDepsSidecar = False
+DEPSVERSION = 1
+
+# Binary snapshot files hold the spreadsheet in memory along with its links, calc
+# loops and calc cache, so that large sheets can be loaded without parsing them.
+# It has a header (SNAPMAGIC, SNAPVERSION, marshal version, python major and minor
+# version), followed by sections, each of which is a 4 byte tag, 8 byte length and
+# inturn its marshalled content. As the marshal format can change across python
+# versions, snapshots are loaded only by the python version which saved them.
+SNAPMAGIC = b"\x00SSKVCSNAP\x00"
+SNAPVERSION = 2
+SNAPHEADER = "<IIHH"
+
+# Whether to save into the same csv file incrementally, by reusing the lines of the
+# rows not modified since its last load/save, as is
+bIncrementalSave = True
+
+# Autosave: If AUTOSAVEINTERVAL (in seconds) is more than 0, unsaved changes are saved
+# periodically into a recovery file (file.autosave), by a forked child process, which
+# works on its copy-on-write snapshot of the spreadsheet in memory. So the user can
+# continue working, while it is being saved.
+AUTOSAVEINTERVAL = 0
+AUTOSAVEPOLLMS = 1000
+AUTOSAVESUFFIX = ".autosave"
+AUTOSAVEUNNAMED = "sskvc_"
+gAutoSave = { 'pid': None, 'file': None, 'editCount': None, 'time': 0 }
+
+# Number of lines, beyond which the line crypto of protected files is spread
+# across a pool of threads
+PARALLELCRYPT = 1000
+
 
 chelper = None
 def load_cext():
@@ -39,6 +80,275 @@ def load_cext():
         print("WARN:fileio:Couldnt load the chelper c module, so using slightly slower but better tested python logic", file=GERRFILE)
 
 
+def _deps_hasher():
+    '''
+    Get the hasher used wrt the content of a csv file, to key its deps sidecar file.
+
+    The csv chars are hashed first, as the cell contents and inturn the links
+    between the cells, got from the csv file, depend on them.
+    '''
+    hasher = hashlib.sha256()
+    hasher.update("{}{}".format(THEFIELDSEP, THEQUOTE).encode())
+    return hasher
+
+
+def _save_deps(me, sFile, sHash):
+    '''
+    Save the fwd links and ranges of the cells along with the calc loops, into the
+    deps sidecar file of the given csv file, keyed by the hash of the csv file content.
+
+    If any cell with links was not saved as is into the csv file (those protected
+    with quotes, as they contain the field seperator, and those beyond the numRows/
+    numCols), then the links created from the csv file wont match those in memory,
+    so the sidecar file is not saved and False is returned.
+    '''
+    lLinks = []
+    for cellKey in me['fwdLinks'].keys() | me['fwdRanges'].keys():
+        if (cellKey[0] > me['numRows']) or (cellKey[1] > me['numCols']):
+            return False
+        if me['data'].get(cellKey, "").find(THEFIELDSEP) != -1:
+            return False
+        lFwdLink = list(me['fwdLinks'].get(cellKey, ()))
+        lFwdRange = list(me['fwdRanges'].get(cellKey, ()))
+        lLinks.append([ cellKey[0], cellKey[1], lFwdLink, lFwdRange ])
+    lLoops = [ list(sLoop) for sLoop in set(me['loopOf'].values()) ]
+    sDepsFile = "{}.deps".format(sFile)
+    # json.dumps uses the C encoder, unlike json.dump, which streams through the python one
+    sDeps = json.dumps({ 'version': DEPSVERSION, 'hash': sHash, 'links': lLinks, 'loops': lLoops })
+    f = open("{}.tmp".format(sDepsFile), "w")
+    f.write(sDeps)
+    f.close()
+    os.replace("{}.tmp".format(sDepsFile), sDepsFile)
+    return True
+
+
+def save_deps(me, sFile, sHash):
+    '''
+    Save the deps sidecar file. If not saved, as is the case for encrypted files
+    (sHash is None), whose links shouldnt be leaked, then remove any existing one.
+
+    Any issue with the sidecar file doesnt fail the saving of the csv file.
+    '''
+    try:
+        if (sHash != None) and _save_deps(me, sFile, sHash):
+            return
+        if os.path.exists("{}.deps".format(sFile)):
+            os.remove("{}.deps".format(sFile))
+    except:
+        print("WARN:fileio:saveDeps:{}:{}".format(sFile, sys.exc_info()), file=GERRFILE)
+
+
+def _load_deps(me, sFile, sHash):
+    '''
+    Restore the links between the cells, from the deps sidecar file of the given csv
+    file, provided it matches the hash of the csv file content just loaded.
+
+    Returns True if restored, else False.
+    '''
+    sDepsFile = "{}.deps".format(sFile)
+    if not os.path.exists(sDepsFile):
+        return False
+    f = open(sDepsFile)
+    dDeps = json.load(f)
+    f.close()
+    if (dDeps.get('version') != DEPSVERSION) or (dDeps.get('hash') != sHash):
+        print("INFO:fileio:loadDeps:{}:stale, ignoring".format(sDepsFile), file=GERRFILE)
+        return False
+    dFwdLinks = dict()
+    dFwdRanges = dict()
+    for r, c, lFwdLink, lFwdRange in dDeps['links']:
+        if len(lFwdLink) > 0:
+            dFwdLinks[(r,c)] = set(map(tuple, lFwdLink))
+        if len(lFwdRange) > 0:
+            dFwdRanges[(r,c)] = set(map(tuple, lFwdRange))
+    dLoopOf = dict()
+    for lLoop in dDeps['loops']:
+        sLoop = frozenset(map(tuple, lLoop))
+        for cell in sLoop:
+            dLoopOf[cell] = sLoop
+    syncd.restore_links(dFwdLinks, dFwdRanges, dLoopOf)
+    return True
+
+
+def load_deps(me, sFile, sHash):
+    '''
+    Restore the links between the cells from the deps sidecar file, if possible.
+    Else create them freshly from the cell contents.
+    '''
+    if sHash != None:
+        try:
+            if _load_deps(me, sFile, sHash):
+                return
+        except:
+            print("WARN:fileio:loadDeps:{}:{}".format(sFile, sys.exc_info()), file=GERRFILE)
+    syncd.create_links()
+
+
+def _enc_line(r, line, userKey, fileKey):
+    '''
+    Encrypt the given line of row r, using its line specific key.
+    '''
+    lineKey = sec.get_linekey(r, userKey, fileKey)
+    if bInternalEncDec:
+        return sec.aes_cbc_enc_b64(base64.urlsafe_b64decode(lineKey), line).decode()
+    sym = cryptography.fernet.Fernet(lineKey)
+    return sym.encrypt(line.encode()).decode()
+
+
+def _dec_line(r, line, userKey, fileKey):
+    '''
+    Decrypt the given line of row r, using its line specific key.
+    '''
+    lineKey = sec.get_linekey(r, userKey, fileKey)
+    if bInternalEncDec:
+        return sec.aes_cbc_dec_b64(base64.urlsafe_b64decode(lineKey), line.encode()).decode()
+    sym = cryptography.fernet.Fernet(lineKey)
+    return sym.decrypt(line.encode()).decode()
+
+
+def _crypt_chunk(fCrypt, lRows, lLines, userKey, fileKey):
+    '''
+    Apply fCrypt to the given chunk of lines, which belong to the rows in lRows.
+    '''
+    return [ fCrypt(r, line, userKey, fileKey) for r, line in zip(lRows, lLines) ]
+
+
+def _crypt_parallel(fCrypt, lRows, lLines, userKey, fileKey, numWorkers):
+    '''
+    Apply fCrypt to the given lines, by splitting them into chunks, which are handled
+    by a pool of threads, and yield the results back in order.
+    '''
+    chunkSize = (len(lLines) // (numWorkers*4)) + 1
+    with concurrent.futures.ThreadPoolExecutor(numWorkers) as pool:
+        lFutures = [ pool.submit(_crypt_chunk, fCrypt, lRows[i:i+chunkSize], lLines[i:i+chunkSize], userKey, fileKey) for i in range(0, len(lLines), chunkSize) ]
+        for fut in lFutures:
+            yield from fut.result()
+
+
+def _crypt_lines(fCrypt, lRows, lLines, userKey, fileKey):
+    '''
+    Apply fCrypt (_enc_line or _dec_line) to the given lines, which belong to the rows
+    in lRows, and return a iterator over the resulting lines, in the same order.
+
+    As the key of each line is derived from its row number, the lines can be handled
+    independently of one another. So if there are more than PARALLELCRYPT lines, they
+    are spread across a pool of threads, as the cryptography primitives release the GIL.
+    '''
+    numWorkers = os.cpu_count() or 1
+    if (len(lLines) > PARALLELCRYPT) and (numWorkers > 1):
+        return _crypt_parallel(fCrypt, lRows, lLines, userKey, fileKey, numWorkers)
+    return iter(_crypt_chunk(fCrypt, lRows, lLines, userKey, fileKey))
+
+
+# Number of lines gathered before writing them out together, while saving
+SAVECHUNKLINES = 4096
+# Buffer size of the file stream used for saving
+SAVEBUFSIZE = 1024*1024
+
+
+def _row_text(me, r):
+    '''
+    Get the csv text of the given row, without the newline.
+
+    Only the populated cells of the row are walked, using the sparse index, and
+    the empty cells between them are emitted as runs of field seperators. So the
+    time taken depends on the number of populated cells and not the number of cols.
+
+    If the cell data contains the field seperator in it, then the cell content is
+    protected within quotes.
+    '''
+    lCols = me['rowCols'].get(r)
+    numCols = me['numCols']
+    if lCols == None:
+        return THEFIELDSEP*(numCols-1)
+    lParts = []
+    prevC = 1
+    for c in lCols:
+        if c > numCols:
+            break
+        data = me['data'][(r,c)]
+        if data.find(THEFIELDSEP) != -1:
+            if not data.startswith(THEQUOTE):
+                data = "{}{}".format(THEQUOTE, data)
+            if not data.endswith(THEQUOTE):
+                data = "{}{}".format(data, THEQUOTE)
+        lParts.append(THEFIELDSEP*(c-prevC))
+        lParts.append(data)
+        prevC = c
+    lParts.append(THEFIELDSEP*(numCols-prevC))
+    return "".join(lParts)
+
+
+def _file_state(me, sFile, filePass, salt):
+    '''
+    Remember the details of the csv file just loaded/saved, so that a later save into
+    the same file can reuse the lines of the rows not modified in between. Inturn the
+    rows modified from now on, are tracked in dirtyRows, by syncd.
+    '''
+    fileStat = os.stat(sFile)
+    me['fileState'] = {
+            'file': os.path.realpath(sFile),
+            'pass': sec.keycache_passid(filePass),
+            'salt': salt,
+            'numCols': me['numCols'],
+            'csvChars': (THEFIELDSEP, THEQUOTE),
+            'stat': (fileStat.st_mtime_ns, fileStat.st_size)
+            }
+    me['dirtyRows'] = set()
+
+
+def _reusable_lines(me, sFile, filePass):
+    '''
+    Get the lines of the csv file being saved into, as it was at its last load/save,
+    so that the lines of the rows not modified since then, can be reused as is.
+
+    Returns None, if the lines cant be reused, like when saving into a different file,
+    or using a different password or csv chars or number of cols, or if rows/cols were
+    inserted/deleted in between (dirtyRows is None), or if the file was modified by
+    someone else.
+    '''
+    fileState = me['fileState']
+    if (not bIncrementalSave) or (fileState == None) or (me['dirtyRows'] == None):
+        return None
+    if (fileState['file'] != os.path.realpath(sFile)) or (fileState['pass'] != sec.keycache_passid(filePass)):
+        return None
+    if (fileState['numCols'] != me['numCols']) or (fileState['csvChars'] != (THEFIELDSEP, THEQUOTE)):
+        return None
+    try:
+        fileStat = os.stat(sFile)
+    except OSError:
+        return None
+    if (fileStat.st_mtime_ns, fileStat.st_size) != fileState['stat']:
+        return None
+    f = open(sFile)
+    lLines = f.readlines()
+    f.close()
+    if filePass != None:
+        lLines = lLines[1:]
+    return lLines
+
+
+def _merged_lines(numRows, lOld, lRows, itNew):
+    '''
+    Yield the lines of all the rows, using the newly generated lines for the rows in
+    lRows, and reusing the lines in lOld for the other rows.
+    '''
+    if lOld == None:
+        for line in itNew:
+            yield "{}\n".format(line)
+        return
+    dNew = dict(zip(lRows, itNew))
+    for r in range(1, numRows+1):
+        line = dNew.get(r)
+        if line != None:
+            yield "{}\n".format(line)
+        else:
+            line = lOld[r-1]
+            if not line.endswith("\n"):
+                line = "{}\n".format(line)
+            yield line
+
+
 def _save_file(me, scr, sFile, filePass=None):
     '''
     Save file in a csv format.
@@ -49,39 +359,70 @@ def _save_file(me, scr, sFile, filePass=None):
     If successfully saved, then Clear the dirty bit.
 
     If filePass is provided then encrypt the file.
+
+    The deps sidecar file is also refreshed, keyed by the hash of the content
+    saved. For encrypted files, any deps sidecar file is removed.
+
+    If saving into the same file as the last load/save, only the rows modified
+    since then are generated (and encrypted) again, while the lines of the other
+    rows are reused as is (see _reusable_lines).
+
+    The lines are gathered into chunks of SAVECHUNKLINES lines, which are written
+    out together through a large buffered stream, into a temp file, which then
+    replaces the file atomically.
+
+    For protected files, the lines are encrypted in parallel, if there are more than
+    PARALLELCRYPT lines.
     '''
-    f = open(sFile,"w+")
+    lOld = _reusable_lines(me, sFile, filePass)
+    sTmpFile = "{}.tmp".format(sFile)
+    f = open(sTmpFile, "w+", buffering=SAVEBUFSIZE)
+    if (filePass == None) and bDepsSidecar:
+        hasher = _deps_hasher()
+    else:
+        hasher = None
+    salt = None
     if filePass != None:
-        salt = secrets.token_bytes(16)
-        userKey, fileKey = sec.get_basekeys(filePass, salt)
-        salt = base64.urlsafe_b64encode(salt).decode()
-        print("{}\n".format(salt), end="", file=f)
-    for r in range(1, me['numRows']+1):
-        curRow = ""
-        for c in range(1, me['numCols']+1):
-            data = me['data'].get((r,c))
-            if (data != None):
-                if data.find(THEFIELDSEP) != -1:
-                    if not data.startswith(THEQUOTE):
-                        data = "{}{}".format(THEQUOTE, data)
-                    if not data.endswith(THEQUOTE):
-                        data = "{}{}".format(data, THEQUOTE)
-            else:
-                data = ""
-            curRow += "{}{}".format(data,THEFIELDSEP)
-        curRow = curRow[:-1] # Remove the unwanted fieldsep at the end
-        if filePass != None:
-            lineKey = sec.get_linekey(r, userKey, fileKey)
-            if bInternalEncDec:
-                curRow = sec.aes_cbc_enc_b64(base64.urlsafe_b64decode(lineKey), curRow).decode()
-            else:
-                sym = cryptography.fernet.Fernet(lineKey)
-                curRow = sym.encrypt(curRow.encode()).decode()
-            #status(scr, ["saving line {}".format(r)],y=1)
-        print("{}\n".format(curRow), end="", file=f)
+        if lOld != None:
+            # The line keys of the reused lines depend on the salt
+            salt = me['fileState']['salt']
+        else:
+            # Reuse the salt (and inturn the cached keys) of a recent load/save of this file with the same password
+            salt = sec.keycache_salt(filePass, sFile)
+        if salt == None:
+            salt = secrets.token_bytes(16)
+        userKey, fileKey = sec.get_basekeys(filePass, salt, sFile)
+        f.write("{}\n".format(base64.urlsafe_b64encode(salt).decode()))
+    if lOld == None:
+        lRows = range(1, me['numRows']+1)
+    else:
+        lRows = sorted([ r for r in me['dirtyRows'] if r <= min(me['numRows'], len(lOld)) ])
+        lRows.extend(range(len(lOld)+1, me['numRows']+1))
+    itNew = ( _row_text(me, r) for r in lRows )
+    if filePass != None:
+        itNew = _crypt_lines(_enc_line, lRows, list(itNew), userKey, fileKey)
+    lLines = []
+    for curLine in _merged_lines(me['numRows'], lOld, lRows, itNew):
+        lLines.append(curLine)
+        if len(lLines) >= SAVECHUNKLINES:
+            if hasher != None:
+                hasher.update("".join(lLines).encode())
+            f.writelines(lLines)
+            lLines = []
+    if hasher != None:
+        hasher.update("".join(lLines).encode())
+    f.writelines(lLines)
     f.close()
+    if os.path.exists(sFile):
+        os.chmod(sTmpFile, os.stat(sFile).st_mode)
+    os.replace(sTmpFile, sFile)
+    _file_state(me, sFile, filePass, salt)
+    sHash = None
+    if hasher != None:
+        sHash = hasher.hexdigest()
+    save_deps(me, sFile, sHash)
     me['dirty'] = False
-    print("savefile:{}".format(sFile), file=GLOGFILE)
+    print("savefile:{}:rows:{}".format(sFile, len(lRows)), file=GLOGFILE)
 
 
 def save_file(me, scr, sFile, filePass=None):
@@ -101,6 +442,7 @@ def save_file(me, scr, sFile, filePass=None):
     try:
         cstatusbar(scr, ['[Saving file...]'])
         _save_file(me, scr, sFile, filePass)
+        autosave_discard(me)
     except:
         a,b,c = sys.exc_info()
         print("savefile:exception:{}:{}".format((a,b,c), sFile), file=GLOGFILE)
@@ -108,6 +450,137 @@ def save_file(me, scr, sFile, filePass=None):
         dlg(scr, ["savefile:exception:{}:{}".format(a, sFile), "Press any key to continue"])
 
 
+def _snapshot_cdata(me):
+    '''
+    Get the calc cache marshalled. Any values which cant be marshalled (like python
+    objects got using flypython) are left out, and inturn recalculated when required.
+    '''
+    try:
+        return marshal.dumps(me['cdata'])
+    except ValueError:
+        dCData = dict()
+        for key, val in me['cdata'].items():
+            try:
+                marshal.dumps(val)
+                dCData[key] = val
+            except ValueError:
+                pass
+        return marshal.dumps(dCData)
+
+
+def _save_snapshot(me, sFile):
+    '''
+    Save the spreadsheet in memory into a binary snapshot file.
+
+    Along with the cell contents, the links between the cells, calc loops, calc cache,
+    markers and cformat settings are saved, so that loading it requires no parsing.
+    The snapshot file is written atomically.
+    '''
+    dMeta = {
+            'numRows': me['numRows'], 'numCols': me['numCols'],
+            'cformat.iffloat': me['cformat.iffloat'],
+            'cformat.number2float': me['cformat.number2float']
+            }
+    lSections = [
+            (b"META", marshal.dumps(dMeta)),
+            (b"DATA", marshal.dumps(me['data'])),
+            (b"LNKS", marshal.dumps((me['fwdLinks'], me['fwdRanges']))),
+            (b"LOOP", marshal.dumps(list(set(me['loopOf'].values())))),
+            (b"MRKS", marshal.dumps(me['markers'])),
+            (b"CDAT", _snapshot_cdata(me))
+            ]
+    f = open("{}.tmp".format(sFile), "wb")
+    f.write(SNAPMAGIC)
+    f.write(struct.pack(SNAPHEADER, SNAPVERSION, marshal.version, *sys.version_info[:2]))
+    for tag, bData in lSections:
+        f.write(struct.pack("<4sQ", tag, len(bData)))
+        f.write(bData)
+    f.close()
+    os.replace("{}.tmp".format(sFile), sFile)
+    me['dirty'] = False
+    print("savesnapshot:{}".format(sFile), file=GLOGFILE)
+
+
+def save_snapshot(me, scr, sFile):
+    '''
+    save current spreadsheet in memory into specified binary snapshot file.
+
+    If the file already exists, then alert the user about same.
+    '''
+    sFile = os.path.expanduser(sFile)
+    if (os.path.exists(sFile)):
+        got = dlg(scr, ["File:{}:exists overwrite? [y/N]".format(sFile)])
+        if chr(got).upper() != "Y":
+            cstatusbar(scr, ["[Saving is aborted]"])
+            return
+    try:
+        cstatusbar(scr, ['[Saving snapshot...]'])
+        _save_snapshot(me, sFile)
+    except:
+        a,b,c = sys.exc_info()
+        print("savesnapshot:exception:{}:{}".format((a,b,c), sFile), file=GLOGFILE)
+        traceback.print_exc(file=GERRFILE)
+        dlg(scr, ["savesnapshot:exception:{}:{}".format(a, sFile), "Press any key to continue"])
+
+
+def is_snapshot(sFile):
+    '''
+    Check if the specified file is a binary snapshot file, by looking at its header.
+    '''
+    f = open(sFile, "rb")
+    bMagic = f.read(len(SNAPMAGIC))
+    f.close()
+    return bMagic == SNAPMAGIC
+
+
+def _load_snapshot(me, sFile):
+    '''
+    Load the specified binary snapshot file, along with the links between the cells,
+    calc loops and calc cache in it.
+
+    The sections are decoded in bulk using marshal. Unknown sections are ignored.
+    Snapshots saved by a different python version (or marshal version) are rejected.
+    '''
+    f = open(sFile, "rb")
+    buf = f.read()
+    f.close()
+    print("loadsnapshot:{}".format(sFile), file=GLOGFILE)
+    iPos = len(SNAPMAGIC)
+    version = struct.unpack_from("<I", buf, iPos)[0]
+    if version != SNAPVERSION:
+        raise Exception("loadSnapshot:Unsupported version:{}".format(version))
+    version, marshalVersion, pyMajor, pyMinor = struct.unpack_from(SNAPHEADER, buf, iPos)
+    if (marshalVersion != marshal.version) or ((pyMajor, pyMinor) != sys.version_info[:2]):
+        raise Exception("loadSnapshot:Saved by python {}.{} (marshal {}), cant load in python {}.{} (marshal {}), use its csv file instead".format(
+                pyMajor, pyMinor, marshalVersion, sys.version_info[0], sys.version_info[1], marshal.version))
+    iPos += struct.calcsize(SNAPHEADER)
+    mvBuf = memoryview(buf)
+    dSections = dict()
+    while iPos < len(buf):
+        tag, size = struct.unpack_from("<4sQ", buf, iPos)
+        iPos += 12
+        if iPos+size > len(buf):
+            raise Exception("loadSnapshot:Truncated section:{}".format(tag))
+        dSections[tag] = marshal.loads(mvBuf[iPos:iPos+size])
+        iPos += size
+    dMeta = dSections[b"META"]
+    me['data'] = dSections[b"DATA"]
+    me['numRows'] = dMeta['numRows']
+    me['numCols'] = dMeta['numCols']
+    me['cformat.iffloat'] = dMeta['cformat.iffloat']
+    me['cformat.number2float'] = dMeta['cformat.number2float']
+    me['markers'] = dSections.get(b"MRKS", dict())
+    dFwdLinks, dFwdRanges = dSections[b"LNKS"]
+    dLoopOf = dict()
+    for sLoop in dSections[b"LOOP"]:
+        for cell in sLoop:
+            dLoopOf[cell] = sLoop
+    syncd.restore_links(dFwdLinks, dFwdRanges, dLoopOf)
+    syncd.cdata_clear_all()
+    me['cdata'] = dSections.get(b"CDAT", dict())
+    me['fileState'] = None
+
+
 def _load_line(me, line, r):
     '''
     Handle a single line of input file being loaded, in python.
@@ -142,45 +615,98 @@ def _load_line(me, line, r):
     return c
 
 
-def load_line(me, line, r, filePass, fileKey, userKey):
+def _parse_line(me, line, r):
     '''
-    Handle a single line of input file being loaded.
+    Parse a single (decrypted) line of input file being loaded, in c if possible.
     '''
-    if filePass != None:
-        lineKey = sec.get_linekey(r, userKey, fileKey)
-        if bInternalEncDec:
-            line = sec.aes_cbc_dec_b64(base64.urlsafe_b64decode(lineKey), line.encode()).decode()
-        else:
-            sym = cryptography.fernet.Fernet(lineKey)
-            line = sym.decrypt(line.encode()).decode()
     if chelper != None:
         return chelper.load_line(me['data'], r, line, len(line))
     return _load_line(me, line, r)
 
 
+def load_line(me, line, r, filePass, fileKey, userKey):
+    '''
+    Handle a single line of input file being loaded.
+    '''
+    if filePass != None:
+        line = _dec_line(r, line, userKey, fileKey)
+    return _parse_line(me, line, r)
+
+
+def _load_buffer(me, sFile):
+    '''
+    Load the specified unencrypted csv file in one go, by passing a mmap of it
+    to chelper's load_buffer, which parses all the lines in c.
+
+    Returns the hash of the content of the csv file, to check its deps sidecar file
+    against.
+    '''
+    f = open(sFile, "rb")
+    if os.fstat(f.fileno()).st_size > 0:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    else:
+        buf = b""
+    print("loadfile:{}".format(sFile), file=GLOGFILE)
+    me['data'] = dict()
+    me['numRows'], me['numCols'] = chelper.load_buffer(me['data'], buf)
+    sHash = None
+    if bDepsSidecar:
+        hasher = _deps_hasher()
+        hasher.update(buf)
+        sHash = hasher.hexdigest()
+    if len(buf) > 0:
+        buf.close()
+    f.close()
+    _file_state(me, sFile, None, None)
+    return sHash
+
+
 def _load_file(me, sFile, filePass=None):
     '''
     Load the specified csv file
+
+    Returns the hash of the content of the csv file, to check its deps sidecar file
+    against. For encrypted files, this is None.
+
+    Unencrypted files are loaded in one go using chelper's load_buffer, if available.
+
+    For protected files, the lines are decrypted in parallel, if there are more than
+    PARALLELCRYPT lines.
     '''
+    if (filePass == None) and (chelper != None):
+        return _load_buffer(me, sFile)
     f = open(sFile)
+    salt = None
     if filePass != None:
         line = f.readline()
         salt = base64.urlsafe_b64decode(line.encode())
-        userKey, fileKey = sec.get_basekeys(filePass, salt)
+        userKey, fileKey = sec.get_basekeys(filePass, salt, sFile)
+        lLines = f.readlines()
+        itLines = _crypt_lines(_dec_line, range(1, len(lLines)+1), lLines, userKey, fileKey)
+    else:
+        itLines = f
+    if (filePass == None) and bDepsSidecar:
+        hasher = _deps_hasher()
     else:
-        userKey, fileKey = None, None
+        hasher = None
     print("loadfile:{}".format(sFile), file=GLOGFILE)
     me['data'] = dict()
     r = 0
-    for line in f:
+    for line in itLines:
         r += 1
-        c = load_line(me, line, r, filePass, fileKey, userKey)
+        if hasher != None:
+            hasher.update(line.encode())
+        c = _parse_line(me, line, r)
     f.close()
     me['numRows'] = r
     me['numCols'] = c
+    _file_state(me, sFile, filePass, salt)
+    if hasher != None:
+        return hasher.hexdigest()
+    return None
 
 
-def load_file(me, scr, sFile, filePass=None):
+def load_file(me, scr, sFile, filePass=None, bSnapshot=False):
     '''
     load the specified spreadsheet into memory.
 
@@ -190,6 +716,11 @@ def load_file(me, scr, sFile, filePass=None):
     As a user could come out of help mode by using load_file, so it reverts from help mode,
     if that is the case.
 
+    If bSnapshot, then the specified binary snapshot file (see save_snapshot) is
+    loaded along with the links and calc cache in it, else it is loaded as a csv file.
+    As snapshots are decoded using marshal, they are loaded only when explicitly
+    requested, and a snapshot file passed as a csv file is rejected, and vice versa.
+
     It clears the dirty flag.
     It clears the screen as well as repositions to A1 cell, if _load_file succeeds.
     '''
@@ -204,15 +735,23 @@ def load_file(me, scr, sFile, filePass=None):
         if chelper != None:
             chelper.config_csvchars(bytes(THEFIELDSEP, 'utf-8'), bytes(THEQUOTE, 'utf-8'))
         sFile = os.path.expanduser(sFile)
+        if is_snapshot(sFile) != bSnapshot:
+            if bSnapshot:
+                raise Exception("loadfile:not a binary snapshot file, use l")
+            raise Exception("loadfile:binary snapshot file, use ls")
         cstatusbar(scr, ['[Loading file...]'])
-        me['cdataUpdate'] = True
+        syncd.cdata_clear_all()
         scr.clear()
         t1 = time.time()
-        _load_file(me, sFile, filePass)
+        if bSnapshot:
+            _load_snapshot(me, sFile)
+        else:
+            sHash = _load_file(me, sFile, filePass)
         t2 = time.time()
         cstatusbar(scr, ['[build deps...  ]'])
         t3 = time.time()
-        syncd.create_links()
+        if not bSnapshot:
+            load_deps(me, sFile, sHash)
         t4 = time.time()
         print("DBUG:loadFile:TL[{}] TD[{}]".format(t2-t1, t4-t3), file=GERRFILE)
         cstatusbar(scr, ['[               ]'])
@@ -220,6 +759,7 @@ def load_file(me, scr, sFile, filePass=None):
         revertfrom_help_ifneeded(me)
         nav.goto_cell(scr, "A1")
         print("\033]2; {} [{}] \007".format("SpreadsheetKVC", sFile), file=sys.stdout)
+        autosave_check(scr, sFile)
         return True
     except:
         a,b,c = sys.exc_info()
@@ -278,8 +818,211 @@ def new_file(me, scr):
     nav.goto_cell(scr, "A1")
     me['data'] = dict()
     syncd.create_links()
+    syncd.cdata_clear_all()
+    me['fileState'] = None
     me['dirty'] = False
-    me['cdataUpdate'] = True
+
+
+def autosave_file(me):
+    '''
+    Get the recovery file used by autosave, which is the csv file last loaded/saved
+    with AUTOSAVESUFFIX added to it. If there is no such file, a file in the temp dir
+    named using the pid of the program is used (see autosave_leftovers).
+    '''
+    if me['fileState'] != None:
+        sBase = me['fileState']['file']
+    else:
+        sBase = os.path.join(tempfile.gettempdir(), "{}{}.csv".format(AUTOSAVEUNNAMED, os.getpid()))
+    return "{}{}".format(sBase, AUTOSAVESUFFIX)
+
+
+def _pid_alive(pid):
+    '''
+    Check if a process with the given pid is running.
+    '''
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def autosave_leftovers():
+    '''
+    Get the recovery files of unnamed spreadsheets, left behind in the temp dir by
+    earlier runs of the program (by the current user), which didnt exit normally.
+    These are identified by the pid in their name, no longer running.
+    '''
+    sDir = tempfile.gettempdir()
+    sSuffix = ".csv{}".format(AUTOSAVESUFFIX)
+    lFiles = []
+    for sName in os.listdir(sDir):
+        if not (sName.startswith(AUTOSAVEUNNAMED) and sName.endswith(sSuffix)):
+            continue
+        sPid = sName[len(AUTOSAVEUNNAMED):-len(sSuffix)]
+        if not sPid.isdigit():
+            continue
+        sFile = os.path.join(sDir, sName)
+        if hasattr(os, 'getuid') and (os.stat(sFile).st_uid != os.getuid()):
+            continue
+        if (int(sPid) == os.getpid()) or _pid_alive(int(sPid)):
+            continue
+        lFiles.append(sFile)
+    return sorted(lFiles)
+
+
+def autosave_startcheck(scr):
+    '''
+    Alert the user, if recovery files of unnamed spreadsheets were left behind by
+    earlier runs of the program, which didnt exit normally.
+    '''
+    lFiles = autosave_leftovers()
+    if len(lFiles) == 0:
+        return
+    lMsgs = [ "autosave: Found recovery files of unnamed spreadsheets" ]
+    lMsgs.extend(lFiles[:8])
+    if len(lFiles) > 8:
+        lMsgs.append("... and {} more".format(len(lFiles)-8))
+    lMsgs.append("use :l to load, and delete them once done. Press any key...")
+    dlg(scr, lMsgs)
+
+
+def autosave_pollms():
+    '''
+    Get the time in msecs, the main loop should wait for a key, before checking on
+    autosave, or -1 to wait for ever, if autosave is disabled.
+    '''
+    if AUTOSAVEINTERVAL > 0:
+        return AUTOSAVEPOLLMS
+    return -1
+
+
+def _autosave_child(me, sFile):
+    '''
+    Save the spreadsheet into the recovery file, from the forked child process.
+
+    The child process has its own copy-on-write snapshot of the spreadsheet as it was
+    when forked, so it can be saved as is. The deps sidecar file isnt saved.
+    '''
+    global bDepsSidecar
+    exitCode = 1
+    try:
+        bDepsSidecar = False
+        _save_file(me, None, sFile)
+        exitCode = 0
+    except:
+        pass
+    os._exit(exitCode)
+
+
+def autosave_discard(me):
+    '''
+    Remove the recovery file, like after the spreadsheet is saved by the user.
+
+    If a autosave is in progress, the recovery file is removed when it completes,
+    as the spreadsheet is no longer dirty.
+    '''
+    if (gAutoSave['pid'] == None) and (gAutoSave['file'] != None):
+        if os.path.exists(gAutoSave['file']):
+            os.remove(gAutoSave['file'])
+        gAutoSave['file'] = None
+
+
+def _autosave_done(me, scr):
+    '''
+    Check whether the autosave in progress, if any, has completed.
+
+    Returns True if no autosave is in progress (anymore).
+    '''
+    if gAutoSave['pid'] == None:
+        return True
+    pid, waitStatus = os.waitpid(gAutoSave['pid'], os.WNOHANG)
+    if pid == 0:
+        return False
+    gAutoSave['pid'] = None
+    if os.WIFEXITED(waitStatus) and (os.WEXITSTATUS(waitStatus) == 0):
+        cstatusbar(scr, ['[autosaved]          '])
+    else:
+        # Retry at the next interval, even if there are no new edits
+        gAutoSave['editCount'] = None
+        cstatusbar(scr, ['[autosave failed]    '])
+        print("WARN:fileio:autosave:{}:failed:{}".format(gAutoSave['file'], waitStatus), file=GERRFILE)
+    if not me['dirty']:
+        autosave_discard(me)
+    return True
+
+
+def autosave_tick(me, scr):
+    '''
+    Called periodically from the main loop, to check on the autosave in progress if
+    any, and inturn start a new one, if required.
+
+    A autosave is started if there are unsaved changes, which havent been autosaved
+    yet, and AUTOSAVEINTERVAL seconds have passed since the last autosave. Changes
+    made while a autosave is in progress, get saved by the next autosave.
+
+    Protected (encrypted) spreadsheets arent autosaved, as the recovery file is not
+    encrypted, and the user is told about it on the status bar, whenever a autosave
+    would have been started otherwise. Nor is autosave supported, where os.fork
+    isnt available.
+
+    Nor is a autosave started while in edit mode, as the cell being edited is
+    cleared in me['data'], till the edit buffer is stored back into it.
+
+    Returns whether autosave is enabled.
+    '''
+    if not _autosave_done(me, scr):
+        return True
+    if AUTOSAVEINTERVAL <= 0:
+        return False
+    if (not me['dirty']) or me['readOnly'] or (gAutoSave['editCount'] == me['editCount']):
+        return True
+    if me['state'] == 'E':
+        return True
+    if (time.time() - gAutoSave['time']) < AUTOSAVEINTERVAL:
+        return True
+    if not hasattr(os, 'fork'):
+        return True
+    if (me['fileState'] != None) and (me['fileState']['pass'] != None):
+        gAutoSave['time'] = time.time()
+        gAutoSave['editCount'] = me['editCount']
+        cstatusbar(scr, ['[autosave off:protected file]'])
+        return True
+    sFile = autosave_file(me)
+    if sFile != gAutoSave['file']:
+        autosave_discard(me)
+    gAutoSave['file'] = sFile
+    gAutoSave['time'] = time.time()
+    gAutoSave['editCount'] = me['editCount']
+    cstatusbar(scr, ['[autosave...]        '])
+    pid = os.fork()
+    if pid == 0:
+        _autosave_child(me, sFile)
+    gAutoSave['pid'] = pid
+    return True
+
+
+def autosave_cleanup(me):
+    '''
+    Wait for the autosave in progress if any, and remove the recovery file, when
+    exiting the program normally.
+    '''
+    if gAutoSave['pid'] != None:
+        os.waitpid(gAutoSave['pid'], 0)
+        gAutoSave['pid'] = None
+    autosave_discard(me)
+
+
+def autosave_check(scr, sFile):
+    '''
+    Alert the user, if a recovery file newer than the file just loaded exists, like
+    when the program didnt exit normally, after a autosave.
+    '''
+    sAutoFile = "{}{}".format(os.path.realpath(sFile), AUTOSAVESUFFIX)
+    if os.path.exists(sAutoFile) and (os.path.getmtime(sAutoFile) > os.path.getmtime(sFile)):
+        dlg(scr, ["autosave: Found recovery file {}".format(sAutoFile), "use :l to load it, if required. Press any key..."])
 
 
 def verify_pass(scr, thePass):
@@ -373,4 +1116,52 @@ def path_completion(fpc, sCur):
 
 
 
+def test_autosave():
+    '''
+    Check that a autosave tick while in edit mode, doesnt save the cell being edited
+    as empty into the recovery file, and that the next tick after leaving edit mode
+    saves it. AssertionError is raised, if the recovery file content isnt as expected.
+    '''
+    global AUTOSAVEINTERVAL, cstatusbar, bDepsSidecar, THEFIELDSEP, THEQUOTE
+    savedGlobals = (AUTOSAVEINTERVAL, cstatusbar, bDepsSidecar, THEFIELDSEP, THEQUOTE, syncd.me, dict(gAutoSave))
+    me = { 'data': { (1,1): "10", (1,2): "=A1*2" }, 'numRows': 1, 'numCols': 2, 'cdata': dict(),
+            'dirty': True, 'readOnly': False, 'state': 'C', 'editCount': 0, 'dirtyRows': None,
+            'fileState': None, 'curRow': 1, 'curCol': 1 }
+    def tick_wait():
+        autosave_tick(me, None)
+        while not autosave_tick(me, None) or (gAutoSave['pid'] != None):
+            time.sleep(0.01)
+    try:
+        AUTOSAVEINTERVAL, cstatusbar, bDepsSidecar = 1, lambda scr, msg: None, False
+        THEFIELDSEP, THEQUOTE = ';', "'"
+        syncd.me = me
+        syncd.init()
+        syncd.sparse_build()
+        syncd.create_links()
+        gAutoSave.update({ 'pid': None, 'file': None, 'editCount': None, 'time': 0 })
+        sFile = autosave_file(me)
+        # Enter edit mode on A1, like the 'e' key does
+        me['state'] = 'E'
+        me['backupEdit'] = me['data'][(1,1)]
+        me['data'][(1,1)] = ""
+        me['editCount'] += 1
+        tick_wait()
+        assert not os.path.exists(sFile), "test_autosave: autosaved in edit mode"
+        # Leave edit mode, storing the edit buffer back
+        me['data'][(1,1)] = "11"
+        syncd.cell_updated((1,1), "11")
+        me['state'] = 'C'
+        gAutoSave['time'] = 0
+        tick_wait()
+        f = open(sFile)
+        sContent = f.read()
+        f.close()
+        assert sContent == "11;=A1*2\n", "test_autosave: recovery file:{}".format(sContent)
+        print("test_autosave:ok")
+    finally:
+        autosave_cleanup(me)
+        AUTOSAVEINTERVAL, cstatusbar, bDepsSidecar, THEFIELDSEP, THEQUOTE, syncd.me, dAutoSave = savedGlobals
+        gAutoSave.update(dAutoSave)
+
+
 # vim: set sts=4 expandtab: #
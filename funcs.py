@@ -5,10 +5,13 @@
 
 import sys
 import traceback
+import importlib
 import math
+import collections
 from math import *
 import parsekvc as parse
 import cellval
+import syncd
 
 
 BFILTERPYFUNC = True
@@ -19,6 +22,86 @@ _do_cformat = None
 _do_calign = None
 
 
+np = None
+def load_numpy():
+    '''
+    Load numpy, if available, so that range functions can be vectorised.
+    '''
+    global np
+    try:
+        np = importlib.import_module("numpy")
+        print("INFO:funcs:Loaded numpy, for use by range functions", file=GERRFILE)
+    except:
+        print("WARN:funcs:Couldnt load numpy, so range functions will use python logic", file=GERRFILE)
+
+
+def _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty=True):
+    '''
+    Get the values of the cells in the given range, walking over it only once.
+
+    Values already in the calc cache are used directly, others are got through
+    nvalue_key, which will inturn cache them where possible.
+
+    If empty cells are to be ignored, only the populated cells are walked, using
+    the sparse index maintained by syncd.
+    '''
+    if bIgnoreEmpty:
+        lKeys = syncd.cells_in_range(sR, sC, eR, eC)
+    else:
+        lKeys = [ (r,c) for r in range(sR, eR+1) for c in range(sC, eC+1) ]
+    lValues = list(map(me['cdata'].get, lKeys))
+    if None not in lValues:
+        return lValues
+    for i in range(len(lKeys)):
+        if lValues[i] == None:
+            lValues[i] = cellval.nvalue_key(lKeys[i])
+    return lValues
+
+
+NUMPYMIN = 64
+def _values_array(lValues):
+    '''
+    Return a numpy array of the given values, if numpy is available and the values
+    are all numeric and there are enough of them to make it worth while.
+
+    Floats are got as a float64 array. Ints are got as a int64 array, if even their
+    sum cant overflow it, so that sums remain exact ints. Ints mixed with floats are
+    got as a float64 array, if they can be represented exactly as floats.
+
+    Else return None, so that the caller uses the python logic, like for bigints
+    or non numeric values. Results got from the array should be converted using
+    item(), or be got from the values using the array's indexes, so that they are
+    python ints or floats, as the python logic would give.
+    '''
+    if (np == None) or (len(lValues) < NUMPYMIN):
+        return None
+    sTypes = set(map(type, lValues))
+    if sTypes == { float }:
+        return np.array(lValues, dtype=np.float64)
+    if not (sTypes <= { int, float }):
+        return None
+    if sTypes == { int }:
+        iBound = max(max(lValues), -min(lValues))
+        if iBound*len(lValues) < 2**63:
+            return np.array(lValues, dtype=np.int64)
+        return None
+    lInts = [ val for val in lValues if type(val) == int ]
+    if max(max(lInts), -min(lInts)) <= 2**53:
+        return np.array(lValues, dtype=np.float64)
+    return None
+
+
+def _rangememo_set(rect, key, val, volatileEvals):
+    '''
+    Memo the result of a function over the given range, with syncd, unless some
+    volatile function was evaluated (ie cellval.VOLATILEEVALS changed from the
+    given volatileEvals) while gathering the values of the range.
+    '''
+    if volatileEvals == cellval.VOLATILEEVALS:
+        syncd.rangememo_set(rect, key, val)
+    return val
+
+
 def _cellrange_to_list(lRange, bIgnoreEmpty=True):
     bCellAddr, (sR,sC) = parse.celladdr_valid(lRange[0])
     if not bCellAddr:
@@ -26,13 +109,7 @@ def _cellrange_to_list(lRange, bIgnoreEmpty=True):
     bCellAddr, (eR,eC) = parse.celladdr_valid(lRange[2])
     if not bCellAddr:
         return False, []
-    lOut = []
-    for r in range(sR, eR+1):
-        for c in range(sC, eC+1):
-            if ((me['data'].get((r,c)) == None) and bIgnoreEmpty):
-                continue
-            lOut.append(cellval.nvalue_key((r,c)))
-    return True, lOut
+    return True, _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty)
 
 
 def cellrange_to_list(sIn):
@@ -68,15 +145,20 @@ def _do_minmax(args, bIgnoreEmpty=True):
     bCellAddr, (eR,eC) = parse.celladdr_valid(end)
     if not bCellAddr:
         return None, None, None
-    lItems = []
-    for r in range(sR, eR+1):
-        for c in range(sC, eC+1):
-            if ((me['data'].get((r,c)) == None) and bIgnoreEmpty):
-                continue
-            lItems.append(cellval.nvalue_key((r,c)))
-    tMin = min(lItems)
-    tMax = max(lItems)
-    return tMin, tMax, len(lItems)
+    rect = (sR, sC, eR, eC)
+    memo = syncd.rangememo_get(rect, ('MINMAX', bIgnoreEmpty))
+    if memo != None:
+        return memo
+    volatileEvals = cellval.VOLATILEEVALS
+    lItems = _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty)
+    aItems = _values_array(lItems)
+    if aItems is not None:
+        tMin = lItems[aItems.argmin()]
+        tMax = lItems[aItems.argmax()]
+    else:
+        tMin = min(lItems)
+        tMax = max(lItems)
+    return _rangememo_set(rect, ('MINMAX', bIgnoreEmpty), (tMin, tMax, len(lItems)), volatileEvals)
 
 
 def do_min(args):
@@ -94,6 +176,9 @@ def _do_sum(args, bIgnoreEmpty=True):
     sum up contents of a matrix of cells.
     It also returns the number of cells involved.
     bIgnoreEmpty can be used to control whether empty cells are considered or not.
+
+    If the range doesnt contain =expressions (or text, in FlyPython mode), the
+    sum and count are got from the colSums index maintained by syncd.
     '''
     start,end = args.split(':')
     bCellAddr, (sR,sC) = parse.celladdr_valid(start)
@@ -102,15 +187,22 @@ def _do_sum(args, bIgnoreEmpty=True):
     bCellAddr, (eR,eC) = parse.celladdr_valid(end)
     if not bCellAddr:
         return None, None
-    total = 0
-    cnt = 0
-    for r in range(sR, eR+1):
-        for c in range(sC, eC+1):
-            if ((me['data'].get((r,c)) == None) and bIgnoreEmpty):
-                continue
-            total += cellval.nvalue_key((r,c))
-            cnt += 1
-    return total, cnt
+    if bIgnoreEmpty:
+        sums = syncd.range_sums(sR, sC, eR, eC)
+        if sums != None:
+            return sums
+    rect = (sR, sC, eR, eC)
+    memo = syncd.rangememo_get(rect, ('SUM', bIgnoreEmpty))
+    if memo != None:
+        return memo
+    volatileEvals = cellval.VOLATILEEVALS
+    lItems = _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty)
+    aItems = _values_array(lItems)
+    if aItems is not None:
+        total = aItems.sum().item()
+    else:
+        total = sum(lItems)
+    return _rangememo_set(rect, ('SUM', bIgnoreEmpty), (total, len(lItems)), volatileEvals)
 
 
 def do_sum(args):
@@ -135,15 +227,20 @@ def _do_stddev(args, bIgnoreEmpty=True):
     bCellAddr, (eR,eC) = parse.celladdr_valid(end)
     if not bCellAddr:
         return None, None
-    avg = do_avg(args)
-    total = 0
-    cnt = 0
-    for r in range(sR, eR+1):
-        for c in range(sC, eC+1):
-            if ((me['data'].get((r,c)) == None) and bIgnoreEmpty):
-                continue
-            total += (cellval.nvalue_key((r,c)) - avg)**2
-            cnt += 1
+    rect = (sR, sC, eR, eC)
+    memo = syncd.rangememo_get(rect, ('STDDEV', bIgnoreEmpty))
+    if memo != None:
+        return memo
+    volatileEvals = cellval.VOLATILEEVALS
+    lItems = _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty)
+    aItems = _values_array(lItems)
+    cnt = len(lItems)
+    if aItems is not None:
+        avg = aItems.sum().item()/cnt
+        total = float(((aItems - avg)**2).sum())
+    else:
+        avg = sum(lItems)/cnt
+        total = sum([ (item - avg)**2 for item in lItems ])
     varp = total/cnt
     stdevp = sqrt(varp)
     try:
@@ -152,7 +249,7 @@ def _do_stddev(args, bIgnoreEmpty=True):
     except:
         var = None
         stdev = None
-    return varp, stdevp, var, stdev, cnt
+    return _rangememo_set(rect, ('STDDEV', bIgnoreEmpty), (varp, stdevp, var, stdev, cnt), volatileEvals)
 
 
 def do_stddev(sCmd, args):
@@ -185,15 +282,19 @@ def _do_prod(args, bIgnoreEmpty=True):
     bCellAddr, (eR,eC) = parse.celladdr_valid(end)
     if not bCellAddr:
         return None, None
-    prod = 1
-    cnt = 0
-    for r in range(sR, eR+1):
-        for c in range(sC, eC+1):
-            if ((me['data'].get((r,c)) == None) and bIgnoreEmpty):
-                continue
-            prod *= cellval.nvalue_key((r,c))
-            cnt += 1
-    return prod, cnt
+    rect = (sR, sC, eR, eC)
+    memo = syncd.rangememo_get(rect, ('PROD', bIgnoreEmpty))
+    if memo != None:
+        return memo
+    volatileEvals = cellval.VOLATILEEVALS
+    lItems = _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty)
+    aItems = _values_array(lItems)
+    # int64 products can overflow, so ints are multiplied in python
+    if (aItems is not None) and (aItems.dtype == np.float64):
+        prod = aItems.prod().item()
+    else:
+        prod = math.prod(lItems)
+    return _rangememo_set(rect, ('PROD', bIgnoreEmpty), (prod, len(lItems)), volatileEvals)
 
 
 def do_prod(args):
@@ -225,12 +326,163 @@ def do_avg(args):
     return total/cnt
 
 
-def do_mode(args):
-    pass
+def _median_of_medians(lItems):
+    '''
+    Get a pivot for _select, which is the median of the medians of groups of 5 of
+    the given values. Atleast 30% of the values are on either side of it.
+    '''
+    lMedians = []
+    for i in range(0, len(lItems), 5):
+        lGroup = sorted(lItems[i:i+5])
+        lMedians.append(lGroup[(len(lGroup)-1)//2])
+    if len(lMedians) <= 5:
+        return sorted(lMedians)[(len(lMedians)-1)//2]
+    return _select(lMedians, (len(lMedians)-1)//2)[0]
+
+
+def _select(lItems, k):
+    '''
+    Find the k-th smallest (0 based) of the given values, using quickselect, so
+    that the values dont have to be sorted. It also returns the value which
+    follows it in sorted order, or None if there is none.
+
+    The values are partitioned around a pivot, picked as the median of the first,
+    middle and last values, into those less than, equal to and greater than it,
+    and inturn only the partition which contains the k-th value is looked into
+    further. As the partitions keep the order of the values, the value returned
+    for equal values (like 1 and 1.0) is the same as that of a stable sort.
+
+    If the partitions are lopsided (more than 3/4 of the values remain) too many
+    times, like for adversarial orderings of the values, the pivot is picked
+    using median of medians from then on, so that it takes linear time always.
+    '''
+    lCur = lItems
+    nextVal = None
+    badLeft = 2*len(lItems).bit_length()
+    while True:
+        if badLeft > 0:
+            pivot = sorted([ lCur[0], lCur[len(lCur)//2], lCur[-1] ])[1]
+        else:
+            pivot = _median_of_medians(lCur)
+        curLen = len(lCur)
+        lLess = [ item for item in lCur if item < pivot ]
+        if k < len(lLess):
+            nextVal = next(item for item in lCur if item == pivot)
+            lCur = lLess
+        else:
+            lEqual = [ item for item in lCur if item == pivot ]
+            nLessEqual = len(lLess) + len(lEqual)
+            if k < nLessEqual:
+                if (k+1) < nLessEqual:
+                    return lEqual[k-len(lLess)], lEqual[k+1-len(lLess)]
+                lMore = [ item for item in lCur if item > pivot ]
+                if len(lMore) > 0:
+                    return lEqual[k-len(lLess)], min(lMore)
+                return lEqual[k-len(lLess)], nextVal
+            k -= nLessEqual
+            lCur = [ item for item in lCur if item > pivot ]
+        if 4*len(lCur) > 3*curLen:
+            badLeft -= 1
+
+
+def _do_percentile(sRange, fPercent, bIgnoreEmpty=True):
+    '''
+    Find the given percentile (0.0 to 1.0) of the values in a matrix of cells,
+    interpolating between the values on either side of it, where required.
+    It also returns the number of cells involved.
+    '''
+    start,end = sRange.split(':')
+    bCellAddr, (sR,sC) = parse.celladdr_valid(start)
+    if not bCellAddr:
+        return None, None
+    bCellAddr, (eR,eC) = parse.celladdr_valid(end)
+    if not bCellAddr:
+        return None, None
+    if (fPercent < 0) or (fPercent > 1):
+        return None, None
+    rect = (sR, sC, eR, eC)
+    memo = syncd.rangememo_get(rect, ('PERCENTILE', fPercent, bIgnoreEmpty))
+    if memo != None:
+        return memo
+    volatileEvals = cellval.VOLATILEEVALS
+    lItems = _cellrange_values(sR, sC, eR, eC, bIgnoreEmpty)
+    cnt = len(lItems)
+    if cnt == 0:
+        return None, cnt
+    fRank = (cnt-1)*fPercent
+    k = int(fRank)
+    fFrac = fRank - k
+    aItems = _values_array(lItems)
+    if aItems is not None:
+        lKs = [ k ] if (k+1) >= cnt else [ k, k+1 ]
+        aIndex = np.argpartition(aItems, lKs)
+        val = lItems[aIndex[k]]
+        nextVal = lItems[aIndex[k+1]] if (k+1) < cnt else None
+    else:
+        val, nextVal = _select(lItems, k)
+    if (fFrac != 0) and (nextVal != None):
+        val = val + fFrac*(nextVal - val)
+    return _rangememo_set(rect, ('PERCENTILE', fPercent, bIgnoreEmpty), (val, cnt), volatileEvals)
+
+
+def do_percentile(args):
+    '''
+    Return the value at the specified percentile (0.0 to 1.0) of the specified
+    range of cells. It could be 1D vector or 2D vector of cells.
+    '''
+    argsList = parse.get_funcargs(args)
+    fPercent = cellval.nvalue_expr(argsList[1])
+    val, cnt = _do_percentile(argsList[0], fPercent)
+    return val
+
+
+def do_quartile(args):
+    '''
+    Return the specified quartile (0 to 4) of the specified range of cells.
+    It could be 1D vector or 2D vector of cells.
+    '''
+    argsList = parse.get_funcargs(args)
+    iQuart = cellval.nvalue_expr(argsList[1])
+    if iQuart not in (0, 1, 2, 3, 4):
+        return None
+    val, cnt = _do_percentile(argsList[0], iQuart/4)
+    return val
 
 
 def do_median(args):
-    pass
+    '''
+    Return the median of the specified range of cells.
+    It could be 1D vector or 2D vector of cells.
+    '''
+    val, cnt = _do_percentile(args, 0.5)
+    return val
+
+
+def do_mode(args):
+    '''
+    Return the most frequently occuring value in the specified range of cells.
+    If more than one value occurs the most number of times, the one which
+    occurs first in the range is returned.
+
+    The values are counted in a single pass, using a hash map.
+    '''
+    start,end = args.split(':')
+    bCellAddr, (sR,sC) = parse.celladdr_valid(start)
+    if not bCellAddr:
+        return None
+    bCellAddr, (eR,eC) = parse.celladdr_valid(end)
+    if not bCellAddr:
+        return None
+    rect = (sR, sC, eR, eC)
+    memo = syncd.rangememo_get(rect, 'MODE')
+    if memo != None:
+        return memo
+    volatileEvals = cellval.VOLATILEEVALS
+    lItems = _cellrange_values(sR, sC, eR, eC)
+    if len(lItems) == 0:
+        return None
+    dCnts = collections.Counter(lItems)
+    return _rangememo_set(rect, 'MODE', max(dCnts, key=dCnts.get), volatileEvals)
 
 
 def do_config(args):
@@ -247,6 +499,7 @@ def do_config(args):
 
 
 pyFuncs = [ 'min', 'round', 'pow', 'int', 'float', 'ord', 'chr', 'sin', 'cos', 'tan' ]
+gsAllowedPyFuncs = set(dir(math)).union(pyFuncs)
 def allowed_pyfunc(sCmd, sArgs):
     '''
     Check if the specified python function should be allowed or not.
@@ -255,14 +508,22 @@ def allowed_pyfunc(sCmd, sArgs):
     '''
     if not BFILTERPYFUNC:
         return True
-    if sCmd in dir(math):
-        return True
-    if sCmd in pyFuncs:
-        return True
-    return False
+    return sCmd in gsAllowedPyFuncs
 
 
 ERRPFN = "#ErrPFn#"
+gdPyFuncs = dict()
+def get_pyfunc(sCmd):
+    '''
+    Get the python callable corresponding to the given function name.
+    '''
+    pyFunc = gdPyFuncs.get(sCmd)
+    if pyFunc == None:
+        pyFunc = eval(sCmd)
+        gdPyFuncs[sCmd] = pyFunc
+    return pyFunc
+
+
 def do_pyfunc(sCmd, sArgs):
     '''
     Try evaluating the command and the arguments as a python function
@@ -272,69 +533,99 @@ def do_pyfunc(sCmd, sArgs):
 
     It also allows any argument which is a function call to be handled properly.
 
-    NOTE: If a cellAddressRange is specified, it wont be handled properly.
-    However maybe in future, I may expand a cell address range into a list
-    or so, time permitting.
+    A argument which is a pure cellAddressRange (optionally within brackets) is
+    expanded into a list of the values of its populated cells.
+
+    The arguments are passed to the python function as is, so the values dont
+    have to go through a round trip into text and back.
     '''
     if not allowed_pyfunc(sCmd, sArgs):
         return ERRPFN
-    #print("do_pyfunc:{}:{}".format(sCmd, sArgs), file=GERRFILE)
+    #print("do_pyfunc:{}".format(sCmd, sArgs), file=GERRFILE)
     argsList = parse.get_funcargs(sArgs)
-    theArgs = ""
+    lArgs = []
     for curArg in argsList:
         # Handle a pure CellRange Group
         bList, theList = cellrange_to_list(curArg)
         if bList:
-            sValOrArg = theList
+            lArgs.append(theList)
         else:
             # Evaluate the argument
-            sValOrArg = cellval.nvalue_expr(curArg)
-        theArgs += ",{}".format(sValOrArg)
-    if theArgs.startswith(','):
-        theArgs = theArgs[1:]
-    sPyFunc = "{}({})".format(sCmd, theArgs)
-    #print("do_pyfunc:{}".format(sPyFunc), file=GERRFILE)
-    return eval(sPyFunc)
+            lArgs.append(cellval.nvalue_expr(curArg))
+    return get_pyfunc(sCmd)(*lArgs)
+
+
+gdFuncs = dict()
+def register_func(sName, func, bPure=True, bRanges=False, bVectorizable=False):
+    '''
+    Register a function, so that it can be used in =expressions by the given name.
+    Names are case insensitive.
+
+    func will be called with the arguments text of the function call, as is.
+
+    bPure tells whether the result depends only on the arguments. If not ie if it
+    is volatile, then cells using it are recalculated everytime, rather than their
+    results being cached.
+
+    bRanges tells whether the function works on cell ranges.
+
+    bVectorizable tells whether the function's result over a range can be got by
+    operating on the range's values as a whole.
+    '''
+    gdFuncs[sName.upper()] = { 'func': func, 'pure': bPure, 'ranges': bRanges, 'vectorizable': bVectorizable }
+
+
+def is_volatile(sCmd):
+    '''
+    Check if the specified function is a registered volatile function.
+    '''
+    dFunc = gdFuncs.get(sCmd.upper())
+    if dFunc == None:
+        return False
+    return not dFunc['pure']
+
+
+def register_builtins():
+    '''
+    Register the internally supported functions.
+    '''
+    register_func("SUM", do_sum, bRanges=True, bVectorizable=True)
+    register_func("AVG", do_avg, bRanges=True, bVectorizable=True)
+    register_func("AVERAGE", do_avg, bRanges=True, bVectorizable=True)
+    register_func("CNT", do_cnt, bRanges=True, bVectorizable=True)
+    register_func("COUNT", do_cnt, bRanges=True, bVectorizable=True)
+    register_func("MAX", do_max, bRanges=True, bVectorizable=True)
+    register_func("PROD", do_prod, bRanges=True, bVectorizable=True)
+    for sCmd in [ "STDDEV", "STDEV", "STDDEVP", "STDEVP", "VAR", "VARP" ]:
+        register_func(sCmd, lambda args, sCmd=sCmd: do_stddev(sCmd, args), bRanges=True, bVectorizable=True)
+    register_func("MEDIAN", do_median, bRanges=True, bVectorizable=True)
+    register_func("PERCENTILE", do_percentile, bRanges=True, bVectorizable=True)
+    register_func("QUARTILE", do_quartile, bRanges=True, bVectorizable=True)
+    register_func("MODE", do_mode, bRanges=True)
+    register_func("CONFIG", do_config, bPure=False)
 
 
 def do_func(sCmdIn, sArgs):
     '''
-    Demux the internally supported functions.
+    Demux the registered functions.
     Next try and solve it has a python function.
     Unknown and invalid/exception rising function will return None.
     '''
-    sCmd = sCmdIn.upper()
     try:
         print("do_func:{}:{}".format(sCmdIn, sArgs), file=GLOGFILE)
-        if sCmd == "SUM":
-            return do_sum(sArgs)
-        elif (sCmd == "AVG") or (sCmd == "AVERAGE"):
-            return do_avg(sArgs)
-        elif (sCmd == "CNT") or (sCmd == "COUNT"):
-            return do_cnt(sArgs)
-        #elif sCmd == "MIN":
-        #    return do_min(sArgs)
-        elif sCmd == "MAX":
-            return do_max(sArgs)
-        elif sCmd == "PROD":
-            return do_prod(sArgs)
-        elif (sCmd.startswith("STDDEV") or sCmd.startswith("STDEV")):
-            return do_stddev(sCmd, sArgs)
-        elif sCmd.startswith("VAR"):
-            return do_stddev(sCmd, sArgs)
-        elif sCmd == "CONFIG":
-            return do_config(sArgs)
-        else:
-            return do_pyfunc(sCmdIn, sArgs)
-    except RecursionError:
-        ##DBUG##print("do_func:recursionErr:{}:{}".format(sCmdIn, sArgs), file=GERRFILE)
-        raise
+        dFunc = gdFuncs.get(sCmdIn.upper())
+        if dFunc != None:
+            return dFunc['func'](sArgs)
+        return do_pyfunc(sCmdIn, sArgs)
     except:
         print("do_func:exception:{}:{}:{}".format(sys.exc_info()[1], sCmdIn, sArgs), file=GERRFILE)
         #traceback.print_exc(file=GERRFILE)
     return None
 
 
+register_builtins()
+
+
 
 
 # vim: set sts=4 expandtab: #
@@ -15,9 +15,22 @@ from cryptography.hazmat.primitives.padding import PKCS7
 from cryptography.hazmat.primitives.kdf import pbkdf2
 import os
 import base64
+import time
 
 
 bInternalPadder=True
+
+# Cache of the user and file keys derived from a given file password and salt, so
+# that repeated load/save of a protected file in a session, doesnt redo the costly
+# key derivations. Entries older than KEYCACHETIMEOUT seconds are not used and are
+# wiped (see keycache_expire). The cache is indexed by a digest of the file password
+# and the salt.
+# gdKeyCacheFiles maps the real path of each file loaded/saved using the key cache,
+# to the key cache index of the password and salt used with it.
+bKeyCache = True
+KEYCACHETIMEOUT = 15*60
+gdKeyCache = dict()
+gdKeyCacheFiles = dict()
 def aes_cbc_enc(aesKey, sPlainMsg):
     '''
     AuthenticatedEncryption - Do a encrypt then mac operation on given message.
@@ -143,7 +156,7 @@ def get_linekey(lineNum, userKey, fileKey):
     return key
 
 
-def get_basekeys(filePass, salt):
+def _get_basekeys(filePass, salt):
     '''
     Generate user and file keys from the respective passwords
     and a hopefully random salt.
@@ -178,6 +191,83 @@ def get_basekeys(filePass, salt):
     return userKey, fileKey
 
 
+def keycache_passid(filePass):
+    '''
+    Get the digest of the file password, if any, used to index the key cache.
+    This also allows others to check if a file password has changed, without
+    keeping the password itself around.
+    '''
+    if filePass == None:
+        return None
+    hasher = Hash(algorithm = SHA256(), backend = default_backend())
+    hasher.update(bytes(filePass,"utf-8"))
+    return hasher.finalize()
+
+
+def keycache_expire():
+    '''
+    Wipe the entries in the key cache, which are older than KEYCACHETIMEOUT.
+
+    Its called from the main loop, on each key and each autosave tick, as well as
+    before the key cache is used. If autosave is disabled, the main loop waits for
+    ever for a key, so expiry is lazy then, ie stale keys are wiped, only when the
+    user next presses a key or a protected file is loaded/saved.
+    '''
+    tExpire = time.time() - KEYCACHETIMEOUT
+    for key in [ key for key, val in gdKeyCache.items() if val[0] < tExpire ]:
+        del(gdKeyCache[key])
+    for sFile in [ sFile for sFile, key in gdKeyCacheFiles.items() if key not in gdKeyCache ]:
+        del(gdKeyCacheFiles[sFile])
+
+
+def keycache_clear():
+    '''
+    Wipe the key cache, like when exiting.
+    '''
+    gdKeyCache.clear()
+    gdKeyCacheFiles.clear()
+
+
+def keycache_salt(filePass, sFile):
+    '''
+    Get the salt used with the given file password, when the given file was last
+    loaded/saved, if its key cache entry is still valid.
+
+    This allows repeated saves of a protected file, to reuse the salt and inturn the
+    cached keys. The salt is never shared across different files, so any other file
+    gets a fresh random salt and inturn its own keys.
+    '''
+    if not bKeyCache:
+        return None
+    keycache_expire()
+    key = gdKeyCacheFiles.get(os.path.realpath(sFile))
+    if (key == None) or (key[0] != keycache_passid(filePass)):
+        return None
+    return key[1]
+
+
+def get_basekeys(filePass, salt, sFile=None):
+    '''
+    Get the user and file keys wrt the given file password and salt.
+
+    The keys are reused from the key cache, if available there, else they are
+    generated freshly and added to the key cache. If sFile is provided, then
+    the salt is remembered as the one used with it (see keycache_salt).
+    '''
+    if not bKeyCache:
+        return _get_basekeys(filePass, salt)
+    keycache_expire()
+    key = (keycache_passid(filePass), salt)
+    if sFile != None:
+        gdKeyCacheFiles[os.path.realpath(sFile)] = key
+    val = gdKeyCache.get(key)
+    if val != None:
+        return val[1], val[2]
+    userKey, fileKey = _get_basekeys(filePass, salt)
+    gdKeyCache[key] = (time.time(), userKey, fileKey)
+    return userKey, fileKey
+
+
 def test_101():
     sPlainMsg = "hello world"
     bsEncMsg, bsMac = aes_cbc_enc(b'0123456789abcdef', sPlainMsg)
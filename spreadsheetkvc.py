@@ -68,6 +68,12 @@ Notes:
     dirty tells if any modifications exist that havent been saved
     back to the disk yet.
 
+    dirtyRows tracks the rows modified since the last load/save of the csv file
+    described by fileState, so that saving into it can reuse the unmodified rows.
+
+    editCount is incremented whenever cells are modified, so that autosave can
+    identify if there are new changes to save.
+
     exit triggers a exit from the program, if its not DONTEXIT.
 '''
 
@@ -85,14 +91,14 @@ me = {
         'helpModeSavedReadOnly': None,
         'data': dict(),
         'cdata': dict(),
-        'cdataUpdate': True,
         'clipCell': False,
         'copyData': None,
         'copySrcCell': None,
         'gotStr': "",
         'dirty': False,
-        'calcCnt': dict(),
-        'callDepth': 0,
+        'dirtyRows': None,
+        'fileState': None,
+        'editCount': 0,
         'markers': dict(),
         'fpc': dict(),
         'tc': dict(),
@@ -217,7 +223,11 @@ def dlg(scr, msgs, r=0, c=0, attr=curses.A_NORMAL):
     ty,tx = cellpos(r,c)
     for i in range(len(msgs)):
         cui.cellstr(scr, ty+i, tx, msgs[i], attr)
-    return scr.getch()
+    # Retry, if getch times out, like when autosave is enabled
+    got = scr.getch()
+    while got == -1:
+        got = scr.getch()
+    return got
 
 
 def status(scr, msgs, r=0, c=0, attr=curses.A_NORMAL):
@@ -348,73 +358,58 @@ def _cdata_update(rStart, cStart, rEnd, cEnd):
     '''
     Cache data calculation results for the given block of cells, if not already cached.
 
-    If exception, then ignore that cell and try calculating other cells in the specified block.
-    Just in case if the exception is due to a long chain of cells in calc, then trying other cells
-    and coming back later to this cell, could potentially help build the solution part by part.
+    The cells in the block and the cells they depend on, are evaluated in their
+    dependency order, as got from syncd.get_evalorder, by cellval.nvalue_ordered.
+    So each cell gets evaluated only after all the cells it depends on have been
+    evaluated, thus avoiding recursions, even for very long chains of cells.
 
     Caching is handled by nvalue_key logic.
 
-    If any exceptions while handling the block, it will return to the caller which cells had a
-    recursion limit exception and which cells if any had other exceptions.
+    Cells which are part of a calc loop, as identified by syncd from the links between
+    cells, and cells which depend on them, are not evaluated.
+    If exception, then ignore that cell and try calculating other cells. It returns
+    to the caller the cells which are part of calc loops and the cells which had
+    other exceptions.
     '''
-    bRecursionError = False
-    bException = False
-    lExcCells = []
-    lRecCells = []
+    lCells = []
     for r in range(rStart, rEnd+1):
         for c in range(cStart, cEnd+1):
-            data = me['cdata'].get((r,c))
-            if data != None:
-                continue
-            me['calcCnt'] = dict()
-            me['callDepth'] = 0
-            try:
-                val = cellval.nvalue_key((r,c))
-            except RecursionError:
-                bRecursionError = True
-                lRecCells.append((r,c))
-            except:
-                bException = True
-                lExcCells.append((r,c))
-                print("_cdata_update:exception:{}".format((r,c)), file=GERRFILE)
-                traceback.print_exc(file=GERRFILE)
-    return bRecursionError, lRecCells, bException, lExcCells
+            lCells.append((r,c))
+    lOrder, sLoopCells = syncd.get_evalorder(lCells)
+    lExcCells = []
+    cellval.nvalue_ordered(lOrder, lExcCells)
+    return sLoopCells, lExcCells
 
 
 ERREXCEPTION = "#ErrExc#"
 ERRLOOP = "#ErrLop#"
-def cdata_update(bClearCache=True, rStart=1, cStart=1, rEnd=-1, cEnd=-1):
+def cdata_update(rStart=1, cStart=1, rEnd=-1, cEnd=-1):
     '''
     Help calculate, if needed, and cache calcd values for a given block of cells.
 
-    If there is recursion limit errors, even after multiple tries, then it will
-    force a all cells calc mode/phase. Which should help build solution for all
-    cells over multiple passes. NOTE: The i loop provides this multi pass, when
-    j loop is at j == 1, because full set of cells is tried to be calculated
-    as best as possible in any given pass, thus building over prev evaluated cells,
-    in deep chained scenarios.
+    Only the cells which are not in the calc cache are calculated. As syncd clears
+    the calc cache of only the updated cells and the cells depending on them, only
+    those get recalculated. The full calc cache is cleared only explicitly, when a
+    new spreadsheet is loaded or on the xrecalc command (see syncd.cdata_clear_all).
+
+    Cells involved in calc loops and cells which raised exceptions are err tagged.
     '''
-    if bClearCache:
-        me['cdata'] = dict()
     if rEnd == -1:
         rEnd = me['numRows']
     if cEnd == -1:
         cEnd = me['numCols']
-    for j in range(2):
-        for i in range(4):
-            bRecErr, lRecCells, bExc, lExcCells = _cdata_update(rStart, cStart, rEnd, cEnd)
-            if not bRecErr:
-                break
-            print("cdata_update:{},{}-{},{}:{}:recover".format(rStart, cStart, rEnd, cEnd, j*10+i), file=GERRFILE)
-        if not bRecErr:
-            break
-        print("cdata_update:{},{}-{},{}:fullcalc".format(rStart, cStart, rEnd, cEnd), file=GERRFILE)
-        rStart, cStart = 1, 1
-        rEnd, cEnd = me['numRows'], me['numCols']
+    sLoopCells, lExcCells = _cdata_update(rStart, cStart, rEnd, cEnd)
+    lTagged = []
     for eCell in lExcCells:
         me['data'][eCell] = ERREXCEPTION+me['data'][eCell]
-    for eCell in lRecCells:
-        me['data'][eCell] = ERRLOOP+me['data'][eCell]
+        syncd.cell_updated(eCell, me['data'][eCell], clearCache=False, updateLoops=False)
+        lTagged.append(eCell)
+    for eCell in sLoopCells:
+        if me['data'][eCell].startswith('='):
+            me['data'][eCell] = ERRLOOP+me['data'][eCell]
+            syncd.cell_updated(eCell, me['data'][eCell], clearCache=False, updateLoops=False)
+            lTagged.append(eCell)
+    syncd.update_loops(lTagged)
 
 
 bNumericDisplayOverflow=True
@@ -445,8 +440,7 @@ def _cdraw_data(scr, rowStart, rowEnd, colStart, colEnd):
     # Evaluate any cells in the viewport that may require to be evaluated
     if me['state'] != 'E':
         cstatusbar(scr, ['[status: processing ...]'], 1, 32)
-    cdata_update(me['cdataUpdate'], rowStart, dataColStart, rowEnd, dataColEnd)
-    me['cdataUpdate'] = False
+    cdata_update(rowStart, dataColStart, rowEnd, dataColEnd)
     if me['state'] != 'E':
         cstatusbar(scr, ['                        '], 1, 32)
     # Update the display
@@ -622,14 +616,18 @@ def replace_incontent(cOld, cNew):
     Ensure that the old char specified is not part of valid integer or float values,
     else it may get replaced from integer and float values also.
     '''
-    for r in range(1, me['numRows']+1):
-        for c in range(1, me['numCols']+1):
-            sData = me['data'].get((r,c))
-            if (sData != None):
-                if bConvertTextOnly and (sData[0] == '='):
-                    continue
-                sData = sData.replace(cOld, cNew)
-                me['data'][(r,c)] = sData
+    clearedSet = set()
+    lCells = []
+    for r, c in syncd.cells_in_range(1, 1, me['numRows'], me['numCols']):
+        sData = me['data'][(r,c)]
+        if bConvertTextOnly and (sData[0] == '='):
+            continue
+        sNewData = sData.replace(cOld, cNew)
+        if sNewData != sData:
+            me['data'][(r,c)] = sNewData
+            syncd.cell_updated((r,c), sNewData, clearedSet=clearedSet, updateLoops=False)
+            lCells.append((r,c))
+    syncd.update_loops(lCells)
 
 
 def _do_calign(cmd, lArgs):
@@ -646,7 +644,7 @@ def _do_calign(cmd, lArgs):
         GALIGN = Align.Default
     else:
         raise Exception('calign: Invalid argument')
-    return "'calign:{}'".format(lArgs[0])
+    return "calign:{}".format(lArgs[0])
 
 
 def _do_cformat(cmd, lArgs):
@@ -669,7 +667,7 @@ def _do_cformat(cmd, lArgs):
             me['cformat.iffloat'] = None
         else:
             me['cformat.iffloat'] = int(lArgs[1])
-        return "'FltPreci:{}'".format(me['cformat.iffloat'])
+        return "FltPreci:{}".format(me['cformat.iffloat'])
         #return round(1.11111111111111111111, me['cformat.iffloat'])
         #return 1.11111111111111111111
     elif lArgs[0] == "number2float":
@@ -679,15 +677,15 @@ def _do_cformat(cmd, lArgs):
             me['cformat.number2float'] = True
         else:
             raise Exception('cformat: Invalid argument')
-        return "'Num2Float:{}'".format(me['cformat.number2float'])
+        return "Num2Float:{}".format(me['cformat.number2float'])
     elif lArgs[0] == "neat":
         me['cformat.number2float'] = True
         me['cformat.iffloat'] = 2
-        return "'CFormat:Neat'"
+        return "CFormat:Neat"
     elif lArgs[0] == "raw":
         me['cformat.number2float'] = False
         me['cformat.iffloat'] = None
-        return "'CFormat:Raw'"
+        return "CFormat:Raw"
 
 
 def do_ccmd(scr, cmd, args):
@@ -697,6 +695,7 @@ def do_ccmd(scr, cmd, args):
     cro, crw
     cfs, ctq
     calign, cformat,
+    cautosave
     '''
     global THEFIELDSEP, THEQUOTE
 
@@ -726,6 +725,12 @@ def do_ccmd(scr, cmd, args):
     elif cmd.startswith('cformat'):
         lArgs, lTypes = parse.get_tokens(args)
         _do_cformat(cmd, lArgs)
+    elif (cmd == 'cautosave'):
+        if (args == None) or (args == 'off'):
+            fileio.AUTOSAVEINTERVAL = 0
+        else:
+            fileio.AUTOSAVEINTERVAL = int(args)
+        cstatusbar(scr, ['autosave interval: {} secs'.format(fileio.AUTOSAVEINTERVAL)])
     setup_fileio()
 
 
@@ -736,7 +741,7 @@ def do_xcmd(scr, cmd, args):
     global GBRAWVIEW
 
     if (cmd == 'xrecalc'):
-        me['cdataUpdate'] = True
+        syncd.cdata_clear_all()
     elif (cmd == 'xrows'):
         newRows = int(args)
         if newRows < me['numRows']:
@@ -783,7 +788,7 @@ def path_completion(fpc, cmdArgs):
     else:
         cmd, args = cmdArgs.split(' ',1)
     # Check if its a valid command
-    if (cmd in ['w', 's', 'l', '!ls']):
+    if (cmd in ['w', 's', 'ws', 'l', 'ls', '!ls']):
         theArg = args
         theBase = cmd
     elif (cmd in ['pw', 'ps', 'pl']):
@@ -814,6 +819,7 @@ def explicit_commandmode(stdscr, cmdArgs):
 
     w|s path/file_to_save;   l path/file_to_open
     pw|ps path/file_to_save; pl path/file_to_open
+    ws path/snapshot_file_to_save; ls path/snapshot_file_to_open
     dr delete row;           dc delete column
     irb num_of_rows
         insert n rows before current row
@@ -847,8 +853,12 @@ def explicit_commandmode(stdscr, cmdArgs):
     elif (cmd == 'pw') or (cmd == 'ps'):
         filePass, args = args.split(' ',1)
         fileio.save_file(me, stdscr, args, filePass)
+    elif cmd == 'ws':
+        fileio.save_snapshot(me, stdscr, args)
     elif cmd == 'l':
         fileio.load_file(me, stdscr, args)
+    elif cmd == 'ls':
+        fileio.load_file(me, stdscr, args, bSnapshot=True)
     elif cmd == 'pl':
         filePass, args = args.split(' ',1)
         fileio.load_file(me, stdscr, args, filePass)
@@ -860,12 +870,9 @@ def explicit_commandmode(stdscr, cmdArgs):
         edit.insert_rc_ab(cmd, args)
         t2 = time.time()
         print("DBUG:InsertRC:{}".format(t2-t1), file=GERRFILE)
-        cstatusbar(stdscr, ['[sync deps progress...]'])
-        syncd.create_links()
         cstatusbar(stdscr, ['                       '])
         me['dirty'] = True
-        # insert_rc_ab adjusts calc cache as required so not force clearing full cache.
-        #me['cdataUpdate'] = True
+        # insert_rc_ab adjusts calc cache and links as required so not force clearing full cache.
     elif cmd.startswith('d') and not me['readOnly']:
         if args == None:
             args = "1"
@@ -874,12 +881,9 @@ def explicit_commandmode(stdscr, cmdArgs):
         edit.delete_rc(cmd, args)
         t2 = time.time()
         print("DBUG:DeleteRC:{}".format(t2-t1), file=GERRFILE)
-        cstatusbar(stdscr, ['[sync deps progress...]'])
-        syncd.create_links()
         cstatusbar(stdscr, ['                       '])
         me['dirty'] = True
-        # delete_rc adjusts calc cache as required so not force clearing full cache.
-        #me['cdataUpdate'] = True
+        # delete_rc adjusts calc cache and links as required so not force clearing full cache.
     elif cmd.startswith('g'):
         if args != None:
             nav.goto_cell(stdscr, args)
@@ -889,8 +893,9 @@ def explicit_commandmode(stdscr, cmdArgs):
         if len(me['data']) > 0:
             me['data'] = dict()
             syncd.create_links()
+            syncd.cdata_clear_all()
+            me['fileState'] = None
             me['dirty'] = True
-            me['cdataUpdate'] = True
     elif (cmd == 'new'):
         fileio.new_file(me, stdscr)
     elif (cmd[0] == 'c'):
@@ -1108,10 +1113,8 @@ def rl_editplusmode(stdscr, key):
                 me['state'] = 'C'
             me['dirty'] = True
             # sync up things
-            #me['cdataUpdate'] = True
             tData = me['data'].get((me['curRow'],me['curCol']))
-            if tData != None:
-                syncd.cell_updated((me['curRow'], me['curCol']), tData, clearedSet=set())
+            syncd.cell_updated((me['curRow'], me['curCol']), tData, clearedSet=set())
         elif me['state'] == ':':
             explicit_commandmode(stdscr, me['gotStr'])
             me['state'] = 'C'
@@ -1164,7 +1167,17 @@ def runlogic(stdscr):
     bBackInC = False
     while True:
         cdraw(stdscr)
-        key = stdscr.getch()
+        # If autosave is enabled, getch times out periodically, so that autosave can
+        # progress, even when the user is idle. The timeout is restored before handling
+        # the key, so that the dialogs used by the handlers wait for the user.
+        # Stale key cache entries are wiped on each tick, as well as on each key.
+        stdscr.timeout(fileio.autosave_pollms())
+        while True:
+            key = stdscr.getch()
+            sec.keycache_expire()
+            if (not fileio.autosave_tick(me, stdscr)) or (key != -1):
+                break
+        stdscr.timeout(-1)
         try:
             if (me['state'] == 'C'):    #### Command Mode
                 if not bBackInC:
@@ -1214,7 +1227,7 @@ def setup_cellval():
     cellval.GERRFILE = GERRFILE
 
 
-def setup_funcs():
+def setup_funcs(load=False):
     if GBFLYPYTHON:
         funcs.BFILTERPYFUNC = False
     else:
@@ -1224,6 +1237,8 @@ def setup_funcs():
     funcs.GERRFILE = GERRFILE
     funcs._do_cformat = _do_cformat
     funcs._do_calign = _do_calign
+    if load:
+        funcs.load_numpy()
 
 
 def setup_fileio(load=False):
@@ -1254,18 +1269,20 @@ def setup_nav():
     nav.cellcur = cellcur
 
 
-def setup_syncd():
+def setup_syncd(load=False):
     syncd.GLOGFILE = GLOGFILE
     syncd.GERRFILE = GERRFILE
     syncd.me = me
     syncd.init()
+    if load:
+        syncd.load_cext()
 
 
 def setup_helpermodules():
     setup_parse(True)
-    setup_syncd()
+    setup_syncd(True)
     setup_cellval()
-    setup_funcs()
+    setup_funcs(True)
     setup_nav()
     setup_fileio(True)
     setup_edit()
@@ -1304,7 +1321,7 @@ def setup_files():
     GERRFILE=setup_errfile()
 
 
-CmdArgs = enum.Enum("CmdArgs", "help fieldsep quote startnohelp creadonly calldepth flypython usecolor")
+CmdArgs = enum.Enum("CmdArgs", "help fieldsep quote startnohelp creadonly flypython usecolor depssidecar")
 def print_usage():
     print("{}:spreadsheetkvc: usage".format(sys.argv[0]))
     print("    --{}          Prints this commandline usage info".format(CmdArgs.help.name))
@@ -1312,9 +1329,9 @@ def print_usage():
     print('    --{} "{}"     Specify the csv field text quote to use'.format(CmdArgs.quote.name, THEQUOTE))
     print("    --{}   Dont show the help dialog at the start".format(CmdArgs.startnohelp.name))
     print("    --{}     run in readonly|view mode".format(CmdArgs.creadonly.name))
-    print("    --{} <depth>    specify the maximum call depth | cell chaining allowed".format(CmdArgs.calldepth.name))
     print("    --{}     allow more varied python expressions in cells".format(CmdArgs.flypython.name))
     print("    --{}      use alternate color rows on the terminal".format(CmdArgs.usecolor.name))
+    print("    --{}   save and use the deps sidecar file (file.csv.deps)".format(CmdArgs.depssidecar.name))
     exit(0)
 
 
@@ -1325,7 +1342,7 @@ def process_cmdline(args):
     global THEFIELDSEP
     global THEQUOTE
     global gbStartHelp
-    global CALLDEPTHMAX, GBFLYPYTHON, GBUSECOLOR
+    global GBFLYPYTHON, GBUSECOLOR
     i = 1
     while i < len(args):
         cmd = args[i][2:]
@@ -1341,13 +1358,12 @@ def process_cmdline(args):
             gbStartHelp = False
         elif cmd == CmdArgs.creadonly.name:
             me['readOnly'] = True
-        elif cmd == CmdArgs.calldepth.name:
-            i += 1
-            CALLDEPTHMAX = int(args[i])
         elif cmd == CmdArgs.flypython.name:
             GBFLYPYTHON = True
         elif cmd == CmdArgs.usecolor.name:
             GBUSECOLOR = True
+        elif cmd == CmdArgs.depssidecar.name:
+            fileio.bDepsSidecar = True
         i += 1
 
 
@@ -1360,8 +1376,8 @@ stdscr=cstart()
 cattr_textnum(stdscr)
 setup_sighandlers()
 setup_helpermodules()
-sys.setrecursionlimit(5000)
 try:
+    fileio.autosave_startcheck(stdscr)
     if gbStartHelp:
         helpdlg.help_dlg(stdscr)
     runlogic(stdscr)
@@ -1371,6 +1387,9 @@ except Exception as e:
     traceback.print_exc(file=GERRFILE)
     print("exception: done", file=GLOGFILE)
 finally:
+    if me['exit'] != DONTEXIT:
+        fileio.autosave_cleanup(me)
+    sec.keycache_clear()
     stdscr.clear()
     stdscr.refresh()
     cend(stdscr)
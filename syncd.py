@@ -4,13 +4,25 @@
 #
 
 
+import sys
 import time
+import math
+import bisect
+import importlib
+import os
+import concurrent.futures
 import parsekvc as parse
+import cellval
 
 
 me = None
 GERRFILE = None
 GLOGFILE = None
+csyncd = None
+
+# Number of =expression cells, above which create_links parses them using a pool
+# of worker processes, if more than 1 cpu is available.
+PARALLELLINKS = 100000
 
 
 '''
@@ -39,20 +51,85 @@ to be updated because a given cell has been updated.
     of all the cells, to see if they are dependent on the cell being
     updated/modified/edited/...
 
+Ranges of cells refered to in a =expression are not expanded into
+the individual cells. Instead they are kept as rectangles in fwdRanges
+of the cell and inturn in a spatial index (rangeIndex), so that the
+cells depending on a given cell through ranges, can be found with a
+point query. So the memory used by links and the time taken to create
+them scale with the number of =expressions and not the number of cells
+covered by their ranges.
+
 NOTE: Clearing the cached data of a cell, will automatically force
 it to get recalculated.
+
+Sync module also maintains a sparse index of the cells with content,
+in the form of the sorted list of populated rows (rowList), and for each
+of them the sorted list of its populated cols (rowCols), and in turn for
+each col the sorted list of its populated rows (colRows). This allows
+walking over only the populated cells in a given range of cells.
+
+Sync module also maintains a per column index (colSums) of the sum and
+count of the cells, as a segment tree over small blocks of rows, so that
+sum and count of any range of cells, which doesnt contain =expressions or
+other cells whose value could change, can be found in O(log n) time,
+without walking over the range.
+The index of a column is built lazily, when a range in it is first summed,
+and inturn kept uptodate by cell_updated.
+
+Calc loops ie cells which directly or indirectly depend on themselves,
+are found from the forward links graph, by identifying its strongly
+connected components. loopOf maps each cell which is part of a calc
+loop to the set of cells making up that loop. It is built fully by
+create_links and inturn kept uptodate by cell_updated.
+
+Sync module also memos the results of functions over ranges of cells
+(rangeMemo), so that cells using the same function over the same range
+reuse the result. The memo of a range is dropped, when any cell in it is
+updated or has its calc cache cleared, by looking up the rangeIndex.
+
+The hot logics wrt links (ie revLinks add/discard, rangeIndex queries,
+clearing of the calc cache of the dependent cells and converting the cell
+addresses in a =expression into links and ranges) are also implemented in
+the csyncd c module, which works on the same python containers. If it is
+loaded, then it is used, else the python logic is used.
 '''
 
 
+def load_cext():
+    global csyncd
+    try:
+        csyncd = importlib.import_module("csyncd")
+        print("INFO:syncd:Loaded csyncd c module", file=GERRFILE)
+    except:
+        print("WARN:{}".format(sys.exc_info()), file=GERRFILE)
+        print("WARN:syncd:Couldnt load the csyncd c module, so using slightly slower but better tested python logic", file=GERRFILE)
+
+
 def init():
     me['fwdLinks'] = dict()
     me['revLinks'] = dict()
+    me['fwdRanges'] = dict()
+    me['rangeIndex'] = dict()
+    me['rangeLevels'] = dict()
+    me['rangeRects'] = dict()
+    me['rangeMemo'] = dict()
+    me['loopOf'] = dict()
+    me['colSums'] = dict()
+    me['colSumItems'] = dict()
+    me['rowList'] = []
+    me['rowCols'] = dict()
+    me['colRows'] = dict()
+    me['cexpr'] = dict()
+    cellval.compile_cache_clear()
 
 
 def cell_revlink_add(cell, revLink):
     '''
     Update the revLinks of a cell, to include the cell named by revLink.
     '''
+    if csyncd != None:
+        csyncd.revlink_add(me['revLinks'], cell, revLink)
+        return
     cellRevLink = me['revLinks'].get(cell)
     if cellRevLink == None:
         cellRevLink = set()
@@ -64,14 +141,331 @@ def cell_revlink_discard(cell, revLink):
     '''
     Update the revLinks of a cell, by removing the cell named by revLink.
     '''
-    cellRevLink = me['revLinks'].get(cell)
-    if cellRevLink != None:
-        cellRevLink.discard(revLink)
+    if csyncd != None:
+        bFound = csyncd.revlink_discard(me['revLinks'], cell, revLink)
     else:
+        cellRevLink = me['revLinks'].get(cell)
+        bFound = (cellRevLink != None)
+        if bFound:
+            cellRevLink.discard(revLink)
+    if not bFound:
         print("WARN:syncdCellRevLinkDiscard:cell[{}] revLinkToRemove[{}]".format(cell, revLink), file=GERRFILE)
 
 
-def cdata_clear_revlinks(cellKey, clearedSet=None, depth=0):
+def sparse_add(cellKey):
+    '''
+    Add the given cell to the sparse index of populated cells.
+    '''
+    r, c = cellKey
+    lCols = me['rowCols'].get(r)
+    if lCols == None:
+        lCols = []
+        me['rowCols'][r] = lCols
+        bisect.insort(me['rowList'], r)
+    i = bisect.bisect_left(lCols, c)
+    if (i < len(lCols)) and (lCols[i] == c):
+        return
+    lCols.insert(i, c)
+    lRows = me['colRows'].get(c)
+    if lRows == None:
+        lRows = []
+        me['colRows'][c] = lRows
+    bisect.insort(lRows, r)
+
+
+def _sorted_discard(lItems, item):
+    i = bisect.bisect_left(lItems, item)
+    if (i < len(lItems)) and (lItems[i] == item):
+        del(lItems[i])
+
+
+def sparse_discard(cellKey):
+    '''
+    Remove the given cell from the sparse index of populated cells.
+    '''
+    r, c = cellKey
+    lCols = me['rowCols'].get(r)
+    if lCols == None:
+        return
+    _sorted_discard(lCols, c)
+    if len(lCols) == 0:
+        me['rowCols'].pop(r)
+        _sorted_discard(me['rowList'], r)
+    lRows = me['colRows'].get(c)
+    if lRows == None:
+        return
+    _sorted_discard(lRows, r)
+    if len(lRows) == 0:
+        me['colRows'].pop(c)
+
+
+def sparse_build():
+    '''
+    Build the sparse index for all the cells in the spreadsheet in memory.
+    '''
+    me['rowCols'] = dict()
+    me['colRows'] = dict()
+    for r, c in sorted(me['data']):
+        lCols = me['rowCols'].get(r)
+        if lCols == None:
+            lCols = []
+            me['rowCols'][r] = lCols
+        lCols.append(c)
+        lRows = me['colRows'].get(c)
+        if lRows == None:
+            lRows = []
+            me['colRows'][c] = lRows
+        lRows.append(r)
+    me['rowList'] = list(me['rowCols'])
+
+
+def _sorted_slice(lItems, start, end):
+    return lItems[bisect.bisect_left(lItems, start):bisect.bisect_right(lItems, end)]
+
+
+def cells_in_range(sR, sC, eR, eC):
+    '''
+    Get the list of populated cells in the given range, in row major order.
+
+    A single column range is got from the column's rows, while others are got
+    from the populated rows in the range and inturn their populated cols.
+    '''
+    if sC == eC:
+        return [ (r, sC) for r in _sorted_slice(me['colRows'].get(sC, ()), sR, eR) ]
+    lCells = []
+    rowCols = me['rowCols']
+    for r in _sorted_slice(me['rowList'], sR, eR):
+        lCols = rowCols[r]
+        if (lCols[0] >= sC) and (lCols[-1] <= eC):
+            lCells.extend([ (r, c) for c in lCols ])
+        else:
+            lCells.extend([ (r, c) for c in _sorted_slice(lCols, sC, eC) ])
+    return lCells
+
+
+def _range_blocks(rect):
+    '''
+    Get the blocks of the rangeIndex, which the given rectangle is registered under.
+
+    A rectangle is registered at the level (a row level and a col level), whose block
+    height and width are larger than its height and width respectively, so that it
+    gets registered under atmost 2x2 blocks of that level.
+    '''
+    r1, c1, r2, c2 = rect
+    level = ((r2-r1).bit_length(), (c2-c1).bit_length())
+    lBlocks = []
+    for br in range(r1 >> level[0], (r2 >> level[0])+1):
+        for bc in range(c1 >> level[1], (c2 >> level[1])+1):
+            lBlocks.append((level, br, bc))
+    return level, lBlocks
+
+
+def range_index_add(cellKey, rect):
+    '''
+    Add to the rangeIndex, that the given cell depends on the given rectangle of cells.
+    '''
+    level, lBlocks = _range_blocks(rect)
+    me['rangeLevels'][level] = me['rangeLevels'].get(level, 0) + 1
+    me['rangeRects'][rect] = me['rangeRects'].get(rect, 0) + 1
+    for block in lBlocks:
+        sEntries = me['rangeIndex'].get(block)
+        if sEntries == None:
+            sEntries = set()
+            me['rangeIndex'][block] = sEntries
+        sEntries.add((cellKey, rect))
+
+
+def range_index_discard(cellKey, rect):
+    '''
+    Remove from the rangeIndex, the dependence of the given cell on the given rectangle of cells.
+    '''
+    level, lBlocks = _range_blocks(rect)
+    levelCnt = me['rangeLevels'].get(level, 0) - 1
+    if levelCnt > 0:
+        me['rangeLevels'][level] = levelCnt
+    else:
+        me['rangeLevels'].pop(level, None)
+    rectCnt = me['rangeRects'].get(rect, 0) - 1
+    if rectCnt > 0:
+        me['rangeRects'][rect] = rectCnt
+    else:
+        me['rangeRects'].pop(rect, None)
+        me['rangeMemo'].pop(rect, None)
+    for block in lBlocks:
+        sEntries = me['rangeIndex'].get(block)
+        if sEntries == None:
+            continue
+        sEntries.discard((cellKey, rect))
+        if len(sEntries) == 0:
+            me['rangeIndex'].pop(block)
+
+
+def range_index_query(cellKey):
+    '''
+    Get the set of cells which depend on the given cell through ranges.
+    '''
+    if csyncd != None:
+        return csyncd.range_index_query(me['rangeIndex'], me['rangeLevels'], cellKey)
+    r, c = cellKey
+    sCells = set()
+    for level in me['rangeLevels']:
+        sEntries = me['rangeIndex'].get((level, r >> level[0], c >> level[1]))
+        if sEntries == None:
+            continue
+        for owner, rect in sEntries:
+            if (rect[0] <= r <= rect[2]) and (rect[1] <= c <= rect[3]):
+                sCells.add(owner)
+    return sCells
+
+
+def rangememo_get(rect, key):
+    '''
+    Get the result memoed for the given range of cells wrt the given key (which
+    identifies the function and any other arguments), or None if not memoed.
+    '''
+    dResults = me['rangeMemo'].get(rect)
+    if dResults == None:
+        return None
+    return dResults.get(key)
+
+
+def rangememo_set(rect, key, val):
+    '''
+    Memo the result of a function wrt the given range of cells, so that other
+    cells using the same function over the same range, can reuse it.
+
+    Only ranges which are in the rangeIndex are memoed, as the memo of a range is
+    dropped by rangememo_discard, when any cell in it is updated or its calc cache
+    is cleared, by looking up the rangeIndex.
+    '''
+    if rect not in me['rangeRects']:
+        return
+    dResults = me['rangeMemo'].get(rect)
+    if dResults == None:
+        dResults = dict()
+        me['rangeMemo'][rect] = dResults
+    dResults[key] = val
+
+
+def rangememo_discard(cellKey):
+    '''
+    Drop the memoed results of all ranges which contain the given cell.
+    '''
+    dMemo = me['rangeMemo']
+    if len(dMemo) == 0:
+        return
+    if csyncd != None:
+        csyncd.rangememo_discard(me['rangeIndex'], me['rangeLevels'], dMemo, cellKey)
+        return
+    r, c = cellKey
+    for level in me['rangeLevels']:
+        sEntries = me['rangeIndex'].get((level, r >> level[0], c >> level[1]))
+        if sEntries == None:
+            continue
+        for owner, rect in sEntries:
+            if (rect[0] <= r <= rect[2]) and (rect[1] <= c <= rect[3]):
+                dMemo.pop(rect, None)
+
+
+def has_links(cellKey):
+    '''
+    Check if the given cell depends on any other cells.
+    '''
+    return (cellKey in me['fwdLinks']) or (cellKey in me['fwdRanges'])
+
+
+def links_extent(cellKey):
+    '''
+    Get the max row and max col among the cells, which the given cell depends on,
+    either directly or through ranges.
+    '''
+    maxR = maxC = 0
+    for r, c in me['fwdLinks'].get(cellKey, ()):
+        if r > maxR:
+            maxR = r
+        if c > maxC:
+            maxC = c
+    for r1, c1, r2, c2 in me['fwdRanges'].get(cellKey, ()):
+        if r2 > maxR:
+            maxR = r2
+        if c2 > maxC:
+            maxC = c2
+    return maxR, maxC
+
+
+def fwd_cells(cellKey, sWithin=None):
+    '''
+    Get the cells with content, which the given cell depends on, either directly or
+    through ranges. If sWithin is provided, only cells within it are considered.
+
+    The cells of the ranges are got using range_cells.
+    '''
+    if sWithin == None:
+        sWithin = me['data']
+    for cell in me['fwdLinks'].get(cellKey, ()):
+        if cell in sWithin:
+            yield cell
+    for rect in me['fwdRanges'].get(cellKey, ()):
+        yield from range_cells(rect, sWithin)
+
+
+def range_cells(rect, sWithin):
+    '''
+    Get the cells with content in the given range, which are within sWithin.
+
+    The populated cells of the range or the cells of sWithin (the smaller) are walked,
+    to find the cells that are within the range. When only some of the cells are of
+    interest (like the cells which have links), large ranges without any =expressions
+    in them, as found from colSums (see range_others), are skipped.
+    '''
+    r1, c1, r2, c2 = rect
+    if sWithin is me['data']:
+        yield from cells_in_range(r1, c1, r2, c2)
+        return
+    if range_others(r1, c1, r2, c2) == 0:
+        return
+    if ((r2-r1+1)*(c2-c1+1)) <= len(sWithin):
+        for cell in cells_in_range(r1, c1, r2, c2):
+            if cell in sWithin:
+                yield cell
+    else:
+        for cell in sWithin:
+            if (r1 <= cell[0] <= r2) and (c1 <= cell[1] <= c2):
+                yield cell
+
+
+def _evalorder_links(node, sLinked):
+    '''
+    Get the nodes to walk into from the given node, wrt get_evalorder.
+
+    For a cell, these are the linked cells it depends on directly and the ranges
+    it depends on, as is (ie as rectangles). For a range, these are its linked
+    cells. So the cells of a range are walked only once, even if many cells
+    depend on the same range.
+    '''
+    if len(node) == 4:
+        yield from range_cells(node, sLinked)
+        return
+    for cell in me['fwdLinks'].get(node, ()):
+        if cell in sLinked:
+            yield cell
+    yield from me['fwdRanges'].get(node, ())
+
+
+def rev_cells(cellKey):
+    '''
+    Get the cells which depend on the given cell, either directly or through ranges.
+    '''
+    if csyncd != None:
+        return csyncd.rev_cells(me['revLinks'], me['rangeIndex'], me['rangeLevels'], cellKey)
+    sCells = range_index_query(cellKey)
+    revLinks = me['revLinks'].get(cellKey)
+    if revLinks != None:
+        sCells.update(revLinks)
+    return sCells
+
+
+def cdata_clear_revlinks(cellKey, clearedSet=None):
     '''
     Clear cdata cache entry of a cell and all its revLinks.
 
@@ -79,95 +473,542 @@ def cdata_clear_revlinks(cellKey, clearedSet=None, depth=0):
     cell either directly or indirectly require to be cleared from calc
     cache, this logic helps with same.
 
+    The dependent cells are walked using a explicit worklist rather than
+    recursion, and each cell is cleared only once, so that chains of any
+    length and deeply interconnected chains are handled in a single linear
+    sweep over the dependent cells.
+
     If clearedSet is provided, it is kept uptodate wrt all cells that have been
-    cleared from calc cache, by this series of clear_revlinks calls. So for
-    calc cell-to-cell chains involving lot of interconnections and deep chains,
-    the logic will efficiently handle the situation. Without clearedSet it can
-    take long time for deeply interconnected chains of calcs.
-    '''
-    #print("DBUG:syncdCdataClearRevLinks:{}:cell[{}]".format(depth, cellKey), file=GERRFILE)
-    me['cdata'].pop(cellKey, None)
-    if clearedSet != None:
-        clearedSet.add(cellKey)
-    revLinks = me['revLinks'].get(cellKey)
-    if revLinks == None:
-        revLinks = []
-    for cell in revLinks:
-        if (clearedSet != None) and (cell in clearedSet):
+    cleared from calc cache, by this series of clear_revlinks calls. Inturn the
+    cells already in it are not walked again. This helps when a bunch of cells
+    are updated from the same context, like say during insert / delete of rows.
+
+    The csyncd c module, if loaded, does the same walk.
+    '''
+    if clearedSet == None:
+        clearedSet = set()
+    if csyncd != None:
+        csyncd.cdata_clear_revlinks(me['cdata'], me['revLinks'], me['rangeIndex'], me['rangeLevels'], me['rangeMemo'], cellKey, clearedSet)
+        return
+    cdata = me['cdata']
+    clearedSet.add(cellKey)
+    lWork = [ cellKey ]
+    while len(lWork) > 0:
+        cell = lWork.pop()
+        cdata.pop(cell, None)
+        rangememo_discard(cell)
+        for revCell in rev_cells(cell):
+            if revCell in clearedSet:
+                continue
+            clearedSet.add(revCell)
+            lWork.append(revCell)
+
+
+def cdata_clear_all():
+    '''
+    Clear the full calc cache, along with the memoed results of ranges.
+
+    This is required only when the spreadsheet in memory is replaced as a whole,
+    or when the user explicitly asks for all cells to be recalculated. For other
+    updates, the calc cache is cleared only wrt the updated cells and the cells
+    depending on them, by cell_updated.
+    '''
+    me['cdata'] = dict()
+    me['rangeMemo'] = dict()
+
+
+def find_loops(lCells, sWithin=None):
+    '''
+    Find the calc loops among the given cells and the cells depending on them,
+    by identifying the strongly connected components of the links graph.
+
+    The graph is walked along the reverse links, as the cells depending on a cell
+    can be found easily, even when they depend on it through ranges. The strongly
+    connected components are the same, either way.
+
+    This uses Tarjan's algorithm, with a explicit stack rather than recursion,
+    so that chains of any length can be handled. If sWithin is provided, then
+    only links to cells within it are considered.
+
+    Returns a dict mapping each cell which is part of a calc loop, to the set
+    of cells making up the loop.
+    '''
+    dLoopOf = dict()
+    dIndex = dict()
+    dLow = dict()
+    lSCCStack = []
+    sOnStack = set()
+    for startCell in lCells:
+        if startCell in dIndex:
             continue
-        cdata_clear_revlinks(cell, clearedSet, depth+1)
+        dIndex[startCell] = dLow[startCell] = len(dIndex)
+        lSCCStack.append(startCell)
+        sOnStack.add(startCell)
+        lStack = [ (startCell, iter(rev_cells(startCell))) ]
+        while len(lStack) > 0:
+            cell, itLinks = lStack[-1]
+            for link in itLinks:
+                if (sWithin != None) and (link not in sWithin):
+                    continue
+                if link not in dIndex:
+                    dIndex[link] = dLow[link] = len(dIndex)
+                    lSCCStack.append(link)
+                    sOnStack.add(link)
+                    lStack.append((link, iter(rev_cells(link))))
+                    break
+                if (link in sOnStack) and (dIndex[link] < dLow[cell]):
+                    dLow[cell] = dIndex[link]
+            else:
+                lStack.pop()
+                if len(lStack) > 0:
+                    parent = lStack[-1][0]
+                    if dLow[cell] < dLow[parent]:
+                        dLow[parent] = dLow[cell]
+                if dLow[cell] != dIndex[cell]:
+                    continue
+                lLoop = []
+                while True:
+                    sccCell = lSCCStack.pop()
+                    sOnStack.discard(sccCell)
+                    lLoop.append(sccCell)
+                    if sccCell == cell:
+                        break
+                if (len(lLoop) == 1) and (cell not in rev_cells(cell)):
+                    continue
+                sLoop = frozenset(lLoop)
+                for sccCell in lLoop:
+                    dLoopOf[sccCell] = sLoop
+    return dLoopOf
 
 
-TIMECAP1 = 0
-TIMECAP2 = 0
-TIMECAP3 = 0
-TOKENCAP1 = 0
-def cell_updated_time_init():
-    global TIMECAP1, TIMECAP2, TIMECAP3, TOKENCAP1
-    TIMECAP1 = 0
-    TIMECAP2 = 0
-    TIMECAP3 = 0
-    TOKENCAP1 = 0
+def update_loops(lCells):
+    '''
+    Update the calc loops info, after the links of the given cells have changed.
 
+    A change in the links of a cell can only break the calc loop it was part of,
+    or create a new calc loop which includes it. So the old loops of the given
+    cells are dropped and inturn a single strongly connected components pass is
+    run, starting from the given cells and the cells of their old loops.
 
-def cell_updated(cellKey, sContent, clearCache=True, clearedSet=None):
+    When a bunch of cells are updated together, cell_updated can be told not to
+    update the calc loops, and inturn this can be called once for all of them,
+    so that the cells depending on them are walked only once.
     '''
-    Update the fw and reverse links associated with each cell
+    loopOf = me['loopOf']
+    lStart = []
+    for cellKey in lCells:
+        sOldLoop = loopOf.get(cellKey)
+        if sOldLoop != None:
+            for cell in sOldLoop:
+                loopOf.pop(cell, None)
+            lStart.extend(sOldLoop)
+        if has_links(cellKey):
+            lStart.append(cellKey)
+    if len(lStart) == 0:
+        return
+    loopOf.update(find_loops(lStart))
 
-    NOTE: For now it maintains a expanded list of cells. TO keep the
-    logic which depends on this at other places simple and stupid.
 
-    clearedSet can be used to ensure that calc cache clearing can be done
-    efficiently for spreadsheets involving very-very-long chains of
-    cell-to-cell interdependencies. Also when a bunch of cells are
-    updated from the same context like say during insert / delete of
-    rows / cols, the clearedSet helps to avoid trying to clear calc cache
-    of same dependent cells more than once, across multiple calls to
-    cell_updated.
+def get_evalorder(lCells):
+    '''
+    Get the order in which the given cells and the cells they depend on
+    require to be evaluated, so that any cell is evaluated only after all
+    the cells it depends on have been evaluated.
+
+    Only cells which have some content and which are not already in the
+    calc cache are included. The links graph is walked depth first, using
+    a explicit stack rather than recursion, so that chains of any length
+    can be handled. Cells which dont depend on other cells, can be evaluated
+    directly when required, so they are not walked into, other than the
+    given cells themselves.
 
-    In normal use one should call cell_updated with a empty clearedSet.
-    Think carefully before using cell_updated without clearedSet.
+    Ranges are walked as nodes by themselves, so that the cells of a range
+    are walked only once, even if many cells depend on the same range.
+
+    Cells which are part of calc loops are not walked into, instead they
+    are returned separately, along with the cells which depend on them.
+    So the returned tuple is (lOrder, sLoopCells).
     '''
-    global TIMECAP1, TIMECAP2, TIMECAP3, TOKENCAP1
-    origCellFwdLink = me['fwdLinks'].get(cellKey)
-    cellFwdLink = set()
-    # Handle the new content of the cell
-    #T1 = time.time()
+    cdata = me['cdata']
+    data = me['data']
+    loopOf = me['loopOf']
+    sLinked = me['fwdLinks'].keys() | me['fwdRanges'].keys()
+    lOrder = []
+    sLoopNodes = set()
+    sSeen = set()
+    for startCell in lCells:
+        if (startCell in sSeen) or (startCell in cdata) or (startCell not in data):
+            continue
+        sSeen.add(startCell)
+        if startCell in loopOf:
+            sLoopNodes.add(startCell)
+            continue
+        # Each entry is [node, itDependsOn, bDependsOnLoop]
+        lStack = [ [startCell, _evalorder_links(startCell, sLinked), False] ]
+        while len(lStack) > 0:
+            entry = lStack[-1]
+            for link in entry[1]:
+                if link in sLoopNodes:
+                    entry[2] = True
+                    continue
+                if (link in sSeen) or (link in cdata):
+                    continue
+                sSeen.add(link)
+                if link in loopOf:
+                    sLoopNodes.add(link)
+                    entry[2] = True
+                    continue
+                lStack.append([link, _evalorder_links(link, sLinked), False])
+                break
+            else:
+                lStack.pop()
+                if entry[2]:
+                    sLoopNodes.add(entry[0])
+                    if len(lStack) > 0:
+                        lStack[-1][2] = True
+                elif len(entry[0]) == 2:
+                    lOrder.append(entry[0])
+    sLoopCells = { node for node in sLoopNodes if len(node) == 2 }
+    return lOrder, sLoopCells
+
+
+COLSUMSHIFT = 4
+COLSUMMINCELLS = 4096
+COLSUMFLOATCHARS = set('0123456789.eE+-')
+def _colsum_item(sContent):
+    '''
+    Get the contribution of a cell's content to the colSums index, which is its
+    numeric value, or None if its value cant be got from the index, like for
+    =expressions or text cells, when they dont evaluate to 0.
+    '''
+    if sContent == "":
+        return 0
+    if sContent.startswith('='):
+        return None
+    if not ((sContent[0] in [ '+', '-' ]) or sContent[0].isnumeric()):
+        if cellval.GBTEXT2ZERO:
+            return 0
+        return None
+    # Plain numbers are converted directly, as thats much cheaper than eval
+    sDigits = sContent.lstrip('+-')
+    if (len(sContent)-len(sDigits) <= 1) and sDigits.isascii() and sDigits.isdigit() and ((sDigits[0] != '0') or (len(sDigits) == 1)):
+        return int(sContent)
+    val = None
+    if (set(sContent) <= COLSUMFLOATCHARS) and not set(sContent).isdisjoint('.eE'):
+        try:
+            val = float(sContent)
+        except ValueError:
+            pass
+    if val == None:
+        val = cellval.nvalue_number(sContent)
+    if type(val) == int:
+        return val
+    if (type(val) == float) and math.isfinite(val):
+        return val
+    return None
+
+
+def _colsum_leaf(dItems, b):
+    '''
+    Get the summary of the given block of rows of a column, as a list of
+    [intSum, floatSum, floatCnt, cellCnt, otherCnt], from its dict of row to item.
+
+    The floats of the block are summed using math.fsum.
+    '''
+    intSum = floatCnt = cellCnt = otherCnt = 0
+    lFloats = []
+    for r in range(b << COLSUMSHIFT, (b+1) << COLSUMSHIFT):
+        if r not in dItems:
+            continue
+        val = dItems[r]
+        cellCnt += 1
+        if val == None:
+            otherCnt += 1
+        elif type(val) == float:
+            lFloats.append(val)
+        else:
+            intSum += val
+    return [ intSum, math.fsum(lFloats), len(lFloats), cellCnt, otherCnt ]
+
+
+def _colsum_tree(dItems, size):
+    '''
+    Build the segment tree of a column, over its blocks of rows, from its dict of
+    row to item, in linear time.
+
+    It is a list of 5 lists (intSums, floatSums, floatCnts, cellCnts, otherCnts),
+    each having 2*size nodes, where size is a power of 2. The leaf node of block b
+    is at size+b, and each inner node n holds the totals of its children 2n, 2n+1.
+
+    A segment tree is used rather than a fenwick tree, as a range is got by adding
+    up its nodes, rather than by subtracting prefix sums, so floats dont lose
+    precision, and inner nodes are recomputed from their children on updates,
+    rather than adjusted by deltas, so sums dont drift as cells are updated.
+    '''
+    lTree = [ [0]*(2*size), [0.0]*(2*size), [0]*(2*size), [0]*(2*size), [0]*(2*size) ]
+    lInts, lFloatSums, lFloatCnts, lCellCnts, lOtherCnts = lTree
+    dFloats = dict()
+    for r, val in dItems.items():
+        n = size + (r >> COLSUMSHIFT)
+        lCellCnts[n] += 1
+        if val == None:
+            lOtherCnts[n] += 1
+        elif type(val) == float:
+            dFloats.setdefault(n, []).append(val)
+        else:
+            lInts[n] += val
+    for n, lFloats in dFloats.items():
+        lFloatSums[n] = math.fsum(lFloats)
+        lFloatCnts[n] = len(lFloats)
+    for lNodes in lTree:
+        for n in range(size-1, 0, -1):
+            lNodes[n] = lNodes[2*n] + lNodes[2*n+1]
+    return lTree
+
+
+def _colsums_column(c):
+    '''
+    Get the colSums index of the given column, building it if not yet built.
+
+    It is a segment tree over the blocks of COLSUMSHIFT rows of the column (see
+    _colsum_tree), covering atleast the rows of the spreadsheet.
+    '''
+    lTree = me['colSums'].get(c)
+    if lTree != None:
+        return lTree
+    dItems = dict()
+    for r in me['colRows'].get(c, ()):
+        dItems[r] = _colsum_item(me['data'][(r,c)])
+    numBlocks = (max(me['numRows'], max(dItems, default=0)) >> COLSUMSHIFT) + 1
+    size = 1
+    while size < numBlocks:
+        size *= 2
+    lTree = _colsum_tree(dItems, size)
+    me['colSumItems'][c] = dItems
+    me['colSums'][c] = lTree
+    return lTree
+
+
+def colsums_update(cellKey, sContent):
+    '''
+    Update the colSums index of the cell's column, if already built, wrt the given
+    cell's new content. This should match the cell's content in the spreadsheet data.
+
+    The leaf of the cell's block is summarised again, and inturn the inner nodes
+    above it are recomputed, so it takes O(log n) time. If the cell is beyond the
+    rows covered by the tree, the tree is built again with double the size.
+    '''
+    r, c = cellKey
+    lTree = me['colSums'].get(c)
+    if lTree == None:
+        return
+    dItems = me['colSumItems'][c]
     if sContent == None:
-        sContent = ""
-    if sContent.strip().startswith('='):
-        lCellAddrs = parse.get_celladdrs_incranges(sContent)
-        #print("DBUG2:syncdCellUpdated:{}:{}".format(sContent.strip(), lCellAddrs), file=GERRFILE)
-        #lCellAddrs = parse.get_celladdrs_incranges_internal(sContent)
-        #print(lCellAddrs, file=GERRFILE)
+        if r not in dItems:
+            return
+        dItems.pop(r)
     else:
-        lCellAddrs = []
-    TOKENCAP1 += len(lCellAddrs)
-    #T2 = time.time()
-    #TIMECAP1 += (T2-T1)
+        newItem = _colsum_item(sContent)
+        if (r in dItems) and (dItems[r] == newItem) and (type(dItems[r]) == type(newItem)):
+            return
+        dItems[r] = newItem
+    b = r >> COLSUMSHIFT
+    size = len(lTree[0]) >> 1
+    if b >= size:
+        while b >= size:
+            size *= 2
+        me['colSums'][c] = _colsum_tree(dItems, size)
+        return
+    n = size + b
+    for i, val in enumerate(_colsum_leaf(dItems, b)):
+        lTree[i][n] = val
+    n >>= 1
+    while n > 0:
+        for lNodes in lTree:
+            lNodes[n] = lNodes[2*n] + lNodes[2*n+1]
+        n >>= 1
+
+
+def _colsums_query(sR, sC, eR, eC):
+    '''
+    Get [intSum, floatsList, floatCnt, cellCnt, otherCnt] for the given range, from the
+    colSums index. The whole blocks within the range are got from O(log n) nodes of the
+    segment tree, while the rows in the partial blocks at either end are got individually.
+    '''
+    lTotals = [ 0, [], 0, 0, 0 ]
+    for c in range(sC, eC+1):
+        lTree = _colsums_column(c)
+        dItems = me['colSumItems'][c]
+        if len(dItems) == 0:
+            continue
+        size = len(lTree[0]) >> 1
+        bS = (sR + (1 << COLSUMSHIFT) - 1) >> COLSUMSHIFT
+        bE = min(((eR+1) >> COLSUMSHIFT), size)
+        if bS >= bE:
+            lRows = _sorted_slice(me['colRows'].get(c, ()), sR, eR)
+        else:
+            lRows = _sorted_slice(me['colRows'].get(c, ()), sR, (bS << COLSUMSHIFT)-1)
+            lRows += _sorted_slice(me['colRows'].get(c, ()), bE << COLSUMSHIFT, eR)
+            lNodes = []
+            nS = size + bS
+            nE = size + bE
+            while nS < nE:
+                if nS & 1:
+                    lNodes.append(nS)
+                    nS += 1
+                if nE & 1:
+                    nE -= 1
+                    lNodes.append(nE)
+                nS >>= 1
+                nE >>= 1
+            for n in lNodes:
+                lTotals[0] += lTree[0][n]
+                lTotals[1].append(lTree[1][n])
+                lTotals[2] += lTree[2][n]
+                lTotals[3] += lTree[3][n]
+                lTotals[4] += lTree[4][n]
+        for r in lRows:
+            val = dItems[r]
+            lTotals[3] += 1
+            if val == None:
+                lTotals[4] += 1
+            elif type(val) == float:
+                lTotals[1].append(val)
+                lTotals[2] += 1
+            else:
+                lTotals[0] += val
+    return lTotals
+
+
+def range_others(sR, sC, eR, eC):
+    '''
+    Get the number of cells in the given range, whose value cant be got from the colSums index.
+
+    Returns None for ranges smaller than COLSUMMINCELLS cells, as walking over them
+    directly is cheaper than building the index of their columns, which are
+    otherwise not summed, just to skip them while walking the links.
+    '''
+    if ((eR-sR+1)*(eC-sC+1)) < COLSUMMINCELLS:
+        return None
+    return _colsums_query(sR, sC, eR, eC)[4]
+
+
+def range_sums(sR, sC, eR, eC):
+    '''
+    Get the sum and count of the cells in the given range, from the colSums index.
+
+    Returns None, if the range contains cells whose value cant be got from the index,
+    in which case the caller should walk over the range.
+
+    Even small ranges are answered from the index, as their cells' numeric values
+    are already got in the colSumItems of the column, while walking over them would
+    convert the cells' contents again.
+    '''
+    intSum, lFloats, floatCnt, cellCnt, otherCnt = _colsums_query(sR, sC, eR, eC)
+    if otherCnt > 0:
+        return None
+    if floatCnt == 0:
+        return intSum, cellCnt
+    try:
+        lFloats.append(float(intSum))
+    except OverflowError:
+        return None
+    return math.fsum(lFloats), cellCnt
+
+
+TOKENCAP1 = 0
+def cell_updated_time_init():
+    global TOKENCAP1
+    TOKENCAP1 = 0
+
+
+def fwd_links(sContent, lCellAddrs):
+    '''
+    Convert the cell addresses (including ranges) in the given =expression,
+    into the set of cells and the set of ranges (as rectangles), it depends on.
+    '''
+    if csyncd != None:
+        cellFwdLink, cellFwdRange, lInvalid = csyncd.fwd_links(lCellAddrs)
+        for sAddr in lInvalid:
+            print("WARN:syncdFwdLinks:{}:{}".format(sContent, sAddr), file=GERRFILE)
+        return cellFwdLink, cellFwdRange
+    cellFwdLink = set()
+    cellFwdRange = set()
     for cellAddrPlus in lCellAddrs:
         if (len(cellAddrPlus) == 1):
             bCellAddr, key = parse.celladdr_valid(cellAddrPlus[0])
             if not bCellAddr:
-                print("WARN:syncdCellUpdated:{}:{}={}".format(sContent, cellAddrPlus[0], key), file=GERRFILE)
+                print("WARN:syncdFwdLinks:{}:{}={}".format(sContent, cellAddrPlus[0], key), file=GERRFILE)
                 continue
             cellFwdLink.add(key)
-            cell_revlink_add(key, cellKey)
         elif (len(cellAddrPlus) == 2):
             bCellAddr, key1 = parse.celladdr_valid(cellAddrPlus[0])
             if not bCellAddr:
-                print("WARN:syncdCellUpdated:{}:{}={}".format(sContent, cellAddrPlus[0], key1), file=GERRFILE)
+                print("WARN:syncdFwdLinks:{}:{}={}".format(sContent, cellAddrPlus[0], key1), file=GERRFILE)
                 continue
             bCellAddr, key2 = parse.celladdr_valid(cellAddrPlus[1])
             if not bCellAddr:
-                print("WARN:syncdCellUpdated:{}:{}={}".format(sContent, cellAddrPlus[1], key2), file=GERRFILE)
+                print("WARN:syncdFwdLinks:{}:{}={}".format(sContent, cellAddrPlus[1], key2), file=GERRFILE)
+                continue
+            if (key1[0] > key2[0]) or (key1[1] > key2[1]):
                 continue
-            for r in range(key1[0], key2[0]+1):
-                for c in range(key1[1], key2[1]+1):
-                    cellFwdLink.add((r,c))
-                    cell_revlink_add((r,c), cellKey)
-    #T3 = time.time()
-    #TIMECAP2 += (T3-T2)
+            cellFwdRange.add((key1[0], key1[1], key2[0], key2[1]))
+    return cellFwdLink, cellFwdRange
+
+
+def expr_links(sContent):
+    '''
+    Get the set of cells and the set of ranges, which the given cell content depends on.
+    '''
+    global TOKENCAP1
+    if sContent == None:
+        sContent = ""
+    if sContent.strip().startswith('='):
+        lCellAddrs = parse.get_celladdrs_incranges(sContent)
+        #print("DBUG2:syncdExprLinks:{}:{}".format(sContent.strip(), lCellAddrs), file=GERRFILE)
+    else:
+        lCellAddrs = []
+    TOKENCAP1 += len(lCellAddrs)
+    return fwd_links(sContent, lCellAddrs)
+
+
+def cell_updated(cellKey, sContent, clearCache=True, clearedSet=None, updateLoops=True):
+    '''
+    Update the fw and reverse links associated with each cell
+
+    NOTE: Individual cells are maintained in fwd and rev links, while ranges
+    are maintained as rectangles in fwdRanges and the rangeIndex.
+
+    The calc cache of the cell and all the cells depending on it is cleared
+    in a single linear sweep (see cdata_clear_revlinks). When a bunch of cells
+    are updated from the same context like say during insert / delete of
+    rows / cols, a common clearedSet can be passed to avoid trying to clear
+    calc cache of same dependent cells more than once, across multiple calls
+    to cell_updated.
+
+    updateLoops can be set to False, when a bunch of cells are updated, in which
+    case the caller should inturn call update_loops once for all of them.
+
+    The row of the cell is noted in dirtyRows, if rows are being tracked, so
+    that saving into the same file, can reuse the lines of the other rows.
+    '''
+    me['editCount'] += 1
+    if me['dirtyRows'] != None:
+        me['dirtyRows'].add(cellKey[0])
+    # Drop the compiled =expression, if any, so that it gets recompiled
+    me['cexpr'].pop(cellKey, None)
+    rangememo_discard(cellKey)
+    colsums_update(cellKey, me['data'].get(cellKey))
+    if cellKey in me['data']:
+        sparse_add(cellKey)
+    else:
+        sparse_discard(cellKey)
+    origCellFwdLink = me['fwdLinks'].get(cellKey)
+    origCellFwdRange = me['fwdRanges'].get(cellKey)
+    # Handle the new content of the cell
+    cellFwdLink, cellFwdRange = expr_links(sContent)
+    for key in cellFwdLink:
+        cell_revlink_add(key, cellKey)
     # Handle cells removed from the =expression
     if origCellFwdLink != None:
         droppedCells = origCellFwdLink.difference(cellFwdLink)
@@ -180,37 +1021,355 @@ def cell_updated(cellKey, sContent, clearCache=True, clearedSet=None):
             me['fwdLinks'].pop(cellKey)
     for cell in droppedCells:
         cell_revlink_discard(cell, cellKey)
+    # Handle the ranges
+    if origCellFwdRange == None:
+        origCellFwdRange = set()
+    for rect in origCellFwdRange.difference(cellFwdRange):
+        range_index_discard(cellKey, rect)
+    for rect in cellFwdRange.difference(origCellFwdRange):
+        range_index_add(cellKey, rect)
+    if len(cellFwdRange) > 0:
+        me['fwdRanges'][cellKey] = cellFwdRange
+    else:
+        me['fwdRanges'].pop(cellKey, None)
+    bHadLinks = (origCellFwdLink != None) or (len(origCellFwdRange) > 0)
+    if updateLoops and (bHadLinks or has_links(cellKey)):
+        update_loops([cellKey])
     # Clear cell calc cache for all dependents
     if clearCache:
         cdata_clear_revlinks(cellKey, clearedSet)
-    #T4 = time.time()
-    #TIMECAP3 += (T4-T3)
+
+
+def _shift_list(lItems, fShift):
+    '''
+    Shift the given sorted list of rows|cols, dropping the deleted ones.
+    As fShift is monotonic, the list remains sorted.
+    '''
+    lNew = []
+    for item in lItems:
+        item = fShift(item)
+        if item != None:
+            lNew.append(item)
+    return lNew
+
+
+def _shift_keys(dItems, fShift):
+    '''
+    Shift the row|col keys of the given dict, dropping the deleted ones.
+    '''
+    dNew = dict()
+    for item in dItems:
+        newItem = fShift(item)
+        if newItem != None:
+            dNew[newItem] = dItems[item]
+    return dNew
+
+
+def sparse_shift(bRowMode, fShift):
+    '''
+    Update the sparse index, after rows (bRowMode) or cols have been inserted or deleted.
+    '''
+    if bRowMode:
+        me['rowList'] = _shift_list(me['rowList'], fShift)
+        me['rowCols'] = _shift_keys(me['rowCols'], fShift)
+        dLines = me['colRows']
+    else:
+        me['colRows'] = _shift_keys(me['colRows'], fShift)
+        dLines = me['rowCols']
+    for line in list(dLines):
+        lItems = _shift_list(dLines[line], fShift)
+        if len(lItems) > 0:
+            dLines[line] = lItems
+        else:
+            dLines.pop(line)
+    if not bRowMode:
+        me['rowList'] = sorted(me['rowCols'])
+
+
+def remap_links(bRowMode, iAfter, iInc, sReparseNew=None):
+    '''
+    Update the links and the indexes maintained by syncd, after rows (bRowMode) or cols
+    have been inserted (iInc > 0) or deleted (iInc < 0) after the row|col iAfter, without
+    parsing the =expressions of all the cells again.
+
+    Insert/delete shifts the cells after iAfter by iInc and inturn rewrites the cell
+    addresses in =expressions by shifting those after iAfter by iInc (see
+    edit.update_celladdrs_all). So the existing links are shifted the same way, and the
+    reverse links and the rangeIndex are rebuilt from them. Only the cells which refer
+    to deleted cells, whose rewritten addresses could be err tagged or could point to
+    other cells, are parsed again and inturn have their calc loops updated. Along with
+    the cells in sReparseNew (given by their keys after the shift), whose =expressions
+    have been err tagged in ways, which the links dont capture.
+
+    The colSums index is shifted for col insert/delete, and left to be built again
+    lazily when next required, for row insert/delete.
+
+    NOTE: It expects me['data'] to have been already updated. And the links of the
+    deleted cells to have been already cleared, by calling cell_updated on them.
+
+    As the rows get shifted, dirtyRows tracking is stopped, till the next load/save.
+    '''
+    me['editCount'] += 1
+    me['dirtyRows'] = None
+    iDelEnd = iAfter - iInc
+    def fShift(n):
+        if n <= iAfter:
+            return n
+        if n <= iDelEnd:
+            return None
+        return n + iInc
+    iAxis = 0 if bRowMode else 1
+    if bRowMode:
+        def fMap(cell):
+            if cell[0] <= iAfter:
+                return cell
+            return (cell[0]+iInc, cell[1])
+        def fMapRect(rect):
+            r1, c1, r2, c2 = rect
+            if r1 > iAfter:
+                r1 += iInc
+            if r2 > iAfter:
+                r2 += iInc
+            return (r1, c1, r2, c2)
+    else:
+        def fMap(cell):
+            if cell[1] <= iAfter:
+                return cell
+            return (cell[0], cell[1]+iInc)
+        def fMapRect(rect):
+            r1, c1, r2, c2 = rect
+            if c1 > iAfter:
+                c1 += iInc
+            if c2 > iAfter:
+                c2 += iInc
+            return (r1, c1, r2, c2)
+    # Cells refering to deleted cells are parsed again
+    sReparse = set()
+    if iInc < 0:
+        for cell, links in me['fwdLinks'].items():
+            for link in links:
+                if iAfter < link[iAxis] <= iDelEnd:
+                    sReparse.add(cell)
+                    break
+        for cell, rects in me['fwdRanges'].items():
+            for rect in rects:
+                if (iAfter < rect[iAxis] <= iDelEnd) or (iAfter < rect[iAxis+2] <= iDelEnd):
+                    sReparse.add(cell)
+                    break
+    dFwdLinks = dict()
+    for cell, links in me['fwdLinks'].items():
+        if cell in sReparse:
+            continue
+        dFwdLinks[fMap(cell)] = { fMap(link) for link in links }
+    dFwdRanges = dict()
+    for cell, rects in me['fwdRanges'].items():
+        if cell in sReparse:
+            continue
+        dFwdRanges[fMap(cell)] = { fMapRect(rect) for rect in rects }
+    dCExpr = dict()
+    for cell, cexpr in me['cexpr'].items():
+        if fShift(cell[iAxis]) != None:
+            dCExpr[fMap(cell)] = cexpr
+    dLoopOf = dict()
+    dLoops = dict()
+    for cell, sLoop in me['loopOf'].items():
+        sNewLoop = dLoops.get(id(sLoop))
+        if sNewLoop == None:
+            sNewLoop = frozenset(map(fMap, sLoop))
+            dLoops[id(sLoop)] = sNewLoop
+        dLoopOf[fMap(cell)] = sNewLoop
+    colSums = me['colSums']
+    colSumItems = me['colSumItems']
+    rowList, rowCols, colRows = me['rowList'], me['rowCols'], me['colRows']
+    init()
+    me['rowList'], me['rowCols'], me['colRows'] = rowList, rowCols, colRows
+    sparse_shift(bRowMode, fShift)
+    if not bRowMode:
+        me['colSums'] = _shift_keys(colSums, fShift)
+        me['colSumItems'] = _shift_keys(colSumItems, fShift)
+    me['cexpr'] = dCExpr
+    me['loopOf'] = dLoopOf
+    _links_index(dFwdLinks, dFwdRanges)
+    lReparse = [ fMap(cell) for cell in sReparse ]
+    if sReparseNew != None:
+        lReparse = list(set(lReparse).union(sReparseNew))
+    for cell in lReparse:
+        cell_updated(cell, me['data'].get(cell), clearCache=False, updateLoops=False)
+    update_loops(lReparse)
+
+
+def _links_index(dFwdLinks, dFwdRanges):
+    '''
+    Set the given fwd links and ranges of the cells, and inturn build the revLinks
+    and the rangeIndex from them.
+    '''
+    me['fwdLinks'] = dFwdLinks
+    me['fwdRanges'] = dFwdRanges
+    revLinks = me['revLinks']
+    for cell, links in dFwdLinks.items():
+        for link in links:
+            cellRevLink = revLinks.get(link)
+            if cellRevLink == None:
+                cellRevLink = set()
+                revLinks[link] = cellRevLink
+            cellRevLink.add(cell)
+    for cell, rects in dFwdRanges.items():
+        for rect in rects:
+            range_index_add(cell, rect)
+
+
+def restore_links(dFwdLinks, dFwdRanges, dLoopOf):
+    '''
+    Restore the links and calc loops info for all cells in the spreadsheet in memory,
+    as got from a earlier create_links on the same content. This avoids parsing the
+    =expressions of all the cells and finding the calc loops, as create_links does.
+
+    Like create_links, this doesnt touch the calc cache.
+    '''
+    init()
+    sparse_build()
+    T1 = time.time()
+    _links_index(dFwdLinks, dFwdRanges)
+    me['loopOf'] = dLoopOf
+    T2 = time.time()
+    print("DBUG:restoreLinks:TT:{}".format(T2-T1), file=GERRFILE)
+
+
+def _links_worker_init(sErrFile, bCExt):
+    '''
+    Setup a worker process used by create_links. If the worker process was not
+    forked, the error file and c modules require to be setup again.
+    '''
+    global GERRFILE
+    if (GERRFILE == None) and (sErrFile != None):
+        GERRFILE = open(sErrFile, "a")
+        parse.GERRFILE = GERRFILE
+    if bCExt and (csyncd == None):
+        parse.load_cext()
+        load_cext()
+
+
+def _links_chunk(lCells):
+    '''
+    Get the fwd links and ranges of each of the given (cellKey, sContent) cells.
+    '''
+    lLinks = []
+    for cellKey, sContent in lCells:
+        cellFwdLink, cellFwdRange = expr_links(sContent)
+        lLinks.append((cellKey, cellFwdLink, cellFwdRange))
+    return lLinks
+
+
+def _links_parallel(lCells, numWorkers):
+    '''
+    Get the fwd links and ranges of the given cells, by sharding them across a pool
+    of worker processes.
+    '''
+    chunkSize = (len(lCells) // (numWorkers*4)) + 1
+    sErrFile = getattr(GERRFILE, 'name', None)
+    lChunks = [ lCells[i:i+chunkSize] for i in range(0, len(lCells), chunkSize) ]
+    with concurrent.futures.ProcessPoolExecutor(numWorkers, initializer=_links_worker_init, initargs=(sErrFile, csyncd != None)) as pool:
+        for lLinks in pool.map(_links_chunk, lChunks):
+            yield from lLinks
 
 
 def create_links():
     '''
     Create fwd and rev Links freshly for all cells in the spreadsheet in memory.
 
-    NOTE: Normally when/where create_links is called, even full calc cache update would be
-    triggered by setting cdataUpdate flag to true before or after calling create_links,
-    so the call to cell_updated from create_links can set clearCache to False.
+    NOTE: Normally when/where create_links is called, even full calc cache would be
+    cleared by calling cdata_clear_all before or after calling create_links,
+    so create_links doesnt clear the calc cache of the cells.
 
     As create links doesnt touch the calc cache, so remember to either
 
-        force clear the full calc cache by using cdataUpdate
+        force clear the full calc cache by using cdata_clear_all
 
         OR adjust calc cache suitably in the context from where create_links is called.
+
+    The =expressions are parsed independently of one another, to get the fwd links and
+    ranges of each cell, and inturn the revLinks and rangeIndex are built from them.
+    If there are more than PARALLELLINKS =expressions, the parsing is sharded across
+    a pool of worker processes.
     '''
     init()
-    clearedSet = set()
+    # The content of the spreadsheet could have been replaced as a whole
+    me['editCount'] += 1
+    sparse_build()
     cell_updated_time_init()
     T1 = time.time()
-    for key in me['data']:
-        cell_updated(key, me['data'][key], clearCache=False, clearedSet=clearedSet)
+    lCells = [ (key, sContent) for key, sContent in me['data'].items() if sContent.strip().startswith('=') ]
+    numWorkers = os.cpu_count() or 1
+    if (len(lCells) > PARALLELLINKS) and (numWorkers > 1):
+        itLinks = _links_parallel(lCells, numWorkers)
+    else:
+        itLinks = _links_chunk(lCells)
+    dFwdLinks = dict()
+    dFwdRanges = dict()
+    for cellKey, cellFwdLink, cellFwdRange in itLinks:
+        if len(cellFwdLink) > 0:
+            dFwdLinks[cellKey] = cellFwdLink
+        if len(cellFwdRange) > 0:
+            dFwdRanges[cellKey] = cellFwdRange
     T2 = time.time()
-    print("DBUG:createLinks:T1:{}, T2:{}, T3:{}, CAs:{}; TT:{}".format(TIMECAP1, TIMECAP2, TIMECAP3, TOKENCAP1, T2-T1), file=GERRFILE)
+    _links_index(dFwdLinks, dFwdRanges)
+    me['loopOf'] = find_loops(list(dFwdLinks.keys() | dFwdRanges.keys()))
+    T3 = time.time()
+    print("DBUG:createLinks:TP:{}, CAs:{}, Cells:{}; TT:{}".format(T2-T1, TOKENCAP1, len(lCells), T3-T1), file=GERRFILE)
+
+
+def _test_csyncd_state(bUseC, dData):
+    '''
+    Create the links for the given data, using either the c or the python logic,
+    and return the resulting links, reverse cells of each cell and the cells
+    cleared from the calc cache wrt each cell.
+    '''
+    global csyncd, me
+    if bUseC:
+        load_cext()
+    else:
+        csyncd = None
+    me = { 'data': dData, 'cdata': dict(), 'numRows': 100, 'editCount': 0, 'dirtyRows': set() }
+    create_links()
+    assert me['editCount'] == 1, "create_links should count as an edit"
+    assert me['dirtyRows'] == set(), "create_links shouldnt mark rows dirty"
+    dRevCells = dict()
+    dCleared = dict()
+    for key in dData:
+        dRevCells[key] = rev_cells(key)
+        me['cdata'] = dict.fromkeys(dData, 0)
+        clearedSet = set()
+        cdata_clear_revlinks(key, clearedSet)
+        dCleared[key] = (clearedSet, set(me['cdata'].keys()))
+    return me['fwdLinks'], me['revLinks'], me['fwdRanges'], me['loopOf'], dRevCells, dCleared
 
 
+def test_csyncd(numCells=2000, seed=1):
+    '''
+    Check that the csyncd c module and the python logic give the same results,
+    for a spreadsheet with random =expressions. AssertionError is raised, if the
+    c module cant be loaded or if any of the results dont match.
+    '''
+    import random
+    global csyncd, me
+    savedCSyncd, savedMe = csyncd, me
+    random.seed(seed)
+    cols = "ABCDEFGHIJ"
+    dData = dict()
+    for i in range(numCells):
+        r, c = random.randint(1, 100), random.randint(1, 10)
+        sA = "{}{}".format(random.choice(cols), random.randint(1, 100))
+        sB = "{}{}".format(random.choice(cols), random.randint(1, 100))
+        dData[(r,c)] = random.choice([ "1", "=1+2", "={}+1".format(sA), "=sum({}:{})+{}".format(sA, sB, sA), "=$A$1+{}:{}".format(sB, sA) ])
+    try:
+        lPy = _test_csyncd_state(False, dData)
+        lC = _test_csyncd_state(True, dData)
+        assert csyncd != None, "test_csyncd: csyncd c module not available"
+        for name, py, c in zip([ "fwdLinks", "revLinks", "fwdRanges", "loopOf", "revCells", "cleared" ], lPy, lC):
+            assert py == c, "test_csyncd:{}:MISMATCH".format(name)
+            print("test_csyncd:{}:ok".format(name))
+    finally:
+        csyncd, me = savedCSyncd, savedMe
 
 
 # vim: set sts=4 expandtab: #
@@ -16,10 +16,13 @@ treeDB = {
                         'neat': None,
                         'raw': None
                         },
+            'cautosave': { 'ANYNUM': None },
             'clear': None,
             'l': None,
             'w': None,
             's': None,
+            'ws': None,
+            'ls': None,
             'pl': None,
             'pw': None,
             'ps': None,